@@ -0,0 +1,63 @@
+# Measures how much pure Python work overlaps with a blocking Vulkan command called from another thread
+# the commands are generated wrappers listed in genswigi.default_gil_releasing_commands
+# For a software only run use lavapipe e.g. VK_ICD_FILENAMES=/usr/share/vulkan/icd.d/lvp_icd.x86_64.json
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+import argparse
+import threading
+import time
+import vulkanmitts as vk
+from vkcontextmanager import VkContextManager
+from hello_vulkanmittsoffscreen import record_textured_cube
+
+# pure Python on purpose, numpy would release the GIL by itself and hide the contention
+def python_work(iterations):
+    acc = 0
+    for i in range(iterations):
+        acc += i * i % 7
+    return acc
+
+def timed(fct, *args):
+    t0 = time.perf_counter()
+    fct(*args)
+    return time.perf_counter() - t0
+
+def benchmark(frames, iterations, command = 'queueWaitIdle'):
+    with VkContextManager(VkContextManager.VKC_INIT_PIPELINE, VkContextManager.VKC_OFFSCREEN) as vkc:
+        record_textured_cube(vkc)
+        def render():
+            for i in range(frames):
+                if command == 'queueWaitIdle':
+                    vkc.submit()
+                    vk.queueWaitIdle(vkc.device_queue)
+                else:
+                    # hits the pipeline cache after the first iteration, but the driver still builds the pipeline state
+                    vkc.create_graphics_pipeline(vkc.vertex_shader, vkc.vertex_layout)
+
+        render_time = timed(render)
+        work_time = timed(python_work, iterations)
+
+        worker = threading.Thread(target=python_work, args=(iterations,))
+        t0 = time.perf_counter()
+        worker.start()
+        render()
+        worker.join()
+        concurrent_time = time.perf_counter() - t0
+
+    # 0.0 when the two threads are serialized by the GIL, 1.0 when the shortest one is completely hidden
+    overlap = (render_time + work_time - concurrent_time) / min(render_time, work_time)
+    print('%s x %d: %.3fs' % (command, frames, render_time))
+    print('python work: %.3fs' % work_time)
+    print('concurrent: %.3fs' % concurrent_time)
+    print('overlap: %.2f' % overlap)
+    return overlap
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the overlap between Python threads and blocking Vulkan commands.')
+    parser.add_argument('--command',choices=['queueWaitIdle','createGraphicsPipelines'],default='queueWaitIdle',help='Blocking command timed against the Python thread')
+    parser.add_argument('--frames',type=int,default=200,help='Number of calls to the blocking command')
+    parser.add_argument('--iterations',type=int,default=5000000,help='Number of iterations of the pure Python work')
+    args = parser.parse_args()
+
+    benchmark(args.frames, args.iterations, args.command)
@@ -0,0 +1,48 @@
+# Measures the speedup of recording secondary command buffers from N threads instead of 1 with vkrecording.ParallelRecorder
+# the tasks replay command streams with cmdReplayCommandStream, which releases the GIL during the recording
+# For a software only run use lavapipe e.g. VK_ICD_FILENAMES=/usr/share/vulkan/icd.d/lvp_icd.x86_64.json
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+import argparse
+import time
+from cube_data import *
+from vkcontextmanager import VkContextManager
+from vkrecording import ParallelRecorder
+from mesh import grid_transforms
+
+def timed_recording(recorder, tasks, frames):
+    t0 = time.perf_counter()
+    for i in range(frames):
+        # nothing is submitted, the command buffers can be recycled right away
+        recorder.reset()
+        recorder.record(tasks)
+    return time.perf_counter() - t0
+
+def benchmark(frames, grid_size, thread_count, task_count):
+    with VkContextManager(vertex_data = get_xyzw_uv_cube_coords(), surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+        mvps = vkc.model_view_projections(grid_transforms(grid_size, spacing = 4.0 / grid_size, size = 1.6 / grid_size))
+        times = []
+        for count in [1, thread_count]:
+            with ParallelRecorder(vkc, count) as recorder:
+                tasks = recorder.push_constant_draw_tasks(mvps, task_count)
+                # warm up, the first frame allocates the command buffers
+                timed_recording(recorder, tasks, 1)
+                times.append(timed_recording(recorder, tasks, frames))
+
+    speedup = times[0] / times[1]
+    print('%d draws x %d frames' % (len(mvps), frames))
+    print('1 thread: %.3fs' % times[0])
+    print('%d threads: %.3fs' % (thread_count, times[1]))
+    print('speedup: %.2f' % speedup)
+    return speedup
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the speedup of recording command buffers from many threads.')
+    parser.add_argument('--frames',type=int,default=50,help='Number of recorded frames')
+    parser.add_argument('--grid_size',type=int,default=100,help='The grid_size x grid_size cubes are drawn with one draw each')
+    parser.add_argument('--threads',type=int,default=4,help='Number of recording threads compared to 1')
+    parser.add_argument('--tasks',type=int,default=16,help='Number of secondary command buffers per frame')
+    args = parser.parse_args()
+
+    benchmark(args.frames, args.grid_size, args.threads, args.tasks)
@@ -0,0 +1,18 @@
+# File helpers shared by the on-disk caches
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+import os
+import tempfile
+
+# write to a temporary file in the same folder then rename, a reader never sees a partially written file
+def atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -82,6 +82,13 @@ def p_name_to_vec_ptr(identifier):
         return 'vecPtr' + identifier[2:]
     return 'vecPtr' + identifier[1:]
 
+# VkTimelineSemaphoreSubmitInfo => timelineSemaphoreSubmitInfo
+def chain_param_name(struct_identifier):
+    return struct_identifier[2].lower() + struct_identifier[3:]
+
+def p_name_to_chain(identifier):
+    return 'chain' + identifier[0].upper() + identifier[1:]
+
 def p_name_to_val(identifier):
     return identifier[1].lower() + identifier[2:]
 
@@ -98,6 +105,39 @@ def argout_void_to_char(argout_type):
         return 'uint8_t'
     return argout_type
 
+# commands that can block or compile, their wrappers release the GIL for the duration of the driver call
+# so that other Python threads keep running while e.g. a fence is waited on or a pipeline is compiled
+default_gil_releasing_commands = ['vkQueueSubmit',
+                                  'vkQueueSubmit2',
+                                  'vkQueueSubmit2KHR',
+                                  'vkQueueBindSparse',
+                                  'vkQueueWaitIdle',
+                                  'vkDeviceWaitIdle',
+                                  'vkWaitForFences',
+                                  'vkWaitSemaphores',
+                                  'vkWaitSemaphoresKHR',
+                                  'vkGetQueryPoolResults',
+                                  'vkAcquireNextImageKHR',
+                                  'vkAcquireNextImage2KHR',
+                                  'vkQueuePresentKHR',
+                                  'vkCreateGraphicsPipelines',
+                                  'vkCreateComputePipelines',
+                                  'vkCreateShaderModule',
+                                  'vkCreatePipelineCache',
+                                  'vkGetPipelineCacheData',
+                                  'vkMergePipelineCaches',
+                                  'vkCreateDevice']
+
+# prefixes of more commands releasing the GIL e.g. vkCmd, none by default because the vkCmd* calls are too short
+# for the release to pay off, vkrecording.ParallelRecorder records command streams instead, measure before enabling it
+default_gil_releasing_prefixes = []
+
+# extension structs that can be chained in the pNext of the structs they extend, see findPNextChains
+# each one becomes an optional trailing parameter of the makers of the extended structs e.g. SubmitInfo and SemaphoreCreateInfo
+default_pnext_structs = ['VkTimelineSemaphoreSubmitInfo',
+                         'VkSemaphoreTypeCreateInfo',
+                         'VkPhysicalDeviceTimelineSemaphoreFeatures']
+
 def findAllocatedPtrType(is_alloc, params):
     allocated_ptr_type = None
     if not is_alloc:
@@ -137,15 +177,24 @@ class CSWIGOutputGenerator(COutputGenerator):
                  tree_copy,
                  errFile = sys.stderr,
                  warnFile = sys.stderr,
-                 diagFile = sys.stdout):
+                 diagFile = sys.stdout,
+                 gil_releasing_commands = default_gil_releasing_commands,
+                 gil_releasing_prefixes = default_gil_releasing_prefixes,
+                 pnext_structs = default_pnext_structs):
         COutputGenerator.__init__(self, errFile, warnFile, diagFile)
         self.tree_copy = tree_copy
+        self.gilReleasingCommands = set(gil_releasing_commands)
+        self.gilReleasingPrefixes = tuple(gil_releasing_prefixes)
+        self.pNextStructs = list(pnext_structs)
+        self.pNextChains = {}
+        # the makers with a pNext chain access the RAII struct of the chained types, they are written after all the features
+        self.swigChainImpl = []
         self.shared_ptr_types = set()
         self.std_vector_types = set()
         self.redundant_typedef_types = set(['VkPipelineStageFlags','VkObjectEntryUsageFlagsNVX'])
         self.swigImpl = []
         self.fctPtrDecl = []
-        self.skippedCommands = ['vkAllocateCommandBuffers','vkAllocateDescriptorSets']
+        self.skippedCommands = ['vkAllocateCommandBuffers','vkAllocateDescriptorSets','vkAllocateMemory']
         self.handleTypes = set()
         self.vectorOfHandleTypes = set()
         # types that must not be in the generated interface file because their SWIG generate wrappers are not what we want
@@ -263,6 +312,18 @@ class CSWIGOutputGenerator(COutputGenerator):
                                 self.nonRAIIStruct.add(typename)
                                 break
 
+    # maps each struct extended by one of self.pNextStructs to the list of its chainable types
+    # the extended structs keep a copy of the chained structs, so they must be RAII structs
+    def findPNextChains(self):
+        all_types = self.registry.reg.findall("types/type")
+        for type in all_types:
+            typename = type.get('name')
+            if typename in self.pNextStructs and typename in self.structTypes and type.get('structextends') is not None:
+                for extended_typename in type.get('structextends').split(','):
+                    if extended_typename in self.structTypes:
+                        self.pNextChains.setdefault(extended_typename, []).append(typename)
+                        self.nonRAIIStruct.add(extended_typename)
+
     def beginFile(self, genOpts):
         self.outdir = genOpts.directory
         OutputGenerator.beginFile(self, genOpts)
@@ -279,6 +340,7 @@ class CSWIGOutputGenerator(COutputGenerator):
         self.getVkStructureTypes()
         self.findParamsAndMembersCArray()
         self.findNonRAIIStruct()
+        self.findPNextChains()
 
     def getVkStructureTypes(self):
         self.structure_type_enum_strings = set()
@@ -361,6 +423,7 @@ class CSWIGOutputGenerator(COutputGenerator):
         write(self.loadPtrs, file=self.outFile)
         write('%{\n', file=self.outFile)
         write('\n'.join(self.swigImpl), end='', file=self.outFile)
+        write('\n'.join(self.swigChainImpl), end='', file=self.outFile)
         write('%}\n', file=self.outFile)
 
         for type_name in self.nonRAIIStruct:
@@ -407,6 +470,7 @@ class CSWIGOutputGenerator(COutputGenerator):
             file_out.write("%carray_of_float(float)\n")
             file_out.write("%carray_of_long(int32_t)\n")
             file_out.write("%carray_of_long(uint32_t)\n")
+            file_out.write("%carray_of_long(uint8_t)\n")
             for t in self.structCArrayTypes:
                 file_out.write("%%carray_of_struct(%s)\n" % t)
 
@@ -531,6 +595,10 @@ class CSWIGOutputGenerator(COutputGenerator):
         if kept_members == 0:
             return
 
+        # the structs that can be chained in pNext are optional trailing parameters, nullptr or None in Python to skip them
+        chain_types = self.pNextChains.get(typeName, [])
+        n_params = kept_members + len(chain_types)
+
         swig_maker_name = maker_name(typeName)
         raii_type_name = typeName + 'RAII'
         raii_struct_body = typeinfo.elem.get('category') + ' ' + raii_type_name + ' {\n'
@@ -615,12 +683,35 @@ class CSWIGOutputGenerator(COutputGenerator):
                     paramdecl = self.makeCParamDecl(members[i], self.genOpts.alignFuncParam)
                     written_cnt += 1
 
-                if (written_cnt < kept_members):
+                if (written_cnt < n_params):
                     paramdecl += ',\n'
                 else:
                     paramdecl += ')'
 
                 indentdecl += paramdecl
+
+            for k, chain_type in enumerate(chain_types):
+                chain_name = chain_param_name(chain_type)
+                if chain_type in self.nonRAIIStruct:
+                    paramdecl = '    const std::shared_ptr<%(chain_type)sRAII> &' % locals()
+                else:
+                    paramdecl = '    const %(chain_type)s *' % locals()
+                paramdecl = paramdecl.rstrip()
+                paramdecl = paramdecl.ljust(48)
+                paramdecl += chain_name + ' = nullptr'
+                paramdecl += ',\n' if k < len(chain_types) - 1 else ')'
+                indentdecl += paramdecl
+
+                memberdecl = '    %(chain_type)s' % locals()
+                memberdecl = memberdecl.ljust(48)
+                memberdecl += p_name_to_chain(chain_name)
+                raii_struct_body += memberdecl + ';\n'
+                if chain_type in self.nonRAIIStruct:
+                    memberdecl = '    std::shared_ptr<%(chain_type)sRAII>' % locals()
+                    memberdecl = memberdecl.ljust(48)
+                    memberdecl += chain_name
+                    raii_struct_body += memberdecl + ';\n'
+                raii_struct_req = True
         else:
             indentdecl = '(void)'
 
@@ -713,6 +804,22 @@ class CSWIGOutputGenerator(COutputGenerator):
                     else:
                         swig_impl += '      raii_obj->nonRaiiObj.%(member_name)s = %(member_name)s;\n' % locals()
 
+            # each chained struct is copied in the RAII struct and inserted at the head of the pNext chain
+            # the RAII chained structs are also referenced so that their arrays outlive the copy
+            for chain_type in chain_types:
+                chain_name = chain_param_name(chain_type)
+                chain_member_name = p_name_to_chain(chain_name)
+                swig_impl += '      if ( %(chain_name)s )\n' % locals()
+                swig_impl += '      {\n'
+                if chain_type in self.nonRAIIStruct:
+                    swig_impl += '          raii_obj->%(chain_name)s = %(chain_name)s;\n' % locals()
+                    swig_impl += '          raii_obj->%(chain_member_name)s = %(chain_name)s->nonRaiiObj;\n' % locals()
+                else:
+                    swig_impl += '          raii_obj->%(chain_member_name)s = *%(chain_name)s;\n' % locals()
+                swig_impl += '          raii_obj->%(chain_member_name)s.pNext = const_cast<void*>(raii_obj->nonRaiiObj.pNext);\n' % locals()
+                swig_impl += '          raii_obj->nonRaiiObj.pNext = &raii_obj->%(chain_member_name)s;\n' % locals()
+                swig_impl += '      }\n'
+
             swig_impl += '      return raii_obj;\n'
         else:
             swig_impl += '      %(typeName)s obj;\n' % locals()
@@ -734,6 +841,16 @@ class CSWIGOutputGenerator(COutputGenerator):
         swig_impl += '   }\n'
         self.appendSection('command', fct_decl + '\n')
 
+        if len(chain_types) > 0:
+            protect = self.currentFeature not in self.crossPlatformFeatures
+            if protect:
+                self.swigChainImpl.append('#ifdef ' + self.currentFeature)
+            self.swigChainImpl.append(raii_struct_body)
+            self.swigChainImpl.append(swig_impl)
+            if protect:
+                self.swigChainImpl.append('#endif /* ' + self.currentFeature + '*/')
+            return
+
         if raii_struct_req:
             self.swigFeatureImpl.append(raii_struct_body)
 
@@ -996,6 +1113,16 @@ class CSWIGOutputGenerator(COutputGenerator):
                 swig_impl += '      vec%(argout_param_name)s.resize(%(argout_param_name)sCount); \n\n'% locals()
 
         # FUNCTION BODY : call to wrapped function
+        # when the GIL is released the result is checked after the GIL is re-acquired since ThrowOnVkError builds the exception
+        release_gil = command_name in self.gilReleasingCommands or (len(self.gilReleasingPrefixes) > 0 and command_name.startswith(self.gilReleasingPrefixes))
+        if release_gil:
+            if return_type_str != 'void':
+                swig_impl += '      %(return_type_str)s result;\n' % locals()
+                cbs = 'result = '
+            else:
+                cbs = ''
+            cbe = ''
+            swig_impl += '      Py_BEGIN_ALLOW_THREADS\n'
         swig_impl += '      %(cbs)s%(pf)s%(command_name)s(\n' % locals()
         for i in range(0,n):
             passed_param_name, passed_param_type = params_name_type[i]
@@ -1044,6 +1171,11 @@ class CSWIGOutputGenerator(COutputGenerator):
 
         swig_impl += '  )%(cbe)s;\n' % locals()
 
+        if release_gil:
+            swig_impl += '      Py_END_ALLOW_THREADS\n'
+            if return_type_str == 'VkResult':
+                swig_impl += '      ThrowOnVkError(result, "%(command_name)s", __FILE__, __LINE__);\n' % locals()
+
         allocated_ptr_type = findAllocatedPtrType(is_allocation_cmd, params)
 
         # FUNCTION BODY : Optional return statement
@@ -1236,7 +1368,7 @@ vlam3dPrefixString = """
 */
 """
 
-def genswigi(vkxml, output_folder):
+def genswigi(vkxml, output_folder, gil_releasing_commands = default_gil_releasing_commands, gil_releasing_prefixes = default_gil_releasing_prefixes, pnext_structs = default_pnext_structs):
     if not os.path.exists(vkxml):
         raise RuntimeError(vkxml+' not found')
 
@@ -1295,7 +1427,7 @@ def genswigi(vkxml, output_folder):
     errWarn = sys.stderr
     print(f'Writing SWIG interface to {output_folder}/vulkan.ixx')
     with open(diagFilename, 'w', encoding='utf-8') as diag:
-        gen = CSWIGOutputGenerator(tree_copy, errFile=errWarn, warnFile=errWarn, diagFile=diag)
+        gen = CSWIGOutputGenerator(tree_copy, errFile=errWarn, warnFile=errWarn, diagFile=diag, gil_releasing_commands=gil_releasing_commands, gil_releasing_prefixes=gil_releasing_prefixes, pnext_structs=pnext_structs)
         reg.setGenerator(gen)
         reg.apiGen()
 
@@ -1304,8 +1436,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generates a SWIG interface from vk.xml.')
     parser.add_argument('vkxml',type=str,help='Path to vk.xml')
     parser.add_argument('output_folder',type=str,help='Folder where to write the SWIG interface')
+    parser.add_argument('--gil_releasing_commands',type=str,default=','.join(default_gil_releasing_commands),help='Comma separated list of the commands that release the GIL during the driver call, empty for none')
+    parser.add_argument('--gil_releasing_prefixes',type=str,default=','.join(default_gil_releasing_prefixes),help='Comma separated list of command name prefixes e.g. vkCmd whose commands release the GIL, empty for none')
+    parser.add_argument('--pnext_structs',type=str,default=','.join(default_pnext_structs),help='Comma separated list of the extension structs that can be chained in the pNext of the structs they extend, empty for none')
 
     args = parser.parse_args()
 
-    genswigi(args.vkxml, args.output_folder)
+    genswigi(args.vkxml, args.output_folder, [c for c in args.gil_releasing_commands.split(',') if c], [p for p in args.gil_releasing_prefixes.split(',') if p], [t for t in args.pnext_structs.split(',') if t])
 
@@ -0,0 +1,104 @@
+# Compiles a manifest of GLSL shader permutations to SPIR-V files using a pool of processes
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+#
+# The manifest is a JSON list of entries:
+# [ { "stage": "vert", "source": "vertex_shader.glsl", "defines": { "USE_NORMALS": 1 }, "output": "optional_name.spv" }, ... ]
+# source paths are relative to the manifest folder
+from __future__ import print_function
+import os
+import sys
+import json
+import hashlib
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pyglslang
+from glsl_to_spv import glslang_session
+from fileutils import atomic_write
+
+# same stage names as the file extensions used by glslangValidator
+STAGES = { 'vert' : pyglslang.EShLangVertex,
+           'tesc' : pyglslang.EShLangTessControl,
+           'tese' : pyglslang.EShLangTessEvaluation,
+           'geom' : pyglslang.EShLangGeometry,
+           'frag' : pyglslang.EShLangFragment,
+           'comp' : pyglslang.EShLangCompute }
+
+ShaderPermutation = namedtuple('ShaderPermutation', ['stage', 'source', 'defines', 'output'])
+CompileResult = namedtuple('CompileResult', ['permutation', 'success', 'log', 'output_path'])
+
+# the defines must come after the #version directive
+def inject_defines(shader_code, defines):
+    if not defines:
+        return shader_code
+    define_lines = ''.join('#define %s %s\n' % (name, value) for name, value in sorted(defines.items()))
+    lines = shader_code.splitlines(True)
+    for i, line in enumerate(lines):
+        if line.strip().startswith('#version'):
+            return ''.join(lines[:i+1]) + define_lines + ''.join(lines[i+1:])
+    return define_lines + shader_code
+
+def default_output_name(stage, source, defines):
+    base_name = os.path.splitext(os.path.basename(source))[0]
+    if not defines:
+        return '%s.%s.spv' % (base_name, stage)
+    defines_hash = hashlib.sha256(json.dumps(defines, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    return '%s.%s.%s.spv' % (base_name, stage, defines_hash)
+
+def load_manifest(manifest_path):
+    with open(manifest_path, 'r') as manifest_file:
+        entries = json.load(manifest_file)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    permutations = []
+    for entry in entries:
+        stage = entry['stage']
+        if stage not in STAGES:
+            raise ValueError('Unknown shader stage %s, expecting one of %s' % (stage, ', '.join(sorted(STAGES))))
+        source = os.path.join(manifest_dir, entry['source'])
+        defines = entry.get('defines', {})
+        output = entry.get('output', default_output_name(stage, source, defines))
+        permutations.append(ShaderPermutation(stage, source, defines, output))
+    return permutations
+
+def compile_permutation(permutation, output_dir):
+    # the first call in a worker process initializes glslang, it then stays initialized for the next shaders
+    # done here rather than with the initializer of ProcessPoolExecutor which needs Python 3.7
+    glslang_session.initialize()
+    with open(permutation.source, 'r') as source_file:
+        shader_code = inject_defines(source_file.read(), permutation.defines)
+    spv, log = glslang_session.compile_with_log(STAGES[permutation.stage], shader_code)
+    if spv is None:
+        return CompileResult(permutation, False, log, None)
+    output_path = os.path.join(output_dir, permutation.output)
+    atomic_write(output_path, np.array(spv, dtype='<u4').tobytes())
+    return CompileResult(permutation, True, log, output_path)
+
+# yields a CompileResult as soon as each shader is compiled, not in the manifest order
+def compile_batch(permutations, output_dir, max_workers = None):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(compile_permutation, p, output_dir) for p in permutations]
+        for future in as_completed(futures):
+            yield future.result()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compiles a manifest of GLSL shader permutations to SPIR-V.')
+    parser.add_argument('manifest',type=str,help='Path to the JSON manifest')
+    parser.add_argument('output_folder',type=str,help='Folder where to write the .spv files')
+    parser.add_argument('--jobs',type=int,default=None,help='Number of worker processes, default is the number of cores')
+    args = parser.parse_args()
+
+    failures = 0
+    for result in compile_batch(load_manifest(args.manifest), args.output_folder, args.jobs):
+        if result.success:
+            print('%s -> %s' % (result.permutation.source, result.output_path))
+        else:
+            failures += 1
+            print('FAILED %s %s' % (result.permutation.source, json.dumps(result.permutation.defines)))
+        if len(result.log) > 0:
+            print(result.log)
+
+    sys.exit(1 if failures > 0 else 0)
@@ -2,131 +2,283 @@
 # Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
 # This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
 
+import os
+import atexit
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+import numpy as np
 import pyglslang
 from contextlib2 import contextmanager
+from fileutils import atomic_write
 
-@contextmanager
-def pyglslangprocessing():
-    try:      
-        pyglslang.InitializeProcess()
-        yield   
-    finally:
-        pyglslang.FinalizeProcess()
+SPV_MAGIC_NUMBER = 0x07230203
 
+# TBuiltInResource values set by init_resources, from glslang's StandAlone/ResourceLimits.cpp
+RESOURCE_LIMITS = OrderedDict([
+    ('maxLights', 32),
+    ('maxClipPlanes', 6),
+    ('maxTextureUnits', 32),
+    ('maxTextureCoords', 32),
+    ('maxVertexAttribs', 64),
+    ('maxVertexUniformComponents', 4096),
+    ('maxVaryingFloats', 64),
+    ('maxVertexTextureImageUnits', 32),
+    ('maxCombinedTextureImageUnits', 80),
+    ('maxTextureImageUnits', 32),
+    ('maxFragmentUniformComponents', 4096),
+    ('maxDrawBuffers', 32),
+    ('maxVertexUniformVectors', 128),
+    ('maxVaryingVectors', 8),
+    ('maxFragmentUniformVectors', 16),
+    ('maxVertexOutputVectors', 16),
+    ('maxFragmentInputVectors', 15),
+    ('minProgramTexelOffset', -8),
+    ('maxProgramTexelOffset', 7),
+    ('maxClipDistances', 8),
+    ('maxComputeWorkGroupCountX', 65535),
+    ('maxComputeWorkGroupCountY', 65535),
+    ('maxComputeWorkGroupCountZ', 65535),
+    ('maxComputeWorkGroupSizeX', 1024),
+    ('maxComputeWorkGroupSizeY', 1024),
+    ('maxComputeWorkGroupSizeZ', 64),
+    ('maxComputeUniformComponents', 1024),
+    ('maxComputeTextureImageUnits', 16),
+    ('maxComputeImageUniforms', 8),
+    ('maxComputeAtomicCounters', 8),
+    ('maxComputeAtomicCounterBuffers', 1),
+    ('maxVaryingComponents', 60),
+    ('maxVertexOutputComponents', 64),
+    ('maxGeometryInputComponents', 64),
+    ('maxGeometryOutputComponents', 128),
+    ('maxFragmentInputComponents', 128),
+    ('maxImageUnits', 8),
+    ('maxCombinedImageUnitsAndFragmentOutputs', 8),
+    ('maxCombinedShaderOutputResources', 8),
+    ('maxImageSamples', 0),
+    ('maxVertexImageUniforms', 0),
+    ('maxTessControlImageUniforms', 0),
+    ('maxTessEvaluationImageUniforms', 0),
+    ('maxGeometryImageUniforms', 0),
+    ('maxFragmentImageUniforms', 8),
+    ('maxCombinedImageUniforms', 8),
+    ('maxGeometryTextureImageUnits', 16),
+    ('maxGeometryOutputVertices', 256),
+    ('maxGeometryTotalOutputComponents', 1024),
+    ('maxGeometryUniformComponents', 1024),
+    ('maxGeometryVaryingComponents', 64),
+    ('maxTessControlInputComponents', 128),
+    ('maxTessControlOutputComponents', 128),
+    ('maxTessControlTextureImageUnits', 16),
+    ('maxTessControlUniformComponents', 1024),
+    ('maxTessControlTotalOutputComponents', 4096),
+    ('maxTessEvaluationInputComponents', 128),
+    ('maxTessEvaluationOutputComponents', 128),
+    ('maxTessEvaluationTextureImageUnits', 16),
+    ('maxTessEvaluationUniformComponents', 1024),
+    ('maxTessPatchComponents', 120),
+    ('maxPatchVertices', 32),
+    ('maxTessGenLevel', 64),
+    ('maxViewports', 16),
+    ('maxVertexAtomicCounters', 0),
+    ('maxTessControlAtomicCounters', 0),
+    ('maxTessEvaluationAtomicCounters', 0),
+    ('maxGeometryAtomicCounters', 0),
+    ('maxFragmentAtomicCounters', 8),
+    ('maxCombinedAtomicCounters', 8),
+    ('maxAtomicCounterBindings', 1),
+    ('maxVertexAtomicCounterBuffers', 0),
+    ('maxTessControlAtomicCounterBuffers', 0),
+    ('maxTessEvaluationAtomicCounterBuffers', 0),
+    ('maxGeometryAtomicCounterBuffers', 0),
+    ('maxFragmentAtomicCounterBuffers', 1),
+    ('maxCombinedAtomicCounterBuffers', 1),
+    ('maxAtomicCounterBufferSize', 16384),
+    ('maxTransformFeedbackBuffers', 4),
+    ('maxTransformFeedbackInterleavedComponents', 64),
+    ('maxCullDistances', 8),
+    ('maxCombinedClipAndCullDistances', 8),
+    ('maxSamples', 4)
+])
+
+RESOURCE_BOOL_LIMITS = OrderedDict([
+    ('nonInductiveForLoops', True),
+    ('whileLoops', True),
+    ('doWhileLoops', True),
+    ('generalUniformIndexing', True),
+    ('generalAttributeMatrixVectorIndexing', True),
+    ('generalVaryingIndexing', True),
+    ('generalSamplerIndexing', True),
+    ('generalVariableIndexing', True),
+    ('generalConstantMatrixVectorIndexing', True)
+])
 
 def init_resources():
     resources = pyglslang.TBuiltInResource()
-    resources.maxLights = 32
-    resources.maxClipPlanes = 6
-    resources.maxTextureUnits = 32
-    resources.maxTextureCoords = 32
-    resources.maxVertexAttribs = 64
-    resources.maxVertexUniformComponents = 4096
-    resources.maxVaryingFloats = 64
-    resources.maxVertexTextureImageUnits = 32
-    resources.maxCombinedTextureImageUnits = 80
-    resources.maxTextureImageUnits = 32
-    resources.maxFragmentUniformComponents = 4096
-    resources.maxDrawBuffers = 32
-    resources.maxVertexUniformVectors = 128
-    resources.maxVaryingVectors = 8
-    resources.maxFragmentUniformVectors = 16
-    resources.maxVertexOutputVectors = 16
-    resources.maxFragmentInputVectors = 15
-    resources.minProgramTexelOffset = -8
-    resources.maxProgramTexelOffset = 7
-    resources.maxClipDistances = 8
-    resources.maxComputeWorkGroupCountX = 65535
-    resources.maxComputeWorkGroupCountY = 65535
-    resources.maxComputeWorkGroupCountZ = 65535
-    resources.maxComputeWorkGroupSizeX = 1024
-    resources.maxComputeWorkGroupSizeY = 1024
-    resources.maxComputeWorkGroupSizeZ = 64
-    resources.maxComputeUniformComponents = 1024
-    resources.maxComputeTextureImageUnits = 16
-    resources.maxComputeImageUniforms = 8
-    resources.maxComputeAtomicCounters = 8
-    resources.maxComputeAtomicCounterBuffers = 1
-    resources.maxVaryingComponents = 60
-    resources.maxVertexOutputComponents = 64
-    resources.maxGeometryInputComponents = 64
-    resources.maxGeometryOutputComponents = 128
-    resources.maxFragmentInputComponents = 128
-    resources.maxImageUnits = 8
-    resources.maxCombinedImageUnitsAndFragmentOutputs = 8
-    resources.maxCombinedShaderOutputResources = 8
-    resources.maxImageSamples = 0
-    resources.maxVertexImageUniforms = 0
-    resources.maxTessControlImageUniforms = 0
-    resources.maxTessEvaluationImageUniforms = 0
-    resources.maxGeometryImageUniforms = 0
-    resources.maxFragmentImageUniforms = 8
-    resources.maxCombinedImageUniforms = 8
-    resources.maxGeometryTextureImageUnits = 16
-    resources.maxGeometryOutputVertices = 256
-    resources.maxGeometryTotalOutputComponents = 1024
-    resources.maxGeometryUniformComponents = 1024
-    resources.maxGeometryVaryingComponents = 64
-    resources.maxTessControlInputComponents = 128
-    resources.maxTessControlOutputComponents = 128
-    resources.maxTessControlTextureImageUnits = 16
-    resources.maxTessControlUniformComponents = 1024
-    resources.maxTessControlTotalOutputComponents = 4096
-    resources.maxTessEvaluationInputComponents = 128
-    resources.maxTessEvaluationOutputComponents = 128
-    resources.maxTessEvaluationTextureImageUnits = 16
-    resources.maxTessEvaluationUniformComponents = 1024
-    resources.maxTessPatchComponents = 120
-    resources.maxPatchVertices = 32
-    resources.maxTessGenLevel = 64
-    resources.maxViewports = 16
-    resources.maxVertexAtomicCounters = 0
-    resources.maxTessControlAtomicCounters = 0
-    resources.maxTessEvaluationAtomicCounters = 0
-    resources.maxGeometryAtomicCounters = 0
-    resources.maxFragmentAtomicCounters = 8
-    resources.maxCombinedAtomicCounters = 8
-    resources.maxAtomicCounterBindings = 1
-    resources.maxVertexAtomicCounterBuffers = 0
-    resources.maxTessControlAtomicCounterBuffers = 0
-    resources.maxTessEvaluationAtomicCounterBuffers = 0
-    resources.maxGeometryAtomicCounterBuffers = 0
-    resources.maxFragmentAtomicCounterBuffers = 1
-    resources.maxCombinedAtomicCounterBuffers = 1
-    resources.maxAtomicCounterBufferSize = 16384
-    resources.maxTransformFeedbackBuffers = 4
-    resources.maxTransformFeedbackInterleavedComponents = 64
-    resources.maxCullDistances = 8
-    resources.maxCombinedClipAndCullDistances = 8
-    resources.maxSamples = 4
-    resources.limits.nonInductiveForLoops = True
-    resources.limits.whileLoops = True
-    resources.limits.doWhileLoops = True
-    resources.limits.generalUniformIndexing = True
-    resources.limits.generalAttributeMatrixVectorIndexing = True
-    resources.limits.generalVaryingIndexing = True
-    resources.limits.generalSamplerIndexing = True
-    resources.limits.generalVariableIndexing = True
-    resources.limits.generalConstantMatrixVectorIndexing = True
+    for name, value in RESOURCE_LIMITS.items():
+        setattr(resources, name, value)
+    for name, value in RESOURCE_BOOL_LIMITS.items():
+        setattr(resources.limits, name, value)
     return resources
 
-def glsl_to_spv(shader_stage, shader_code):
-    with pyglslangprocessing() :
-        program = pyglslang.TProgram()
-        Resources = init_resources()
-
-        # Enable SPIR-V and Vulkan rules when parsing GLSL
-        messages = pyglslang.EShMsgSpvRules | pyglslang.EShMsgVulkanRules
-        shader = pyglslang.TShader(shader_stage)    
-        if not shader.parse(shader_code, Resources, 100, False, messages):
-            print(shader.getInfoLog())
-            print(shader.getInfoDebugLog())
+# glslang is initialized once for the process and the resource limits are built once
+# the session is finalized when the interpreter exits
+# its single RLock serializes all the compiles, threads calling glsl_to_spv don't compile in parallel,
+# glsl_batch_compile.py is the parallel path, each of its worker processes has its own session
+class GlslangSession:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.resources = None
+        self.compile_count = 0
+
+    def initialize(self):
+        with self.lock:
+            if self.resources is None:
+                pyglslang.InitializeProcess()
+                self.resources = init_resources()
+                atexit.register(self.finalize)
+
+    def finalize(self):
+        with self.lock:
+            if self.resources is not None:
+                self.resources = None
+                pyglslang.FinalizeProcess()
+
+    # returns the SPIR-V or None and the info logs of the shader and program
+    def compile_with_log(self, shader_stage, shader_code):
+        with self.lock:
+            self.initialize()
+            self.compile_count += 1
+            program = pyglslang.TProgram()
+
+            # Enable SPIR-V and Vulkan rules when parsing GLSL
+            messages = pyglslang.EShMsgSpvRules | pyglslang.EShMsgVulkanRules
+            shader = pyglslang.TShader(shader_stage)
+            if not shader.parse(shader_code, self.resources, 100, False, messages):
+                return None, shader.getInfoLog() + shader.getInfoDebugLog()
+
+            program.addShader(shader)
+            if not program.link(messages):
+                return None, shader.getInfoLog() + shader.getInfoDebugLog() + program.getInfoLog() + program.getInfoDebugLog()
+
+            return program.getSpv(shader_stage), shader.getInfoLog()
+
+    def compile(self, shader_stage, shader_code):
+        spv, log = self.compile_with_log(shader_stage, shader_code)
+        if spv is None:
+            print(log)
             return False
+        return spv
+
+glslang_session = GlslangSession()
+
+# deprecated, a no-op wrapper around glslang_session kept for the scripts written before GlslangSession
+# it no longer calls FinalizeProcess on exit, glslang stays initialized until the interpreter exits
+@contextmanager
+def pyglslangprocessing():
+    glslang_session.initialize()
+    yield
 
-        program.addShader(shader)
-        if not program.link(messages):
-            print(shader.getInfoLog())
-            print(shader.getInfoDebugLog())
+def glsl_to_spv(shader_stage, shader_code):
+    return glslang_session.compile(shader_stage, shader_code)
+
+# the compiled SPIR-V depends on the compiler version and on the resource limits, they are part of the cache key
+def glslang_version():
+    return '%s;%s;%d' % (pyglslang.GetGlslVersionString(), pyglslang.GetEsslVersionString(), pyglslang.GetKhronosToolId())
+
+def resource_limits_digest():
+    return hashlib.sha256(repr(list(RESOURCE_LIMITS.items()) + list(RESOURCE_BOOL_LIMITS.items())).encode('utf-8')).hexdigest()
+
+# Content addressed SPIR-V cache, in memory LRU in front of an optional folder of .spv files
+# a hit returns a read-only uint32 numpy array without calling glslang
+class SpvCache:
+    def __init__(self, cache_dir = None, max_entries = 256):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.compiler_key = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, shader_stage, shader_code):
+        if self.compiler_key is None:
+            self.compiler_key = glslang_version() + ';' + resource_limits_digest()
+        h = hashlib.sha256()
+        h.update(self.compiler_key.encode('utf-8'))
+        h.update(str(int(shader_stage)).encode('utf-8'))
+        h.update(shader_code.encode('utf-8'))
+        return h.hexdigest()
+
+    def spv_path(self, key):
+        return os.path.join(self.cache_dir, key + '.spv')
+
+    def lookup(self, key):
+        with self.lock:
+            spv = self.entries.get(key)
+            if spv is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return spv
+
+        if self.cache_dir is None:
+            return None
+        try:
+            spv = np.fromfile(self.spv_path(key), dtype='<u4')
+        except (IOError, OSError):
+            return None
+        # a truncated or foreign file is treated as a miss and will be overwritten
+        if len(spv) < 5 or spv[0] != SPV_MAGIC_NUMBER:
+            return None
+        spv = spv.astype(np.uint32, copy=False)
+        self.insert(key, spv)
+        with self.lock:
+            self.disk_hits += 1
+        return spv
+
+    def insert(self, key, spv):
+        spv.flags.writeable = False
+        with self.lock:
+            self.entries[key] = spv
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def store(self, key, spv):
+        self.insert(key, spv)
+        if self.cache_dir is not None:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                atomic_write(self.spv_path(key), spv.astype('<u4').tobytes())
+            except (IOError, OSError) as e:
+                warnings.warn('Failed to write SPIR-V cache entry: ' + str(e))
+
+    def compile(self, shader_stage, shader_code):
+        key = self.key(shader_stage, shader_code)
+        spv = self.lookup(key)
+        if spv is not None:
+            return spv
+
+        spv = glsl_to_spv(shader_stage, shader_code)
+        if spv is False:
             return False
+        with self.lock:
+            self.misses += 1
+        spv = np.array(spv, dtype=np.uint32)
+        self.store(key, spv)
+        return spv
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# process wide cache, set VULKANMITTS_SPV_CACHE_DIR to also keep the SPIR-V on disk between runs
+default_spv_cache = SpvCache(os.environ.get('VULKANMITTS_SPV_CACHE_DIR'))
 
-        return program.getSpv(shader_stage)
\ No newline at end of file
+def cached_glsl_to_spv(shader_stage, shader_code, cache = None):
+    if cache is None:
+        cache = default_spv_cache
+    return cache.compile(shader_stage, shader_code)
@@ -5,47 +5,44 @@ import argparse
 import vulkanmitts as vk
 import numpy as np
 from cube_data import *
-from vkcontextmanager import vkreleasing, VkContextManager
+from vkcontextmanager import VkContextManager
+from mesh import index_mesh
 from transforms import *
 
-def render_textured_cube(vkc, cube_coords):
+# the frame is recorded once by the context, each frame only updates the uniform buffer and submits
+def render_rotating_cube(vkc, frame_count, degrees_per_frame = 5.0):
+    P = perspective(45.0, 1.0, 0.1, 100.0)
+    V = look_at( np.array([5, 3, 10]), np.array([0, 0, 0]), np.array([0, -1, 0]) )
+    images = []
+    for frame_no in range(frame_count):
+        M = np.eye(4)
+        yrotate(M, frame_no * degrees_per_frame)
+        vkc.uniform.array[...] = M.dot(V.dot(P))
+        vkc.uniform.flush()
+        images.append(vkc.render_recorded_frame().copy())
+    return images
+
+def record_textured_cube(vkc):
     vkc.init_presentable_image()
-    rp_begin = vkc.make_render_pass_begin_info()
     vk.resetCommandBuffer(vkc.command_buffers[0],0)
     vk.beginCommandBuffer(vkc.command_buffers[0],vk.CommandBufferBeginInfo(0,None))
-    vk.cmdBeginRenderPass(vkc.command_buffers[0], rp_begin, vk.VK_SUBPASS_CONTENTS_INLINE)
-    vk.cmdBindPipeline(vkc.command_buffers[0], vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vkc.pipeline[0])
-    vk.cmdBindDescriptorSets(vkc.command_buffers[0], vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vkc.pipeline_layout, 0, vkc.descriptor_set,  [])
-    vk.cmdBindVertexBuffers(vkc.command_buffers[0], 0, vk.VkBufferVector(1,vkc.vertex_buffer), vk.VkDeviceSizeVector(1,0))
-
-    vkc.init_viewports()
-    vkc.init_scissors()
-    vk.cmdDraw(vkc.command_buffers[0], cube_coords.shape[0], 1, 0, 0)
-    vk.cmdEndRenderPass(vkc.command_buffers[0])
+    vkc.record_render_pass(vkc.command_buffers[0])
     vkc.stage_readback_copy()
     vk.endCommandBuffer(vkc.command_buffers[0])
 
-    with vkreleasing( vk.createFence(vkc.device, vk.FenceCreateInfo(0)) ) as draw_fence:
-        submit_info_vec = vk.VkSubmitInfoVector()
-        submit_info_vec.append( vk.SubmitInfo( vk.VkSemaphoreVector(), vk.VkFlagVector(1,vk.VK_PIPELINE_STAGE_BOTTOM_OF_PIPE_BIT), vkc.command_buffers, vk.VkSemaphoreVector()) )
-        vk.queueSubmit(vkc.device_queue, submit_info_vec, draw_fence)
-        command_buffer_finished = False
-        cmd_fences = vk.VkFenceVector(1,draw_fence)
-        while not command_buffer_finished:
-            try:
-                vk.waitForFences(vkc.device, cmd_fences, True, 100000000)
-                command_buffer_finished = True
-            except RuntimeError:
-                pass
-
-    vkc.readback_map_copy()
-    vkc.save_readback_image('textured_cube.png')
+# returns vkc.readback_array, it holds the image until the next frame
+def render_textured_cube(vkc):
+    record_textured_cube(vkc)
+    vkc.submit_and_wait()
+    return vkc.readback_map_copy()
 
 def hello_pyvk(texture_file, output_img_file):
     cube_coords = get_xyzw_uv_cube_coords()
     print('Creating Vulkan Context')
-    with VkContextManager(VkContextManager.VKC_INIT_PIPELINE, VkContextManager.VKC_OFFSCREEN) as vkc:
-        render_textured_cube(vkc,cube_coords)
+    vertices, indices = index_mesh(cube_coords)
+    with VkContextManager(VkContextManager.VKC_INIT_PIPELINE, VkContextManager.VKC_OFFSCREEN, vertex_data = vertices, index_data = indices) as vkc:
+        render_textured_cube(vkc)
+        vkc.save_readback_image(output_img_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Renders a textured cube to an image file.')
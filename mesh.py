@@ -0,0 +1,140 @@
+# Indexed meshes: vertex deduplication and vertex cache optimization
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+import numpy as np
+
+# post transform cache size assumed by the optimization, 16 to 32 entries on current GPUs
+DEFAULT_CACHE_SIZE = 16
+
+# 0xFFFF is left out because it is the primitive restart index of uint16 index buffers
+def index_dtype(vertex_count):
+    if vertex_count < 0xFFFF:
+        return np.uint16
+    return np.uint32
+
+# vertices is an (n,k) array or a structured 1D array, each vertex is compared by its bytes
+# returns the unique vertices in order of first occurrence and the indices that rebuild the input
+def deduplicate_vertices(vertices):
+    vertices = np.ascontiguousarray(vertices)
+    vertex_bytes = vertices.dtype.itemsize * int(np.prod(vertices.shape[1:]))
+    rows = vertices.reshape(vertices.shape[0], -1).view(np.dtype((np.void, vertex_bytes))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    # np.unique sorts by bytes, renumber by first occurrence to keep the locality of the input
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+    indices = remap[inverse.ravel()].astype(index_dtype(len(order)))
+    return vertices[first[order]], indices
+
+# Tipsify from Sander, Nehab and Barczak, Fast Triangle Reordering for Vertex Locality and Reduced Overdraw, 2007
+# returns the indices of the triangle list in an order that reuses the post transform cache
+def optimize_vertex_cache(indices, vertex_count, cache_size = DEFAULT_CACHE_SIZE):
+    triangles = np.asarray(indices).reshape(-1,3)
+    flat = triangles.ravel()
+    # vertex to triangles adjacency
+    valence = np.bincount(flat, minlength=vertex_count)
+    offsets = np.zeros(vertex_count+1, dtype=np.int64)
+    np.cumsum(valence, out=offsets[1:])
+    adjacency = (np.argsort(flat, kind='stable') // 3).tolist()
+    offsets = offsets.tolist()
+    live = valence.tolist()
+    triangle_list = triangles.tolist()
+
+    cache_time = [0] * vertex_count
+    emitted = [False] * len(triangle_list)
+    output = []
+    dead_end = []
+    time = cache_size + 1
+    cursor = 1
+    fanning = 0 if vertex_count > 0 else -1
+    while fanning >= 0:
+        candidates = []
+        for t in adjacency[offsets[fanning]:offsets[fanning+1]]:
+            if emitted[t]:
+                continue
+            output.append(t)
+            for v in triangle_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+            emitted[t] = True
+
+        # next fanning vertex: the candidate still in the cache after its remaining triangles are emitted
+        fanning = -1
+        priority = -1
+        for v in candidates:
+            if live[v] > 0:
+                p = 0
+                if time - cache_time[v] + 2 * live[v] <= cache_size:
+                    p = time - cache_time[v]
+                if p > priority:
+                    fanning = v
+                    priority = p
+
+        if fanning == -1:
+            while len(dead_end) > 0:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+                    break
+        if fanning == -1:
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fanning = cursor
+                    break
+                cursor += 1
+
+    return triangles[output].ravel().astype(indices.dtype)
+
+# renumbers the vertices in order of first use by the indices so that the vertex fetches are sequential
+# the vertices not referenced by the indices are moved to the end
+def optimize_vertex_fetch(vertices, indices):
+    used, first = np.unique(indices, return_index=True)
+    order = used[np.argsort(first)]
+    if len(order) < len(vertices):
+        order = np.concatenate([order, np.setdiff1d(np.arange(len(vertices)), used)])
+    remap = np.empty(len(vertices), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return vertices[order], remap[indices].astype(indices.dtype)
+
+# expanded triangle list to (vertices, indices), optionally reordered for the vertex cache
+def index_mesh(vertices, optimize = False, cache_size = DEFAULT_CACHE_SIZE):
+    unique_vertices, indices = deduplicate_vertices(vertices)
+    if optimize:
+        indices = optimize_vertex_cache(indices, len(unique_vertices), cache_size)
+        unique_vertices, indices = optimize_vertex_fetch(unique_vertices, indices)
+    return unique_vertices, indices
+
+# average cache miss ratio, the number of vertices transformed per triangle with a FIFO cache
+# 3.0 is the worst case, 0.5 is the limit for large regular meshes
+def acmr(indices, cache_size = DEFAULT_CACHE_SIZE):
+    cache = []
+    misses = 0
+    for v in np.asarray(indices).tolist():
+        if v not in cache:
+            misses += 1
+            cache.append(v)
+            if len(cache) > cache_size:
+                cache.pop(0)
+    return float(misses) / (len(indices) // 3)
+
+# (n*n, 4, 4) model matrices of a grid of small objects in the XY plane, row vector convention like transforms.py
+def grid_transforms(n, spacing = 0.25, size = 0.1):
+    transforms = np.tile(np.eye(4, dtype=np.float32), (n*n,1,1))
+    transforms[:,0,0] = transforms[:,1,1] = transforms[:,2,2] = size
+    xs, ys = np.meshgrid(np.arange(n), np.arange(n))
+    transforms[:,3,0] = (xs.ravel() - (n - 1) / 2.0) * spacing
+    transforms[:,3,1] = (ys.ravel() - (n - 1) / 2.0) * spacing
+    return transforms
+
+# one (vertices, indices) mesh per transform, the XYZW columns of the vertices are pre-transformed
+def transformed_meshes(vertices, indices, transforms):
+    meshes = []
+    for transform in transforms:
+        transformed = vertices.copy()
+        transformed[:,:4] = vertices[:,:4].dot(transform)
+        meshes.append( (transformed, indices) )
+    return meshes
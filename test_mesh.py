@@ -0,0 +1,83 @@
+# mesh module unit test
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+import unittest
+import numpy as np
+from mesh import *
+from cube_data import get_xyzw_uv_cube_coords
+
+def grid_triangles(n):
+    triangles = []
+    for y in range(n):
+        for x in range(n):
+            a = y * (n + 1) + x
+            triangles.append((a, a + 1, a + n + 1))
+            triangles.append((a + 1, a + n + 2, a + n + 1))
+    return np.array(triangles)
+
+def sorted_triangles(vertices, indices):
+    # triangles as sorted rows of vertex bytes, independent of the vertex and triangle order
+    triangles = vertices[indices].reshape(len(indices) // 3, -1)
+    return triangles[np.lexsort(triangles.T[::-1])]
+
+class TestDeduplicate(unittest.TestCase):
+    def test_cube(self):
+        cube = get_xyzw_uv_cube_coords()
+        vertices, indices = deduplicate_vertices(cube)
+        self.assertTrue(len(vertices) < len(cube))
+        self.assertEqual(indices.dtype, np.uint16)
+        self.assertTrue(np.array_equal(vertices[indices], cube))
+        # first occurrence order
+        self.assertTrue(np.array_equal(vertices[0], cube[0]))
+
+    def test_structured_vertices(self):
+        vertex_dtype = np.dtype([('pos', np.float32, 3), ('color', np.uint8, 4)])
+        vertices = np.zeros(6, dtype=vertex_dtype)
+        vertices['pos'][3:] = 1.0
+        unique_vertices, indices = deduplicate_vertices(vertices)
+        self.assertEqual(len(unique_vertices), 2)
+        self.assertTrue(np.array_equal(indices, [0,0,0,1,1,1]))
+
+    def test_index_dtype(self):
+        self.assertEqual(index_dtype(0xFFFE), np.uint16)
+        self.assertEqual(index_dtype(0xFFFF), np.uint32)
+
+class TestVertexCache(unittest.TestCase):
+    def test_shuffled_grid(self):
+        n = 32
+        xs, ys = np.meshgrid(np.arange(n + 1), np.arange(n + 1))
+        positions = np.stack([xs.ravel(), ys.ravel(), np.zeros(xs.size)], 1).astype(np.float32)
+        triangles = grid_triangles(n)
+        np.random.RandomState(0).shuffle(triangles)
+        expanded = positions[triangles.ravel()]
+
+        vertices, indices = index_mesh(expanded)
+        self.assertEqual(len(vertices), len(positions))
+        self.assertTrue(expanded.nbytes > 2 * (vertices.nbytes + indices.nbytes))
+        optimized_vertices, optimized_indices = index_mesh(expanded, optimize = True)
+        self.assertTrue(acmr(optimized_indices) < 0.8)
+        self.assertTrue(acmr(optimized_indices) < acmr(indices) / 2)
+        self.assertTrue(np.array_equal(sorted_triangles(optimized_vertices, optimized_indices), sorted_triangles(vertices, indices)))
+
+    def test_vertex_fetch_order(self):
+        vertices = np.arange(8, dtype=np.float32).reshape(4,2)
+        indices = np.array([3,1,0,3,0,2], dtype=np.uint16)
+        reordered_vertices, reordered_indices = optimize_vertex_fetch(vertices, indices)
+        self.assertTrue(np.array_equal(reordered_indices, [0,1,2,0,2,3]))
+        self.assertTrue(np.array_equal(reordered_vertices[reordered_indices], vertices[indices]))
+
+class TestGrid(unittest.TestCase):
+    def test_transformed_meshes(self):
+        transforms = grid_transforms(3, spacing = 1.0, size = 0.5)
+        self.assertEqual(transforms.shape, (9,4,4))
+        self.assertTrue(np.array_equal(transforms[4,3], [0,0,0,1]))
+        vertices, indices = index_mesh(get_xyzw_uv_cube_coords())
+        meshes = transformed_meshes(vertices, indices, transforms)
+        self.assertEqual(len(meshes), 9)
+        self.assertIs(meshes[0][1], indices)
+        self.assertTrue(np.allclose(meshes[0][0][:,:2], vertices[:,:2] * 0.5 - 1.0))
+        self.assertTrue(np.array_equal(meshes[0][0][:,4:], vertices[:,4:]))
+
+if __name__ == '__main__':
+    # set defaultTest to invoke a specific test case
+    unittest.main()
@@ -1,6 +1,12 @@
+import os
+import json
+import shutil
+import tempfile
 import unittest
+import numpy as np
 import pyglslang
 from glsl_to_spv import *
+from glsl_batch_compile import inject_defines, load_manifest, compile_batch
 
 class TestInit(unittest.TestCase):
     def test_init_glslang(self):        
@@ -73,6 +79,87 @@ class TestGLSLToSPV(unittest.TestCase):
     def test_vertex_shader_to_spv(self):        
         spv = glsl_to_spv(pyglslang.EShLangFragment, self.fs_txt)
 
+class TestGlslangSession(unittest.TestCase):
+    def setUp(self):
+        with open('fragment_shader.glsl','r') as  fs_in:
+            self.fs_txt = fs_in.read()
+
+    def test_batch(self):
+        compile_count = glslang_session.compile_count
+        spvs = [glsl_to_spv(pyglslang.EShLangFragment, self.fs_txt) for i in range(200)]
+        self.assertTrue(all(spv == spvs[0] for spv in spvs))
+        self.assertEqual(glslang_session.compile_count - compile_count, 200)
+
+    def test_compile_with_log(self):
+        spv, log = glslang_session.compile_with_log(pyglslang.EShLangFragment, self.fs_txt.replace('main', 'mian'))
+        self.assertIsNone(spv)
+        self.assertTrue(len(log) > 0)
+
+class TestSpvCache(unittest.TestCase):
+    def setUp(self):
+        with open('vertex_shader.glsl','r') as  vs_in:
+            self.vs_txt = vs_in.read()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_memory_hit(self):
+        cache = SpvCache()
+        spv = cache.compile(pyglslang.EShLangVertex, self.vs_txt)
+        self.assertEqual(spv.dtype, np.uint32)
+        self.assertTrue(np.array_equal(spv, glsl_to_spv(pyglslang.EShLangVertex, self.vs_txt)))
+        self.assertIs(cache.compile(pyglslang.EShLangVertex, self.vs_txt), spv)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_disk_hit(self):
+        spv = SpvCache(self.cache_dir).compile(pyglslang.EShLangVertex, self.vs_txt)
+        cache = SpvCache(self.cache_dir)
+        self.assertTrue(np.array_equal(cache.compile(pyglslang.EShLangVertex, self.vs_txt), spv))
+        self.assertEqual((cache.disk_hits, cache.misses), (1, 0))
+
+    def test_write_failure(self):
+        # a file where the cache folder should be, the entry stays in memory
+        not_a_dir = os.path.join(self.cache_dir, 'file')
+        open(not_a_dir, 'w').close()
+        cache = SpvCache(not_a_dir)
+        with self.assertWarns(UserWarning):
+            spv = cache.compile(pyglslang.EShLangVertex, self.vs_txt)
+        self.assertIs(cache.compile(pyglslang.EShLangVertex, self.vs_txt), spv)
+
+    def test_key(self):
+        cache = SpvCache()
+        self.assertNotEqual(cache.key(pyglslang.EShLangVertex, self.vs_txt), cache.key(pyglslang.EShLangFragment, self.vs_txt))
+        self.assertNotEqual(cache.key(pyglslang.EShLangVertex, self.vs_txt), cache.key(pyglslang.EShLangVertex, self.vs_txt + '\n'))
+
+class TestBatchCompile(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_inject_defines(self):
+        code = inject_defines('#version 400\nvoid main() {}\n', {'FOO' : 1})
+        self.assertEqual(code, '#version 400\n#define FOO 1\nvoid main() {}\n')
+
+    def test_compile_batch(self):
+        manifest = [ { 'stage' : 'vert', 'source' : 'vertex_shader.glsl' },
+                     { 'stage' : 'frag', 'source' : 'fragment_shader.glsl' },
+                     { 'stage' : 'frag', 'source' : 'fragment_shader.glsl', 'defines' : { 'UNUSED' : 1 } } ]
+        manifest_path = os.path.join(self.output_dir, 'manifest.json')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        shutil.copy('vertex_shader.glsl', self.output_dir)
+        shutil.copy('fragment_shader.glsl', self.output_dir)
+
+        results = list(compile_batch(load_manifest(manifest_path), self.output_dir, 2))
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertTrue(result.success)
+            spv = np.fromfile(result.output_path, dtype='<u4')
+            self.assertEqual(spv[0], 0x07230203)
+
 class TestDisassembler(unittest.TestCase):
     def setUp(self):
         with open('vertex_shader.glsl','r') as  vs_in:
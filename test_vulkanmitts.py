@@ -136,7 +136,7 @@ class TestRenderCube(unittest.TestCase):
         cube_coords = get_xyzw_uv_cube_coords()
         with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_WIN32) as vkc:
             self.assertIsNotNone(vkc)
-            render_textured_cube(vkc,cube_coords,[1])
+            render_textured_cube(vkc, [None], [1])
 
 if __name__ == '__main__':
     app = QApplication(sys.argv) # the QApplication must be at this scope to avoid a crash in QT when some test case fails
@@ -1,10 +1,16 @@
 # vulkanmitts unit test
 # Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
 # This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+import os
 import sys
+import shutil
+import tempfile
 import unittest
+import numpy as np
 import vulkanmitts as vk
-from vkcontextmanager import VkContextManager, memory_type_from_properties
+from vkcontextmanager import VkContextManager, memory_type_from_properties, pipeline_cache_data_is_compatible
+from vkstaging import StagingRing
+from vkmemory import is_out_of_memory_error
 from contextlib import contextmanager
 from cube_data import *
 
@@ -80,7 +86,7 @@ class PhysicalDeviceTestCase(unittest.TestCase):
         self.assertTrue(phydev_props.vendorID != 0)
         self.assertTrue(phydev_props.deviceID != 0)
         self.assertTrue(len(phydev_props.deviceName) > 0)
-        self.assertIsNotNone(phydev_props.pipelineCacheUUID) # still opaque in python
+        self.assertEqual(len(phydev_props.pipelineCacheUUID), vk.VK_UUID_SIZE)
         self.assertIsNotNone(phydev_props.limits) # still opaque in python
         self.assertIsNotNone(phydev_props.sparseProperties) # still opaque in python
 
@@ -153,6 +159,24 @@ class TestCommandBuffers(unittest.TestCase):
                     vk.beginCommandBuffer(command_buffers[0], vk.CommandBufferBeginInfo(0,None))
                     vk.endCommandBuffer(command_buffers[0])
 
+    def test_wait_for_fences_status(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            with vkreleasing(vk.createFence(vkc.device, vk.FenceCreateInfo(0))) as fence:
+                # an unsignaled fence times out without raising
+                self.assertEqual(vk.waitForFencesStatus(vkc.device, vk.VkFenceVector(1,fence), True, 0), vk.VK_TIMEOUT)
+            with vkreleasing(vk.createFence(vkc.device, vk.FenceCreateInfo(vk.VK_FENCE_CREATE_SIGNALED_BIT))) as fence:
+                self.assertEqual(vk.waitForFencesStatus(vkc.device, vk.VkFenceVector(1,fence), True), vk.VK_SUCCESS)
+
+    def test_submit_and_wait(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            vk.endCommandBuffer(vkc.command_buffers[0])
+            vkc.submit_and_wait()
+            # the fence is reset and can be reused for the next submission
+            vk.resetCommandBuffer(vkc.command_buffers[0],0)
+            vk.beginCommandBuffer(vkc.command_buffers[0], vk.CommandBufferBeginInfo(0,None))
+            vk.endCommandBuffer(vkc.command_buffers[0])
+            vkc.submit_and_wait()
+
 class TestDepthStencil(unittest.TestCase):
     def test_setup_depth_stencil(self):
         with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
@@ -195,13 +219,540 @@ class TestDepthStencil(unittest.TestCase):
                                           vk.VkBufferMemoryBarrierVector(),
                                           vk.VkImageMemoryBarrierVector(1,image_memory_barrier))
 
+class TestMemoryAllocator(unittest.TestCase):
+    def test_sub_allocation_and_coalescing(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            buffers = []
+            allocations = []
+            for i in range(16):
+                buffer = vk.createBuffer(vkc.device, vk.BufferCreateInfo(0, 4096, vk.VK_BUFFER_USAGE_UNIFORM_BUFFER_BIT, vk.VK_SHARING_MODE_EXCLUSIVE, []))
+                buffers.append(buffer)
+                allocations.append(vkc.allocator.allocate_for_buffer(buffer, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT))
+
+            # all the buffers share the same VkDeviceMemory
+            block = allocations[0].block
+            self.assertTrue(all(a.block is block for a in allocations))
+            self.assertEqual(block.stats()['allocations'], 16)
+
+            # freeing every other range then the rest must leave a single free range
+            for a in allocations[::2] + allocations[1::2]:
+                a.free()
+            self.assertEqual(block.stats()['allocations'], 0)
+            self.assertEqual(block.free_ranges, [(0, block.size)])
+            for b in buffers:
+                del b.this
+
+    def test_map_memory_typed_whole_size(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            memory_type_index = vkc.memory_types.find(0xFFFFFFFF, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT|vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT)
+            memory = vk.allocateMemory(vkc.device, vk.MemoryAllocateInfo(4096, memory_type_index))
+            self.assertEqual(vk.getMemorySize(memory), 4096)
+
+            flat = vk.mapMemory(vkc.device, memory, 0, vk.VK_WHOLE_SIZE, 0)
+            self.assertEqual(flat.dtype, np.uint8)
+            self.assertEqual(flat.shape, (4096,))
+            del flat
+
+            vertex_dtype = np.dtype([('pos', np.float32, 4), ('uv', np.float32, 2)])
+            vertices = vk.mapMemory(vkc.device, memory, 1024, vk.VK_WHOLE_SIZE, 0, vertex_dtype)
+            self.assertEqual(vertices.dtype, vertex_dtype)
+            self.assertEqual(vertices.shape, (3072 // vertex_dtype.itemsize,))
+            vertices['uv'] = 0.5
+            del vertices
+
+            matrices = vk.mapMemory(vkc.device, memory, 1024, 128, 0, np.float32, (2,4,4))
+            self.assertEqual(matrices.shape, (2,4,4))
+            self.assertTrue(np.all(matrices.flat[4:6] == 0.5))
+            del matrices
+
+            with self.assertRaises(IndexError):
+                vk.mapMemory(vkc.device, memory, 0, 64, 0, np.float32, (32,))
+
+            # the array keeps the memory alive after its wrapper is deleted, it is freed with the last view
+            kept = vk.mapMemory(vkc.device, memory, 0, 64, 0, np.float32, (16,))
+            view = kept[4:8]
+            del memory.this
+            del kept
+            view[...] = 1.0
+            self.assertTrue(np.all(view == 1.0))
+            del view
+
+    def test_out_of_memory_error(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            memory_type_index = vkc.memory_types.find(0xFFFFFFFF, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
+            heap_size = vkc.memory_types.heap_sizes[vkc.memory_types.heap_indices[memory_type_index]]
+            # the VkResult is on the exception, still a RuntimeError for the callers written before VkError
+            with self.assertRaises(RuntimeError) as cm:
+                vk.allocateMemory(vkc.device, vk.MemoryAllocateInfo(2 * heap_size, memory_type_index))
+            self.assertIsInstance(cm.exception, vk.VkError)
+            self.assertEqual(cm.exception.result, vk.VK_ERROR_OUT_OF_DEVICE_MEMORY)
+            self.assertTrue(is_out_of_memory_error(cm.exception))
+            self.assertFalse(is_out_of_memory_error(RuntimeError('VK_ERROR_OUT_OF_DEVICE_MEMORY')))
+
+    def test_out_of_memory_fallback(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            allocator = vkc.allocator
+            all_types = (1 << vkc.memory_properties.memoryTypeCount) - 1
+            ranking = vkc.memory_types.ranked(all_types, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
+            if len(ranking) < 2:
+                self.skipTest('a single host visible memory type')
+            buffer = vk.createBuffer(vkc.device, vk.BufferCreateInfo(0, 4096, vk.VK_BUFFER_USAGE_UNIFORM_BUFFER_BIT, vk.VK_SHARING_MODE_EXCLUSIVE, []))
+            mem_reqs = vk.getBufferMemoryRequirements(vkc.device, buffer)
+            # the best memory type is exhausted, the allocation lands in the next one
+            allocate_from_type = allocator.allocate_from_type
+            def exhausted_first_type(mem_reqs, memory_type_index, kind):
+                if memory_type_index == ranking[0]:
+                    vk.allocateMemory(vkc.device, vk.MemoryAllocateInfo(2 * vkc.memory_types.heap_sizes[vkc.memory_types.heap_indices[ranking[0]]], ranking[0]))
+                return allocate_from_type(mem_reqs, memory_type_index, kind)
+            allocator.allocate_from_type = exhausted_first_type
+            try:
+                allocation = allocator.allocate(mem_reqs, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
+            finally:
+                del allocator.allocate_from_type
+            self.assertEqual(allocation.block.memory_type_index, ranking[1])
+            allocation.free()
+            del buffer.this
+
+    def test_context_uses_few_blocks(self):
+        with VkContextManager(surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            stats = vkc.allocator.stats()
+            self.assertTrue(len(stats) < 7) # one allocation per resource before sub-allocation
+            self.assertTrue(sum(s['allocations'] for s in stats) >= 7)
+
+    def test_memory_type_table(self):
+        with VkContextManager(VkContextManager.VKC_INIT_PIPELINE) as vkc:
+            all_types = (1 << vkc.memory_properties.memoryTypeCount) - 1
+            for properties in [vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT]:
+                # the first acceptable type in the table must agree with the Lunar SDK function
+                legacy_index = memory_type_from_properties(vkc.physical_devices[0], all_types, properties)
+                ranking = vkc.memory_types.ranked(all_types, properties)
+                self.assertTrue(legacy_index in ranking)
+                for i in ranking:
+                    self.assertEqual(vkc.memory_types.property_flags[i] & properties, properties)
+                # memoized
+                self.assertIs(vkc.memory_types.ranked(all_types, properties), ranking)
+            self.assertIsNone(vkc.memory_types.find(0, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT))
+            # host visible requests stay out of the BAR heap unless DEVICE_LOCAL is preferred
+            flags = vkc.memory_types.property_flags
+            host_visible = vkc.memory_types.ranked(all_types, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
+            if any(flags[i] & vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT == 0 for i in host_visible):
+                self.assertEqual(flags[host_visible[0]] & vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT, 0)
+            bar = vkc.memory_types.find(all_types, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
+            if any(flags[i] & vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT for i in host_visible):
+                self.assertTrue(flags[bar] & vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
+
+    def test_mapped_buffer(self):
+        with VkContextManager(VkContextManager.VKC_INIT_PIPELINE) as vkc:
+            # the uniform buffer view is a live window on the GPU memory
+            self.assertEqual(vkc.uniform.array.shape, (4,4))
+            identity = np.identity(4, dtype=np.single)
+            vkc.uniform.array[...] = identity
+            vkc.uniform.flush()
+            self.assertTrue(np.array_equal(np.frombuffer(vkc.uniform.allocation.mapped(), dtype=np.single, count=16).reshape(4,4), identity))
+            # non coherent ranges are rounded to nonCoherentAtomSize
+            atom = vkc.allocator.non_coherent_atom_size
+            ranges = vkc.uniform.mapped_range(4, 8)
+            self.assertEqual(ranges[0].offset % atom, 0)
+            self.assertTrue(ranges[0].offset + ranges[0].size >= vkc.uniform.allocation.offset + 12)
+            vkc.uniform.invalidate(4, 8)
+
+class TestVertexLayout(unittest.TestCase):
+    def test_layouts(self):
+        from vertex_layout import XYZW_UV_FLOAT, XYZW_UV_COMPACT, XYZW_UV_NORMAL_COMPACT
+        self.assertEqual(XYZW_UV_FLOAT.stride, 24)
+        self.assertEqual(XYZW_UV_FLOAT.offsets, [0, 16])
+        self.assertEqual(XYZW_UV_COMPACT.stride, 12)
+        self.assertEqual(XYZW_UV_NORMAL_COMPACT.stride, 16)
+        self.assertEqual(len(XYZW_UV_NORMAL_COMPACT.attribute_descriptions()), 3)
+
+    def test_pack_unpack(self):
+        from vertex_layout import XYZW_UV_NORMAL_COMPACT
+        rand = np.random.RandomState(0)
+        positions = rand.uniform(-10, 10, (100,3))
+        uvs = rand.uniform(0, 1, (100,2))
+        normals = rand.normal(size=(100,3))
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+        vertices = XYZW_UV_NORMAL_COMPACT.pack(pos = positions, uv = uvs, normal = normals)
+        self.assertEqual(vertices.nbytes, 100 * 16)
+        # xyz positions get w = 1
+        self.assertTrue(np.all(XYZW_UV_NORMAL_COMPACT.unpack(vertices, 'pos')[:,3] == 1.0))
+        self.assertTrue(np.allclose(XYZW_UV_NORMAL_COMPACT.unpack(vertices, 'pos')[:,:3], positions, rtol=1e-3, atol=1e-2))
+        self.assertTrue(np.allclose(XYZW_UV_NORMAL_COMPACT.unpack(vertices, 'uv'), uvs, atol=1.0/65535))
+        self.assertTrue(np.allclose(XYZW_UV_NORMAL_COMPACT.unpack(vertices, 'normal'), normals, atol=1e-3))
+
+class TestStagingRing(unittest.TestCase):
+    def test_uploads_recycle_the_ring(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            with StagingRing(vkc, size = 4096, depth = 2) as staging:
+                targets = []
+                for i in range(10):
+                    target = vkc.create_mapped_buffer(vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT, np.uint32, 256)
+                    staging.upload_buffer(target.buffer, np.arange(256, dtype=np.uint32) + i)
+                    targets.append(target)
+                    if i % 3 == 2:
+                        staging.flush()
+                staging.finish()
+                self.assertEqual(staging.upload_count, 10)
+                self.assertEqual(len(staging.in_flight), 0)
+                for i, target in enumerate(targets):
+                    target.invalidate()
+                    self.assertTrue(np.array_equal(target.array, np.arange(256, dtype=np.uint32) + i))
+
+                # larger than the ring, uploaded in chunks
+                large = vkc.create_mapped_buffer(vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT, np.uint32, 4096)
+                staging.upload_buffer(large.buffer, np.arange(4096, dtype=np.uint32))
+                staging.finish()
+                large.invalidate()
+                self.assertTrue(np.array_equal(large.array, np.arange(4096, dtype=np.uint32)))
+
+                # images are not split, the size is checked before the image is used
+                with self.assertRaises(ValueError):
+                    staging.upload_image(None, np.zeros(2048, dtype=np.uint32), 64, 32)
+
+    def test_upload_meshes(self):
+        with VkContextManager(VkContextManager.VKC_INIT_COMMAND_BUFFER) as vkc:
+            cube = get_xyzw_uv_cube_coords()
+            quad = cube[:6].copy()
+            quad_indices = np.array([0,1,2,2,1,3], dtype=np.uint16)
+            mesh_buffers = vkc.upload_meshes([(cube, None), (quad, quad_indices), (cube, np.arange(36, dtype=np.uint32))])
+            self.assertEqual(mesh_buffers.device_local, not vkc.memory_types.is_unified())
+            self.assertIsNotNone(mesh_buffers.index_buffer)
+            self.assertEqual([r.vertex_count for r in mesh_buffers.ranges], [36, 6, 36])
+            self.assertEqual(mesh_buffers.ranges[0].index_type, None)
+            self.assertEqual(mesh_buffers.ranges[1].index_type, vk.VK_INDEX_TYPE_UINT16)
+            self.assertEqual(mesh_buffers.ranges[2].index_type, vk.VK_INDEX_TYPE_UINT32)
+            self.assertEqual(mesh_buffers.ranges[2].index_offset % 4, 0)
+            self.assertTrue(all(r.vertex_offset % r.vertex_stride == 0 for r in mesh_buffers.ranges))
+
+    def test_replace_vertex_buffer(self):
+        with VkContextManager(VkContextManager.VKC_INIT_VERTEX_BUFFER) as vkc:
+            used = sum(s['used'] for s in vkc.allocator.stats())
+            vertex_buffer = vkc.vertex_buffer
+            for i in range(3):
+                vkc.init_vertex_buffer(vkc.vertex_data, vkc.index_data)
+            # the buffers of the replaced meshes are released right away, not when the context exits
+            self.assertIsNot(vkc.vertex_buffer, vertex_buffer)
+            self.assertFalse(hasattr(vertex_buffer, 'this'))
+            self.assertEqual(sum(s['used'] for s in vkc.allocator.stats()), used)
+
+    def test_draw_indexed_indirect_commands(self):
+        from vkcontextmanager import MeshRange, draw_indexed_indirect_commands, DRAW_INDEXED_INDIRECT_COMMAND
+        self.assertEqual(DRAW_INDEXED_INDIRECT_COMMAND.itemsize, 20)
+        ranges = [MeshRange(0, 20, 24, 0, 36, vk.VK_INDEX_TYPE_UINT16), MeshRange(480, 20, 24, 72, 36, vk.VK_INDEX_TYPE_UINT16)]
+        commands = draw_indexed_indirect_commands(ranges, instance_count = 2)
+        self.assertEqual(list(commands['firstIndex']), [0, 36])
+        self.assertEqual(list(commands['vertexOffset']), [0, 20])
+        self.assertEqual(list(commands['instanceCount']), [2, 2])
+        with self.assertRaises(ValueError):
+            draw_indexed_indirect_commands(ranges + [MeshRange(960, 20, 24, 144, 36, vk.VK_INDEX_TYPE_UINT32)])
+        with self.assertRaises(ValueError):
+            draw_indexed_indirect_commands(ranges + [MeshRange(960, 20, 24, 0, 0, None)])
+        with self.assertRaises(ValueError):
+            draw_indexed_indirect_commands(ranges + [MeshRange(960, 20, 32, 144, 36, vk.VK_INDEX_TYPE_UINT16)])
+
+    def test_texture_is_device_local(self):
+        with VkContextManager(VkContextManager.VKC_INIT_TEXTURE) as vkc:
+            flags = vkc.memory_types.property_flags[vkc.tex_alloc.block.memory_type_index]
+            self.assertTrue(flags & vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
+            self.assertTrue(vkc.staging.upload_count >= 1)
+
+class TestPipelineCache(unittest.TestCase):
+    def test_persistent_pipeline_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with VkContextManager(pipeline_cache_dir = cache_dir) as vkc:
+                self.assertEqual(len(vkc.pipeline_cache_initial_data), 0)
+                cache_path = vkc.pipeline_cache_path()
+            self.assertTrue(os.path.exists(cache_path))
+
+            with VkContextManager(pipeline_cache_dir = cache_dir) as vkc:
+                self.assertTrue(pipeline_cache_data_is_compatible(vkc.pipeline_cache_initial_data, vkc.gpu_props))
+
+            # a corrupted file is ignored with a warning
+            with open(cache_path, 'wb') as cache_file:
+                cache_file.write(b'not a pipeline cache')
+            with self.assertWarns(UserWarning):
+                with VkContextManager(pipeline_cache_dir = cache_dir) as vkc:
+                    self.assertEqual(len(vkc.pipeline_cache_initial_data), 0)
+        finally:
+            shutil.rmtree(cache_dir)
+
 class TestRenderCube(unittest.TestCase):
+    # the textured cube rendered by a default offscreen context, the render the tests compare with
+    @classmethod
+    def setUpClass(cls):
+        from hello_vulkanmittsoffscreen import render_textured_cube
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            cls.reference = render_textured_cube(vkc).copy()
+
     def test_render_colored_cube(self):
         from hello_vulkanmittsoffscreen import render_textured_cube
         cube_coords = get_xyzw_uv_cube_coords()
         with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
             self.assertIsNotNone(vkc)
-            render_textured_cube(vkc,cube_coords)
+            render_textured_cube(vkc)
+
+    def test_readback_color_and_depth(self):
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            vkc.init_presentable_image()
+            vk.resetCommandBuffer(vkc.command_buffers[0],0)
+            vk.beginCommandBuffer(vkc.command_buffers[0],vk.CommandBufferBeginInfo(0,None))
+            vkc.record_render_pass(vkc.command_buffers[0])
+            vkc.stage_readback_copy(depth_buffer = vkc.depth_readback_buffer)
+            vk.endCommandBuffer(vkc.command_buffers[0])
+            vkc.submit_and_wait()
+
+            self.assertEqual(vkc.readback_array.shape, (512,512,4))
+            self.assertTrue(vkc.readback_array.flags['C_CONTIGUOUS'])
+            depth = vkc.depth_readback_array
+            self.assertEqual(depth.shape, (512,512))
+            # cleared to 1.0 around the cube, closer in the middle of the image
+            self.assertEqual(depth[0,0], np.iinfo(depth.dtype).max)
+            self.assertTrue(depth[256,256] < depth[0,0])
+
+    def test_render_indexed_cube(self):
+        from hello_vulkanmittsoffscreen import render_textured_cube
+        from mesh import index_mesh
+        cube_coords = get_xyzw_uv_cube_coords()
+        vertices, indices = index_mesh(cube_coords, optimize = True)
+        with VkContextManager(vertex_data = vertices, index_data = indices, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            self.assertEqual(vkc.mesh_range.index_count, 36)
+            render_textured_cube(vkc)
+            self.assertTrue(np.array_equal(vkc.readback_array, self.reference))
+
+    def test_render_compact_vertices(self):
+        from hello_vulkanmittsoffscreen import render_textured_cube
+        from vertex_layout import XYZW_UV_COMPACT
+        cube_coords = get_xyzw_uv_cube_coords()
+        # the cube coordinates are exact in half float and 16 bits unorm
+        compact = XYZW_UV_COMPACT.pack(pos = cube_coords[:,:4], uv = cube_coords[:,4:])
+        with VkContextManager(vertex_data = compact, vertex_layout = XYZW_UV_COMPACT, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            self.assertEqual(XYZW_UV_COMPACT.unsupported_formats(vkc.physical_devices[0]), [])
+            render_textured_cube(vkc)
+            self.assertTrue(np.array_equal(vkc.readback_array, self.reference))
+
+    def test_render_instanced_cubes(self):
+        from mesh import grid_transforms
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            # one identity instance must match the non instanced pipeline
+            img = vkc.render_instanced(np.eye(4, dtype=np.float32).reshape(1,4,4))
+            self.assertTrue(np.array_equal(img, self.reference))
+            # 10000 cubes in one draw, the instance buffer is released after the frame
+            used = sum(s['used'] for s in vkc.allocator.stats())
+            transforms = grid_transforms(100, spacing = 0.04, size = 0.015)
+            img = vkc.render_instanced(transforms)
+            self.assertFalse(np.array_equal(img, self.reference))
+            self.assertEqual(sum(s['used'] for s in vkc.allocator.stats()), used)
+
+    def test_render_indirect_meshes(self):
+        from mesh import index_mesh, grid_transforms, transformed_meshes
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            vertices, indices = index_mesh(cube_coords)
+            img = vkc.render_indirect([(vertices, indices)])
+            self.assertTrue(np.array_equal(img, self.reference))
+            used = sum(s['used'] for s in vkc.allocator.stats())
+            img = vkc.render_indirect(transformed_meshes(vertices, indices, grid_transforms(20, spacing = 0.2, size = 0.07)))
+            self.assertFalse(np.array_equal(img, self.reference))
+            self.assertEqual(sum(s['used'] for s in vkc.allocator.stats()), used)
+
+    def test_render_multiple_views(self):
+        from vkmultiview import MultiViewRenderer, orbit_view_projections
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            with MultiViewRenderer(vkc, 8) as renderer:
+                # the MVP of the uniform buffer as a push constant must match the reference render
+                views = renderer.render(vkc.uniform.array.reshape(1,4,4))
+                self.assertEqual(views.shape, (1,512,512,4))
+                self.assertTrue(np.array_equal(views[0], self.reference))
+                views = renderer.render(orbit_view_projections(8))
+                self.assertEqual(views.shape, (8,512,512,4))
+                self.assertFalse(np.array_equal(views[0], views[2]))
+
+    def test_output_size_and_formats(self):
+        from hello_vulkanmittsoffscreen import render_textured_cube
+        cube_coords = get_xyzw_uv_cube_coords()
+        reference = self.reference.astype(np.float32) / 255.0
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN, output_size = (320,200)) as vkc:
+            render_textured_cube(vkc)
+            self.assertEqual(vkc.readback_array.shape, (200,320,4))
+            self.assertEqual(vkc.depth_readback_array.shape, (200,320))
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN, color_format = vk.VK_FORMAT_R16G16B16A16_SFLOAT) as vkc:
+            render_textured_cube(vkc)
+            self.assertEqual(vkc.readback_array.dtype, np.float16)
+            self.assertTrue(np.allclose(vkc.readback_array, reference, atol = 1.0 / 255.0))
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN, color_format = vk.VK_FORMAT_R32_SFLOAT) as vkc:
+            render_textured_cube(vkc)
+            self.assertEqual(vkc.readback_array.dtype, np.float32)
+            self.assertEqual(vkc.readback_array.shape, (512,512))
+            self.assertTrue(np.allclose(vkc.readback_array, reference[:,:,0], atol = 1.0 / 255.0))
+
+    def test_multisampling(self):
+        from hello_vulkanmittsoffscreen import render_textured_cube
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN, sample_count = vk.VK_SAMPLE_COUNT_4_BIT) as vkc:
+            self.assertIsNone(vkc.depth_readback_array)
+            render_textured_cube(vkc)
+            # the background and the inside of the faces are the same, the edges are antialiased
+            self.assertTrue(np.array_equal(vkc.readback_array[0,0], self.reference[0,0]))
+            self.assertFalse(np.array_equal(vkc.readback_array, self.reference))
+
+    def test_resize(self):
+        from hello_vulkanmittsoffscreen import render_textured_cube
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            pipeline = vkc.pipeline
+            vkc.resize(256,128)
+            render_textured_cube(vkc)
+            self.assertEqual(vkc.readback_array.shape, (128,256,4))
+            self.assertEqual(vkc.depth_readback_array.shape, (128,256))
+            self.assertIs(vkc.pipeline, pipeline)
+            vkc.resize(512,512)
+            render_textured_cube(vkc)
+            self.assertTrue(np.array_equal(vkc.readback_array, self.reference))
+
+    def test_recorded_frame(self):
+        from hello_vulkanmittsoffscreen import render_rotating_cube
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            images = render_rotating_cube(vkc, 4)
+            self.assertTrue(np.array_equal(images[0], self.reference))
+            self.assertFalse(np.array_equal(images[1], self.reference))
+            self.assertEqual(len(vkc.recorded_frames), 1)
+            command_buffer = vkc.recorded_frame_command_buffers[0]
+            # a full turn brings back the first frame without recording again
+            images = render_rotating_cube(vkc, 2, 360.0)
+            self.assertTrue(np.array_equal(images[1], self.reference))
+            self.assertIs(vkc.recorded_frame_command_buffers[0], command_buffer)
+            vkc.resize(256,256)
+            self.assertEqual(len(vkc.recorded_frames), 0)
+            images = render_rotating_cube(vkc, 1)
+            self.assertEqual(images[0].shape, (256,256,4))
+
+    def test_parallel_recording(self):
+        from mesh import grid_transforms
+        from vkrecording import ParallelRecorder
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            mvps = vkc.model_view_projections(grid_transforms(40, spacing = 0.1, size = 0.04))
+            with ParallelRecorder(vkc, 1) as recorder:
+                img = recorder.render_push_constant_draws(vkc.uniform.array.reshape(1,4,4))
+                self.assertTrue(np.array_equal(img, self.reference))
+                single_thread = recorder.render_push_constant_draws(mvps).copy()
+            inline = vkc.render_offscreen_frame(lambda command_buffer: vkc.record_push_constant_render_pass(command_buffer, mvps))
+            self.assertTrue(np.array_equal(inline, single_thread))
+            with ParallelRecorder(vkc, 4) as recorder:
+                for i in range(2):
+                    img = recorder.render_push_constant_draws(mvps)
+                    self.assertTrue(np.array_equal(img, single_thread))
+                # the pools are reset every frame, one secondary command buffer per task is in use
+                self.assertEqual(sum(pool.used for pool in recorder.pools), 16)
+
+    def test_command_stream(self):
+        from mesh import grid_transforms
+        from vkcommandstream import CommandStream, COMMAND_STREAM_RECORD, push_constant_draw_stream, render_stream
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            img = render_stream(vkc, push_constant_draw_stream(vkc, vkc.uniform.array.reshape(1,4,4)))
+            self.assertTrue(np.array_equal(img, self.reference))
+
+            mvps = vkc.model_view_projections(grid_transforms(40, spacing = 0.1, size = 0.04))
+            expected = vkc.render_offscreen_frame(lambda command_buffer: vkc.record_push_constant_render_pass(command_buffer, mvps)).copy()
+            stream = push_constant_draw_stream(vkc, mvps)
+            self.assertEqual(len(stream), 2 + 2 * len(mvps))
+            self.assertEqual(stream.finish()[0].itemsize, 32)
+            img = render_stream(vkc, stream)
+            self.assertTrue(np.array_equal(img, expected))
+
+            # the stream is validated by the replay, the records before the faulty one are recorded
+            bad_stream = CommandStream()
+            bad_stream.extend(np.array([(vk.COMMAND_STREAM_BIND_VERTEX_BUFFER, (0,3,0,0,0,0,0))], dtype=COMMAND_STREAM_RECORD))
+            vk.resetCommandBuffer(vkc.command_buffers[0],0)
+            vk.beginCommandBuffer(vkc.command_buffers[0],vk.CommandBufferBeginInfo(0,None))
+            with self.assertRaises(RuntimeError):
+                bad_stream.record(vkc.command_buffers[0])
+            vk.endCommandBuffer(vkc.command_buffers[0])
+
+    def test_frames_in_flight(self):
+        from vkmultiview import orbit_view_projections
+        from vkframes import FrameScheduler
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            mvps = np.concatenate([orbit_view_projections(6), vkc.uniform.array.reshape(1,4,4)])
+            # single-shot render of each MVP through the uniform buffer
+            references = []
+            for mvp in mvps:
+                vkc.uniform.array[...] = mvp
+                vkc.uniform.flush()
+                references.append(vkc.render_offscreen_frame().copy())
+            self.assertTrue(np.array_equal(references[-1], self.reference))
+            for frames_in_flight in [1,2,3]:
+                with FrameScheduler(vkc, frames_in_flight) as scheduler:
+                    images = scheduler.render_push_constant_frames(mvps)
+                    self.assertEqual(scheduler.frame_count, 7)
+                    self.assertEqual(len(images), 7)
+                    for img, expected in zip(images, references):
+                        self.assertTrue(np.array_equal(img, expected))
+
+    def test_work_graph(self):
+        from vkworkgraph import render_work_graph
+        from vkmultiview import orbit_view_projections
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            if not vkc.timeline_semaphores:
+                self.skipTest('Vulkan 1.2 timeline semaphores not supported')
+            mvps = np.concatenate([orbit_view_projections(4), vkc.uniform.array.reshape(1,4,4)])
+            completed_value, img = render_work_graph(vkc, cube_coords, mvps, 2)
+            # every stage signals the run number on its own timeline
+            self.assertEqual(completed_value, len(mvps))
+            self.assertTrue(np.array_equal(img, self.reference))
+
+    def test_work_graph_runs_in_flight(self):
+        from vkworkgraph import WorkGraph
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            if not vkc.timeline_semaphores:
+                self.skipTest('Vulkan 1.2 timeline semaphores not supported')
+            with WorkGraph(vkc, 2) as graph:
+                # two independent roots, a stage of run N+1 can be submitted before the stages of run N complete
+                graph.add_stage('a', lambda command_buffer, slot: None)
+                graph.add_stage('b', lambda command_buffer, slot: None)
+                graph.add_stage('c', lambda command_buffer, slot: None, after = ['a', 'b'])
+                submitted = dict((name, []) for name in graph.stages)
+                completed = dict((name, [0]) for name in graph.stages)
+                for run in range(6):
+                    self.assertEqual(graph.submit(), run + 1)
+                    for name, stage in graph.stages.items():
+                        submitted[name].append(stage.value)
+                        completed[name].append(graph.stage_completed_value(name))
+                graph.wait_idle()
+                for name in graph.stages:
+                    self.assertEqual(submitted[name], list(range(1, 7)))
+                    completed[name].append(graph.stage_completed_value(name))
+                    self.assertEqual(completed[name], sorted(completed[name]))
+                    self.assertEqual(completed[name][-1], 6)
+                self.assertEqual(graph.completed_value(), 6)
+
+    def test_readback_ring(self):
+        from vkreadback import ReadbackRing
+        from vkmultiview import orbit_view_projections
+        cube_coords = get_xyzw_uv_cube_coords()
+        with VkContextManager(vertex_data = cube_coords, surface_type = VkContextManager.VKC_OFFSCREEN) as vkc:
+            # a different view per frame, a frame read back from the wrong slot can't match
+            mvps = orbit_view_projections(7)
+            vkc.init_push_constant_pipeline()
+            references = [vkc.render_offscreen_frame(lambda cb: vkc.record_push_constant_render_pass(cb, [mvp])).copy() for mvp in mvps]
+            self.assertFalse(np.array_equal(references[0], references[1]))
+            with ReadbackRing(vkc, 3) as ring:
+                frames = []
+                for frame, img in ring.render(range(7), lambda cb, frame: vkc.record_push_constant_render_pass(cb, [mvps[frame]])):
+                    frames.append(frame)
+                    self.assertEqual(img.shape, self.reference.shape)
+                    self.assertTrue(np.array_equal(img, references[frame]))
+                self.assertEqual(frames, list(range(7)))
 
 if __name__ == '__main__':
     # set defaultTest to invoke a specific test case
@@ -0,0 +1,125 @@
+# Interleaved vertex layouts with compact attribute formats
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from collections import namedtuple
+import numpy as np
+import vulkanmitts as vk
+
+# numpy component type, number of components and how floats are quantized for each supported vertex format
+# a format with fewer components than the shader input is expanded by the vertex fetch e.g. a vec4 position
+# read from R32G32B32_SFLOAT gets w = 1.0
+FORMATS = { vk.VK_FORMAT_R32G32B32A32_SFLOAT : (np.float32, 4, 'float'),
+            vk.VK_FORMAT_R32G32B32_SFLOAT : (np.float32, 3, 'float'),
+            vk.VK_FORMAT_R32G32_SFLOAT : (np.float32, 2, 'float'),
+            vk.VK_FORMAT_R32_SFLOAT : (np.float32, 1, 'float'),
+            vk.VK_FORMAT_R16G16B16A16_SFLOAT : (np.float16, 4, 'float'),
+            vk.VK_FORMAT_R16G16_SFLOAT : (np.float16, 2, 'float'),
+            vk.VK_FORMAT_R16G16B16A16_UNORM : (np.uint16, 4, 'unorm'),
+            vk.VK_FORMAT_R16G16_UNORM : (np.uint16, 2, 'unorm'),
+            vk.VK_FORMAT_R16G16B16A16_SNORM : (np.int16, 4, 'snorm'),
+            vk.VK_FORMAT_R16G16_SNORM : (np.int16, 2, 'snorm'),
+            vk.VK_FORMAT_R8G8B8A8_UNORM : (np.uint8, 4, 'unorm'),
+            vk.VK_FORMAT_R8G8B8A8_SNORM : (np.int8, 4, 'snorm'),
+            vk.VK_FORMAT_R8G8_SNORM : (np.int8, 2, 'snorm'),
+            vk.VK_FORMAT_R32_UINT : (np.uint32, 1, 'int') }
+
+# encoding 'octahedral' stores a unit normal in 2 components, the shader decodes it with:
+# vec3 n = vec3(e, 1.0 - abs(e.x) - abs(e.y)); if (n.z < 0.0) n.xy = (1.0 - abs(n.yx)) * sign(n.xy); n = normalize(n);
+VertexAttribute = namedtuple('VertexAttribute', ['name', 'location', 'format', 'encoding'])
+VertexAttribute.__new__.__defaults__ = (None,)
+
+def octahedral_encode(normals):
+    normals = np.asarray(normals, dtype=np.float64)
+    n = normals / np.sum(np.abs(normals), axis=-1, keepdims=True)
+    xy = n[...,:2]
+    folded = (1.0 - np.abs(xy[...,::-1])) * np.where(xy >= 0.0, 1.0, -1.0)
+    return np.where(n[...,2:3] < 0.0, folded, xy)
+
+def octahedral_decode(encoded):
+    encoded = np.asarray(encoded, dtype=np.float64)
+    z = 1.0 - np.sum(np.abs(encoded), axis=-1, keepdims=True)
+    folded = (1.0 - np.abs(encoded[...,::-1])) * np.where(encoded >= 0.0, 1.0, -1.0)
+    xy = np.where(z < 0.0, folded, encoded)
+    n = np.concatenate([xy, z], axis=-1)
+    return n / np.linalg.norm(n, axis=-1, keepdims=True)
+
+def quantize(values, component_type, kind):
+    if kind == 'unorm':
+        return np.round(np.clip(values, 0.0, 1.0) * np.iinfo(component_type).max).astype(component_type)
+    if kind == 'snorm':
+        return np.round(np.clip(values, -1.0, 1.0) * np.iinfo(component_type).max).astype(component_type)
+    return np.asarray(values).astype(component_type)
+
+def dequantize(values, component_type, kind):
+    if kind in ('unorm', 'snorm'):
+        return np.maximum(values.astype(np.float32) / np.iinfo(component_type).max, -1.0)
+    return values.astype(np.float32)
+
+# describes one interleaved vertex binding, the attributes are packed in order with 4 bytes alignment
+class VertexLayout:
+    def __init__(self, attributes):
+        self.attributes = [VertexAttribute(*a) for a in attributes]
+        names = []
+        formats = []
+        self.offsets = []
+        offset = 0
+        for a in self.attributes:
+            component_type, components, kind = FORMATS[a.format]
+            offset = (offset + 3) // 4 * 4
+            names.append(a.name)
+            formats.append( (component_type, (components,)) )
+            self.offsets.append(offset)
+            offset += np.dtype(component_type).itemsize * components
+        self.stride = (offset + 3) // 4 * 4
+        self.dtype = np.dtype({'names' : names, 'formats' : formats, 'offsets' : self.offsets, 'itemsize' : self.stride})
+
+    # packs float arrays given per attribute name into an interleaved structured array
+    # missing trailing components are padded with 1.0 e.g. xyz positions in a 4 components format
+    def pack(self, **arrays):
+        count = len(next(iter(arrays.values())))
+        vertices = np.zeros(count, dtype=self.dtype)
+        for a in self.attributes:
+            component_type, components, kind = FORMATS[a.format]
+            values = np.asarray(arrays[a.name], dtype=np.float64).reshape(count, -1)
+            if a.encoding == 'octahedral':
+                values = octahedral_encode(values)
+            if values.shape[1] < components:
+                values = np.hstack([values, np.ones((count, components - values.shape[1]))])
+            vertices[a.name] = quantize(values, component_type, kind)
+        return vertices
+
+    def unpack(self, vertices, name):
+        a = next(a for a in self.attributes if a.name == name)
+        component_type, components, kind = FORMATS[a.format]
+        values = dequantize(vertices[name], component_type, kind)
+        if a.encoding == 'octahedral':
+            values = octahedral_decode(values).astype(np.float32)
+        return values
+
+    def binding_descriptions(self, binding = 0, input_rate = vk.VK_VERTEX_INPUT_RATE_VERTEX):
+        return vk.VkVertexInputBindingDescriptionVector(1, vk.VertexInputBindingDescription(binding, self.stride, input_rate))
+
+    def attribute_descriptions(self, binding = 0):
+        vi_attribs = vk.VkVertexInputAttributeDescriptionVector()
+        for a, offset in zip(self.attributes, self.offsets):
+            vi_attribs.append(vk.VertexInputAttributeDescription(a.location, binding, a.format, offset))
+        return vi_attribs
+
+    # formats that can't be used as vertex attributes on this device
+    def unsupported_formats(self, physical_device):
+        return [a.format for a in self.attributes
+                if (vk.getPhysicalDeviceFormatProperties(physical_device, a.format).bufferFeatures & vk.VK_FORMAT_FEATURE_VERTEX_BUFFER_BIT) == 0]
+
+# layout of cube_data.get_xyzw_uv_cube_coords, 24 bytes per vertex
+XYZW_UV_FLOAT = VertexLayout([('pos', 0, vk.VK_FORMAT_R32G32B32A32_SFLOAT), ('uv', 1, vk.VK_FORMAT_R32G32_SFLOAT)])
+
+# same shader inputs in 12 bytes per vertex, the uv must be in [0,1]
+XYZW_UV_COMPACT = VertexLayout([('pos', 0, vk.VK_FORMAT_R16G16B16A16_SFLOAT), ('uv', 1, vk.VK_FORMAT_R16G16_UNORM)])
+
+# per instance model matrix for vertex_shader_instanced.glsl, a mat4 input uses 4 consecutive locations
+INSTANCE_TRANSFORM = VertexLayout([('model%d' % i, 2 + i, vk.VK_FORMAT_R32G32B32A32_SFLOAT) for i in range(4)])
+
+# 16 bytes per vertex with an octahedral normal at location 2
+XYZW_UV_NORMAL_COMPACT = VertexLayout([('pos', 0, vk.VK_FORMAT_R16G16B16A16_SFLOAT),
+                                       ('uv', 1, vk.VK_FORMAT_R16G16_UNORM),
+                                       ('normal', 2, vk.VK_FORMAT_R16G16_SNORM, 'octahedral')])
@@ -0,0 +1,24 @@
+// Same as vertex_shader.glsl with a per instance model matrix
+// the uniform buffer holds the view projection matrix shared by all the instances
+#version 400
+#extension GL_ARB_separate_shader_objects : enable
+#extension GL_ARB_shading_language_420pack : enable
+layout (std140, binding = 0) uniform buf {
+        mat4 mvp;
+} ubuf;
+
+layout (location = 0) in vec4 pos;
+layout (location = 1) in vec2 inTexCoords;
+layout (location = 2) in mat4 model; // locations 2 to 5, one vec4 per location
+layout (location = 0) out vec2 texcoord;
+out gl_PerVertex { 
+    vec4 gl_Position;
+};
+void main() {
+   texcoord = inTexCoords;
+   gl_Position = ubuf.mvp * model * pos;
+
+   // GL->VK conventions
+   gl_Position.y = -gl_Position.y;
+   gl_Position.z = (gl_Position.z + gl_Position.w) / 2.0;
+}
@@ -0,0 +1,23 @@
+// Same as vertex_shader.glsl with the MVP matrix in a push constant
+// a command buffer can draw the scene from many views without updating the uniform buffer
+#version 400
+#extension GL_ARB_separate_shader_objects : enable
+#extension GL_ARB_shading_language_420pack : enable
+layout (push_constant) uniform push_constants {
+        mat4 mvp;
+} pc;
+
+layout (location = 0) in vec4 pos;
+layout (location = 1) in vec2 inTexCoords;
+layout (location = 0) out vec2 texcoord;
+out gl_PerVertex { 
+    vec4 gl_Position;
+};
+void main() {
+   texcoord = inTexCoords;
+   gl_Position = pc.mvp * pos;
+
+   // GL->VK conventions
+   gl_Position.y = -gl_Position.y;
+   gl_Position.z = (gl_Position.z + gl_Position.w) / 2.0;
+}
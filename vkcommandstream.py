@@ -0,0 +1,154 @@
+# Compact command streams replayed into a command buffer by one native call
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+import numpy as np
+import vulkanmitts as vk
+
+# numpy twin of CommandStreamRecord in vulkanmitts.i, the meaning of args depends on the opcode
+COMMAND_STREAM_RECORD = np.dtype([('opcode', np.uint32), ('args', np.uint32, (7,))])
+
+def split_offset(offset):
+    return offset & 0xFFFFFFFF, offset >> 32
+
+# Builds the records, the buffer table and the push constant payload of a command stream
+# the stream can be recorded in many command buffers, e.g. every frame, the arrays are built once
+# the per object methods append one record, draws_with_push_constants() appends thousands with numpy
+class CommandStream:
+    def __init__(self):
+        self.buffers = vk.VkBufferVector()
+        self.buffer_list = []
+        self.chunks = []
+        self.pending = []
+        self.payload_chunks = []
+        self.payload_size = 0
+        self.arrays = None
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks) + len(self.pending)
+
+    # index of buffer in the handle table of the stream
+    def buffer_index(self, buffer):
+        for i, b in enumerate(self.buffer_list):
+            if b is buffer:
+                return i
+        self.buffer_list.append(buffer)
+        self.buffers.append(buffer)
+        return len(self.buffer_list) - 1
+
+    def flush_pending(self):
+        if len(self.pending) > 0:
+            self.chunks.append(np.array(self.pending, dtype=COMMAND_STREAM_RECORD))
+            self.pending = []
+
+    def append(self, opcode, *args):
+        self.pending.append( (opcode, tuple(int(a) & 0xFFFFFFFF for a in args) + (0,) * (7 - len(args))) )
+        self.arrays = None
+
+    def extend(self, records):
+        self.flush_pending()
+        self.chunks.append(np.asarray(records, dtype=COMMAND_STREAM_RECORD))
+        self.arrays = None
+
+    # returns the offset of data in the payload
+    def add_payload(self, data):
+        data = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+        assert(data.nbytes % 4 == 0)
+        offset = self.payload_size
+        self.payload_chunks.append(data)
+        self.payload_size += data.nbytes
+        self.arrays = None
+        return offset
+
+    def bind_vertex_buffer(self, buffer, offset = 0, binding = 0):
+        self.append(vk.COMMAND_STREAM_BIND_VERTEX_BUFFER, binding, self.buffer_index(buffer), *split_offset(offset))
+
+    def bind_index_buffer(self, buffer, offset, index_type):
+        self.append(vk.COMMAND_STREAM_BIND_INDEX_BUFFER, self.buffer_index(buffer), split_offset(offset)[0], split_offset(offset)[1], index_type)
+
+    def push_constants(self, data, offset = 0, stage_flags = vk.VK_SHADER_STAGE_VERTEX_BIT):
+        size = np.asarray(data).nbytes
+        self.append(vk.COMMAND_STREAM_PUSH_CONSTANTS, stage_flags, offset, size, self.add_payload(data))
+
+    def draw(self, vertex_count, instance_count = 1, first_vertex = 0, first_instance = 0):
+        self.append(vk.COMMAND_STREAM_DRAW, vertex_count, instance_count, first_vertex, first_instance)
+
+    def draw_indexed(self, index_count, instance_count = 1, first_index = 0, vertex_offset = 0, first_instance = 0):
+        self.append(vk.COMMAND_STREAM_DRAW_INDEXED, index_count, instance_count, first_index, vertex_offset, first_instance)
+
+    def set_scissor(self, x, y, width, height, first_scissor = 0):
+        self.append(vk.COMMAND_STREAM_SET_SCISSOR, first_scissor, x, y, width, height)
+
+    # binds the buffers of a MeshRange like VkContextManager.record_draw
+    def bind_mesh(self, vertex_buffer, index_buffer, mesh_range):
+        self.bind_vertex_buffer(vertex_buffer, mesh_range.vertex_offset)
+        if mesh_range.index_type is not None:
+            self.bind_index_buffer(index_buffer, mesh_range.index_offset, mesh_range.index_type)
+
+    # one push constant update and one draw of mesh_range per row of values e.g. an (N,4,4) array of MVP matrices
+    # the mesh must be bound before, see bind_mesh
+    def draws_with_push_constants(self, values, mesh_range, offset = 0, stage_flags = vk.VK_SHADER_STAGE_VERTEX_BIT):
+        values = np.ascontiguousarray(values)
+        count = len(values)
+        if count == 0:
+            return
+        size = values.nbytes // count
+        payload_offset = self.add_payload(values)
+        records = np.zeros(2 * count, dtype=COMMAND_STREAM_RECORD)
+        pushes = records[0::2]
+        pushes['opcode'] = vk.COMMAND_STREAM_PUSH_CONSTANTS
+        pushes['args'][:,0] = stage_flags
+        pushes['args'][:,1] = offset
+        pushes['args'][:,2] = size
+        pushes['args'][:,3] = payload_offset + size * np.arange(count, dtype=np.uint32)
+        draws = records[1::2]
+        if mesh_range.index_type is not None:
+            draws['opcode'] = vk.COMMAND_STREAM_DRAW_INDEXED
+            draws['args'][:,0] = mesh_range.index_count
+        else:
+            draws['opcode'] = vk.COMMAND_STREAM_DRAW
+            draws['args'][:,0] = mesh_range.vertex_count
+        draws['args'][:,1] = 1
+        self.extend(records)
+
+    # (records, payload) arrays passed to cmdReplayCommandStream
+    def finish(self):
+        if self.arrays is None:
+            self.flush_pending()
+            records = np.concatenate(self.chunks) if len(self.chunks) > 0 else np.zeros(0, dtype=COMMAND_STREAM_RECORD)
+            payload = np.concatenate(self.payload_chunks) if len(self.payload_chunks) > 0 else None
+            self.chunks = [records]
+            self.payload_chunks = [] if payload is None else [payload]
+            self.arrays = (records, payload)
+        return self.arrays
+
+    # layout is the pipeline layout of the push constants, None if the stream has none
+    def record(self, command_buffer, layout = None):
+        records, payload = self.finish()
+        vk.cmdReplayCommandStream(command_buffer, records, self.buffers, layout, payload)
+
+# the draws of VkContextManager.record_push_constant_draws as a stream, built once with numpy
+def push_constant_draw_stream(vkc, mvps):
+    stream = CommandStream()
+    stream.bind_mesh(vkc.vertex_buffer, vkc.index_buffer, vkc.mesh_range)
+    stream.draws_with_push_constants(np.asarray(mvps, dtype=np.float32), vkc.mesh_range)
+    return stream
+
+# binds the push constant pipeline of the context and replays the draws of the stream, inside a render pass
+# cmdReplayCommandStream releases the GIL, so threads recording streams in their own command buffers run in parallel
+def record_stream_draws(vkc, command_buffer, stream):
+    vk.cmdBindPipeline(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vkc.push_constant_pipeline[0])
+    vk.cmdBindDescriptorSets(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vkc.push_constant_pipeline_layout, 0, vkc.descriptor_set, [])
+    vkc.init_viewports(command_buffer)
+    vkc.init_scissors(command_buffer)
+    stream.record(command_buffer, vkc.push_constant_pipeline_layout)
+
+# the render pass of the context with the push constant pipeline bound, its draws are replayed from the stream
+def record_stream_render_pass(vkc, command_buffer, stream):
+    vk.cmdBeginRenderPass(command_buffer, vkc.make_render_pass_begin_info(), vk.VK_SUBPASS_CONTENTS_INLINE)
+    record_stream_draws(vkc, command_buffer, stream)
+    vk.cmdEndRenderPass(command_buffer)
+
+def render_stream(vkc, stream):
+    if not hasattr(vkc, 'push_constant_pipeline'):
+        vkc.init_push_constant_pipeline()
+    return vkc.render_offscreen_frame(lambda command_buffer: record_stream_render_pass(vkc, command_buffer, stream))
@@ -3,6 +3,9 @@
 # This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
 from __future__ import print_function
 import os
+import struct
+import binascii
+import warnings
 import vulkanmitts as vk
 import pyglslang
 from PIL import Image
@@ -11,6 +14,12 @@ from contextlib2 import contextmanager,ExitStack
 from transforms import *
 from glsl_to_spv import *
 from cube_data import *
+from mesh import index_mesh
+from vertex_layout import XYZW_UV_FLOAT, INSTANCE_TRANSFORM
+from collections import namedtuple, OrderedDict
+from vkmemory import DeviceMemoryAllocator, MemoryTypeTable, MappedBuffer, delete_this, align_up
+from vkstaging import StagingRing, DEFAULT_STAGING_SIZE
+from fileutils import atomic_write
 
 class MappedMemoryWrapper:
     def __init__(self, obj):
@@ -40,7 +49,61 @@ def check(w, h, c0, c1, blocksize):
     grid = np.tile(tile, ( int(h/(2*blocksize))+1, int(w/(2*blocksize))+1) )
     return grid[:h,:w]
 
+INDEX_TYPES = { np.dtype(np.uint16) : vk.VK_INDEX_TYPE_UINT16,
+                np.dtype(np.uint32) : vk.VK_INDEX_TYPE_UINT32 }
+
+# location of one mesh in the shared vertex and index buffers returned by VkContextManager.upload_meshes
+# the offsets are in bytes, index_type is None for non indexed meshes
+MeshRange = namedtuple('MeshRange', ['vertex_offset', 'vertex_count', 'vertex_stride', 'index_offset', 'index_count', 'index_type'])
+
+# numpy twin of VkDrawIndexedIndirectCommand, an array of it is the content of an indirect buffer
+DRAW_INDEXED_INDIRECT_COMMAND = np.dtype([('indexCount', np.uint32),
+                                          ('instanceCount', np.uint32),
+                                          ('firstIndex', np.uint32),
+                                          ('vertexOffset', np.int32),
+                                          ('firstInstance', np.uint32)])
+
+# device features enabled when supported, the others stay disabled because some e.g. robustBufferAccess have a cost
+OPTIONAL_DEVICE_FEATURES = ['multiDrawIndirect', 'drawIndirectFirstInstance']
+
+# the index type shared by indexed mesh ranges drawn from one index buffer binding
+def mesh_ranges_index_type(mesh_ranges):
+    index_types = set(r.index_type for r in mesh_ranges)
+    if None in index_types:
+        raise ValueError('Indirect draws need indexed meshes, %d of the %d meshes have no indices' % (sum(r.index_type is None for r in mesh_ranges), len(mesh_ranges)))
+    if len(index_types) != 1:
+        raise ValueError('Indirect draws need a single index type, the meshes have %d' % len(index_types))
+    return index_types.pop()
+
+# one draw command per indexed mesh range, the ranges must share the vertex stride and the index type
+# set instanceCount to 0 to skip a mesh without rebuilding the array
+def draw_indexed_indirect_commands(mesh_ranges, instance_count = 1):
+    index_size = 2 if mesh_ranges_index_type(mesh_ranges) == vk.VK_INDEX_TYPE_UINT16 else 4
+    strides = set(r.vertex_stride for r in mesh_ranges)
+    if len(strides) != 1:
+        raise ValueError('Indirect draws need a single vertex stride, the meshes have strides %s' % sorted(strides))
+    stride = strides.pop()
+    commands = np.zeros(len(mesh_ranges), dtype=DRAW_INDEXED_INDIRECT_COMMAND)
+    commands['indexCount'] = [r.index_count for r in mesh_ranges]
+    commands['instanceCount'] = instance_count
+    commands['firstIndex'] = [r.index_offset // index_size for r in mesh_ranges]
+    commands['vertexOffset'] = [r.vertex_offset // stride for r in mesh_ranges]
+    return commands
+
+# the buffers are released by close(), or with the stack passed to upload_meshes
+class MeshBuffers:
+    def __init__(self, vertex_buffer, index_buffer, ranges, device_local, stack):
+        self.vertex_buffer = vertex_buffer
+        self.index_buffer = index_buffer
+        self.ranges = ranges
+        self.device_local = device_local
+        self.stack = stack
+
+    def close(self):
+        self.stack.close()
+
 # ported from the Lunar SDK
+# this queries the physical device on every call, VkContextManager uses its MemoryTypeTable instead
 def memory_type_from_properties(physicalDevice, memoryTypeBits, properties):
     # Search memtypes to find first index with those properties
     memory_props = vk.getPhysicalDeviceMemoryProperties(physicalDevice)
@@ -54,9 +117,35 @@ def memory_type_from_properties(physicalDevice, memoryTypeBits, properties):
 
     return None
 
-def delete_this(obj):
-    if hasattr(obj,'this'):
-        del obj.this
+# VkPipelineCacheHeaderVersionOne: headerSize, headerVersion, vendorID, deviceID, pipelineCacheUUID
+PIPELINE_CACHE_HEADER = struct.Struct('<IIII16s')
+
+def pipeline_cache_data_is_compatible(data, gpu_props):
+    if len(data) < PIPELINE_CACHE_HEADER.size:
+        return False
+    header_size, header_version, vendor_id, device_id, uuid = PIPELINE_CACHE_HEADER.unpack_from(data)
+    return header_size >= PIPELINE_CACHE_HEADER.size and \
+           header_version == vk.VK_PIPELINE_CACHE_HEADER_VERSION_ONE and \
+           vendor_id == gpu_props.vendorID and \
+           device_id == gpu_props.deviceID and \
+           uuid == bytes(bytearray(gpu_props.pipelineCacheUUID))
+
+# numpy type of the texels copied from the depth aspect with vkCmdCopyImageToBuffer
+DEPTH_READBACK_DTYPES = { vk.VK_FORMAT_D16_UNORM : np.uint16,
+                          vk.VK_FORMAT_X8_D24_UNORM_PACK32 : np.uint32,
+                          vk.VK_FORMAT_D24_UNORM_S8_UINT : np.uint32,
+                          vk.VK_FORMAT_D32_SFLOAT : np.float32,
+                          vk.VK_FORMAT_D32_SFLOAT_S8_UINT : np.float32 }
+
+# numpy type and number of components of the offscreen color formats, the readback array is (h,w,components)
+# or (h,w) for single component formats
+COLOR_READBACK_FORMATS = { vk.VK_FORMAT_R8G8B8A8_UNORM : (np.uint8, 4),
+                           vk.VK_FORMAT_B8G8R8A8_UNORM : (np.uint8, 4),
+                           vk.VK_FORMAT_R8G8B8A8_SRGB : (np.uint8, 4),
+                           vk.VK_FORMAT_R16G16B16A16_SFLOAT : (np.float16, 4),
+                           vk.VK_FORMAT_R32G32B32A32_SFLOAT : (np.float32, 4),
+                           vk.VK_FORMAT_R16_SFLOAT : (np.float16, 1),
+                           vk.VK_FORMAT_R32_SFLOAT : (np.float32, 1) }
 
 class VkContextManager:
     # Acronym for ExitStack Push to reduce the clutter
@@ -83,7 +172,9 @@ class VkContextManager:
         self.instance_ext_names = [vk.VK_KHR_SURFACE_EXTENSION_NAME, vk.VK_EXT_DEBUG_REPORT_EXTENSION_NAME]
         if self.surface_type == VkContextManager.VKC_WIN32:
             self.instance_ext_names.append(vk.VK_KHR_WIN32_SURFACE_EXTENSION_NAME)
-        app = vk.ApplicationInfo("foo", 1, "bar", 1, vk.makeVersion(1,1,0))
+        # Vulkan 1.2 when the loader supports it, for the timeline semaphores
+        self.instance_api_version = min(vk.enumerateInstanceVersion(), vk.makeVersion(1,2,0))
+        app = vk.ApplicationInfo("foo", 1, "bar", 1, self.instance_api_version)
         assert(app is not None)
         instance_create_info = vk.InstanceCreateInfo(0, app, ['VK_LAYER_KHRONOS_validation'], self.instance_ext_names)
         self.instance = self.ESP( vk.createInstance(instance_create_info) )
@@ -98,6 +189,7 @@ class VkContextManager:
     def init_enumerate_device(self):
         self.physical_devices = vk.enumeratePhysicalDevices(self.instance)
         self.memory_properties = vk.getPhysicalDeviceMemoryProperties(self.physical_devices[0])
+        self.memory_types = MemoryTypeTable(self.memory_properties)
         self.gpu_props = vk.getPhysicalDeviceProperties(self.physical_devices[0])
 
     def init_device(self):
@@ -108,10 +200,45 @@ class VkContextManager:
         dev_queue_ci = vk.DeviceQueueCreateInfo(0, self.device_queue_index, vk.floatVector(1,0.0))
         vec_dev_queue_ci = vk.VkDeviceQueueCreateInfoVector()
         vec_dev_queue_ci.append(dev_queue_ci)
-        device_ci = vk.DeviceCreateInfo(0, vec_dev_queue_ci, [], self.device_extension_names, None)
+        self.supported_features = vk.getPhysicalDeviceFeatures(self.physical_devices[0])
+        self.enabled_features = vk.getPhysicalDeviceFeatures(self.physical_devices[0])
+        feature_names = [name for name, value in vars(type(self.enabled_features)).items() if isinstance(value, property)]
+        for name in feature_names:
+            if name not in OPTIONAL_DEVICE_FEATURES:
+                setattr(self.enabled_features, name, False)
+        # timeline semaphores are a required feature of Vulkan 1.2, see vkworkgraph.py
+        self.timeline_semaphores = self.instance_api_version >= vk.makeVersion(1,2,0) and self.gpu_props.apiVersion >= vk.makeVersion(1,2,0)
+        timeline_features = vk.PhysicalDeviceTimelineSemaphoreFeatures(True) if self.timeline_semaphores else None
+        device_ci = vk.DeviceCreateInfo(0, vec_dev_queue_ci, [], self.device_extension_names, self.enabled_features, timeline_features)
         self.device = self.ESP( vk.createDevice(self.physical_devices[0], device_ci) )
         assert(self.device is not None)
 
+    def init_memory_allocator(self):
+        # all the resources below are sub-allocated from large blocks, see vkmemory.py
+        self.allocator = DeviceMemoryAllocator(self.device, self.memory_types, non_coherent_atom_size = self.gpu_props.limits.nonCoherentAtomSize)
+        self.stack.callback(self.allocator.destroy)
+
+    # allocate and bind the memory of a resource, the range is returned to the allocator in unwinding order in __exit__
+    def bind_image_memory(self, image, properties, linear = False, preferred = 0):
+        allocation = self.allocator.allocate_for_image(image, properties, linear, preferred)
+        self.stack.callback(allocation.free)
+        return allocation
+
+    # persistently mapped buffer released with the context, or with stack e.g. a local ExitStack for a temporary buffer
+    def create_mapped_buffer(self, usage, dtype, shape, properties = vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, preferred = vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT, stack = None):
+        if stack is None:
+            stack = self.stack
+        mapped_buffer = MappedBuffer(self.allocator, usage, dtype, shape, properties, preferred)
+        stack.callback(mapped_buffer.destroy)
+        return mapped_buffer
+
+    def bind_buffer_memory(self, buffer, properties, preferred = 0, stack = None):
+        if stack is None:
+            stack = self.stack
+        allocation = self.allocator.allocate_for_buffer(buffer, properties, preferred)
+        stack.callback(allocation.free)
+        return allocation
+
     def delete_window(self):
         self.widget = None
 
@@ -158,7 +285,10 @@ class VkContextManager:
         assert(B8G8R8A8_format_found)
 
     def init_without_surface(self):
-        self.format = vk.VK_FORMAT_R8G8B8A8_UNORM
+        fp = vk.getPhysicalDeviceFormatProperties(self.physical_devices[0], self.color_format)
+        if (fp.optimalTilingFeatures & vk.VK_FORMAT_FEATURE_COLOR_ATTACHMENT_BIT) == 0:
+            raise RuntimeError('Color format %d not supported as color attachment on this physical device' % self.color_format)
+        self.format = self.color_format
         self.color_space = None # not required without surface and swap chain
         self.surface = None # not required
         self.init_graphic_queue()
@@ -172,6 +302,48 @@ class VkContextManager:
 
     def init_device_queue(self):
         self.device_queue = vk.getDeviceQueue(self.device, self.graphics_queue_family_index, 0)
+        self.submit_fence = self.ESP( vk.createFence(self.device, vk.FenceCreateInfo(0)) )
+
+    # reusable ring for the buffer and image uploads, see vkstaging.py
+    def init_staging_ring(self, size = DEFAULT_STAGING_SIZE):
+        self.staging = self.stack.enter_context(StagingRing(self, size))
+
+    # with timeline semaphores wait_values and signal_values have one value per semaphore, ignored for the binary ones
+    def make_submit_info(self, command_buffers = None, wait_semaphores = None, wait_stages = None, signal_semaphores = None, wait_values = None, signal_values = None):
+        if command_buffers is None:
+            command_buffers = self.command_buffers
+        if wait_semaphores is None:
+            wait_semaphores = vk.VkSemaphoreVector()
+        if wait_stages is None:
+            wait_stages = vk.VkFlagVector(max(len(wait_semaphores),1), vk.VK_PIPELINE_STAGE_BOTTOM_OF_PIPE_BIT)
+        if signal_semaphores is None:
+            signal_semaphores = vk.VkSemaphoreVector()
+
+        timeline_info = None
+        if wait_values is not None or signal_values is not None:
+            wait_values = [] if wait_values is None else [int(v) for v in wait_values]
+            signal_values = [] if signal_values is None else [int(v) for v in signal_values]
+            assert(len(wait_values) in [0, len(wait_semaphores)] and len(signal_values) in [0, len(signal_semaphores)])
+            timeline_info = vk.TimelineSemaphoreSubmitInfo(wait_values, signal_values)
+        return vk.SubmitInfo(wait_semaphores, wait_stages, command_buffers, signal_semaphores, timeline_info)
+
+    def submit(self, command_buffers = None, fence = None, wait_semaphores = None, wait_stages = None, signal_semaphores = None, wait_values = None, signal_values = None):
+        submit_info_vec = vk.VkSubmitInfoVector()
+        submit_info_vec.append( self.make_submit_info(command_buffers, wait_semaphores, wait_stages, signal_semaphores, wait_values, signal_values) )
+        vk.queueSubmit(self.device_queue, submit_info_vec, fence)
+
+    # blocks until the fence is signaled then resets it for the next submission
+    # the wait doesn't spin, the GIL is released by waitForFencesStatus while the GPU works
+    def wait_and_reset_fence(self, fence):
+        fences = vk.VkFenceVector(1, fence)
+        res = vk.waitForFencesStatus(self.device, fences, True)
+        assert(res == vk.VK_SUCCESS)
+        vk.resetFences(self.device, fences)
+
+    # submits the command buffers on the device queue and blocks until they complete
+    def submit_and_wait(self, command_buffers = None, wait_semaphores = None, wait_stages = None, signal_semaphores = None):
+        self.submit(command_buffers, self.submit_fence, wait_semaphores, wait_stages, signal_semaphores)
+        self.wait_and_reset_fence(self.submit_fence)
 
     def init_swap_chain(self):
         assert(self.surface_type != VkContextManager.VKC_OFFSCREEN and self.surface is not None)
@@ -232,13 +404,7 @@ class VkContextManager:
                                     vk.VK_IMAGE_LAYOUT_UNDEFINED)
 
         self.offscreen_output_image = self.ESP( vk.createImage(self.device, ici) )
-        mem_reqs = vk.getImageMemoryRequirements(self.device, self.offscreen_output_image)
-
-        mem_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, 0)
-        assert(mem_type_index is not None)
-
-        self.offscreen_output_image_men = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, mem_type_index) ) )
-        vk.bindImageMemory(self.device, self.offscreen_output_image, self.offscreen_output_image_men, 0)
+        self.offscreen_output_image_alloc = self.bind_image_memory(self.offscreen_output_image, 0)
 
         subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
         img_mem_barrier = vk.ImageMemoryBarrier(0, vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT, vk.VK_IMAGE_LAYOUT_UNDEFINED, vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL, 0, 0, self.offscreen_output_image, subresource_range)
@@ -256,6 +422,32 @@ class VkContextManager:
         self.images = [self.offscreen_output_image]
         self.image_views = [self.offscreen_output_image_view]
 
+    # with multisampling the render pass draws to this image and resolves it to the output or swap chain image
+    # its content is never stored so it can live in lazily allocated memory on tiled GPUs
+    def init_multisample_color_image(self):
+        limits = self.gpu_props.limits
+        if (limits.framebufferColorSampleCounts & limits.framebufferDepthSampleCounts & self.sample_count) == 0:
+            raise RuntimeError('%d samples not supported on this physical device' % self.sample_count)
+        w,h = self.get_surface_extent()
+        ici = vk.ImageCreateInfo(   0,
+                                    vk.VK_IMAGE_TYPE_2D,
+                                    self.format,
+                                    vk.Extent3D(w,h,1),
+                                    1,
+                                    1,
+                                    self.sample_count,
+                                    vk.VK_IMAGE_TILING_OPTIMAL,
+                                    vk.VK_IMAGE_USAGE_COLOR_ATTACHMENT_BIT|vk.VK_IMAGE_USAGE_TRANSIENT_ATTACHMENT_BIT,
+                                    vk.VK_SHARING_MODE_EXCLUSIVE,
+                                    [],
+                                    vk.VK_IMAGE_LAYOUT_UNDEFINED)
+        self.multisample_color_image = self.ESP( vk.createImage(self.device, ici) )
+        self.multisample_color_alloc = self.bind_image_memory(self.multisample_color_image, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT, preferred = vk.VK_MEMORY_PROPERTY_LAZILY_ALLOCATED_BIT)
+
+        components = vk.ComponentMapping(vk.VK_COMPONENT_SWIZZLE_R, vk.VK_COMPONENT_SWIZZLE_G, vk.VK_COMPONENT_SWIZZLE_B, vk.VK_COMPONENT_SWIZZLE_A)
+        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
+        self.multisample_color_view = self.ESP( vk.createImageView(self.device, vk.ImageViewCreateInfo(0, self.multisample_color_image, vk.VK_IMAGE_VIEW_TYPE_2D, self.format, components, subresource_range)) )
+
     def get_surface_extent(self):
         if self.surface_type == VkContextManager.VKC_WIN32:
             assert(self.surface is not None)
@@ -282,21 +474,15 @@ class VkContextManager:
                                     vk.Extent3D(w,h,1),
                                     1,
                                     1,
-                                    vk.VK_SAMPLE_COUNT_1_BIT,
+                                    self.sample_count,
                                     tiling,
-                                    vk.VK_IMAGE_USAGE_DEPTH_STENCIL_ATTACHMENT_BIT,
+                                    vk.VK_IMAGE_USAGE_DEPTH_STENCIL_ATTACHMENT_BIT | vk.VK_IMAGE_USAGE_TRANSFER_SRC_BIT,
                                     vk.VK_SHARING_MODE_EXCLUSIVE,
                                     [],
                                     vk.VK_IMAGE_LAYOUT_UNDEFINED)
 
         self.depth_image =  self.ESP( vk.createImage(self.device, ici) )
-        mem_reqs = vk.getImageMemoryRequirements(self.device, self.depth_image);
-
-        mem_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, 0)
-        assert(mem_type_index is not None)
-
-        self.depth_mem = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, mem_type_index) ) )
-        vk.bindImageMemory(self.device, self.depth_image, self.depth_mem, 0)
+        self.depth_alloc = self.bind_image_memory(self.depth_image, 0, tiling == vk.VK_IMAGE_TILING_LINEAR)
 
         subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_DEPTH_BIT, 0, 1, 0, 1)
         img_mem_barrier = vk.ImageMemoryBarrier(0, vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT, vk.VK_IMAGE_LAYOUT_UNDEFINED, vk.VK_IMAGE_LAYOUT_DEPTH_STENCIL_ATTACHMENT_OPTIMAL, 0, 0, self.depth_image, subresource_range)
@@ -334,13 +520,7 @@ class VkContextManager:
 
             tex_format = vk.VK_FORMAT_R8G8B8A8_UNORM
 
-        format_props = vk.getPhysicalDeviceFormatProperties(self.physical_devices[0], tex_format)
-        need_staging = (format_props.linearTilingFeatures & vk.VK_FORMAT_FEATURE_SAMPLED_IMAGE_BIT) == 0
-        if need_staging:
-            usage = vk.VK_IMAGE_USAGE_TRANSFER_SRC_BIT
-        else:
-            usage = vk.VK_IMAGE_USAGE_SAMPLED_BIT
-
+        # device local optimal texture, the texels go through the staging ring
         ici = vk.ImageCreateInfo(   0,
                                     vk.VK_IMAGE_TYPE_2D,
                                     tex_format,
@@ -348,124 +528,26 @@ class VkContextManager:
                                     1,
                                     1,
                                     vk.VK_SAMPLE_COUNT_1_BIT,
-                                    vk.VK_IMAGE_TILING_LINEAR,
-                                    usage,
+                                    vk.VK_IMAGE_TILING_OPTIMAL,
+                                    vk.VK_IMAGE_USAGE_TRANSFER_DST_BIT | vk.VK_IMAGE_USAGE_SAMPLED_BIT,
                                     vk.VK_SHARING_MODE_EXCLUSIVE,
                                     [],
                                     vk.VK_IMAGE_LAYOUT_UNDEFINED)
 
         self.tex_image =  self.ESP( vk.createImage(self.device, ici) )
-        mem_reqs = vk.getImageMemoryRequirements(self.device, self.tex_image)
-
-        mem_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
-        assert(mem_type_index is not None)
-
-        self.tex_mem = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, mem_type_index) ) )
-        vk.bindImageMemory(self.device, self.tex_image, self.tex_mem, 0)
-
-        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-        img_mem_barrier = vk.ImageMemoryBarrier(0, vk.VK_ACCESS_MEMORY_READ_BIT, vk.VK_IMAGE_LAYOUT_UNDEFINED, vk.VK_IMAGE_LAYOUT_GENERAL, 0, 0, self.tex_image, subresource_range)
-
-        vk.cmdPipelineBarrier(self.command_buffers[0],
-                              vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
-                              vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT, 0,
-                              vk.VkMemoryBarrierVector(),
-                              vk.VkBufferMemoryBarrierVector(),
-                              vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
+        self.tex_alloc = self.bind_image_memory(self.tex_image, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
+        self.staging.upload_image(self.tex_image, self.img_array, img_size[0], img_size[1])
+        self.staging.flush()
 
+        # submits the layout transitions recorded in the setup command buffer
         vk.endCommandBuffer(self.command_buffers[0])
-
-        with vkreleasing( vk.createFence(self.device, vk.FenceCreateInfo(0)) ) as cmd_fence:
-            submit_info_vec = vk.VkSubmitInfoVector()
-            cmd_buf = vk.VkCommandBufferVector(1, self.command_buffers[0])
-            submit_info_vec.append( vk.SubmitInfo(vk.VkSemaphoreVector(), vk.VkFlagVector(), cmd_buf, vk.VkSemaphoreVector()) )
-            vk.queueSubmit(self.device_queue, submit_info_vec, cmd_fence)
-
-            layout = vk.getImageSubresourceLayout(self.device, self.tex_image, vk.ImageSubresource(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 0))
-
-            command_buffer_finished = False
-            cmd_fences = vk.VkFenceVector(1,cmd_fence)
-            while not command_buffer_finished:
-                try:
-                    vk.waitForFences(self.device, cmd_fences, True, 1000000)
-                    command_buffer_finished = True
-                except RuntimeError:
-                    pass
-
-        # note that we pass the shape of the numpy array we want mapped, in this case the numpy array number of column is 4x the image width because colors are packed per pixel
-        # layout.rowPitch could be different from width * sizeof(pixel format) that why it must be passed to mapMemory2D
-        with vkunmapping( vk.mapMemory2D(self.device, self.tex_mem, 0, 0, np.dtype('ubyte').num, self.img_array.shape[1], self.img_array.shape[0], layout.rowPitch ) ) as mapped_array:
-            assert(mapped_array.mem.strides[0] == layout.rowPitch)
-            np.copyto(mapped_array.mem, self.img_array)
-
+        self.submit_and_wait(vk.VkCommandBufferVector(1, self.command_buffers[0]))
         vk.resetCommandBuffer(self.command_buffers[0], 0)
         vk.beginCommandBuffer(self.command_buffers[0], vk.CommandBufferBeginInfo(0,None))
 
-        if not need_staging:
-            subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-            img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_MEMORY_READ_BIT, vk.VK_ACCESS_SHADER_READ_BIT, vk.VK_IMAGE_LAYOUT_GENERAL, vk.VK_IMAGE_LAYOUT_SHADER_READ_ONLY_OPTIMAL, 0, 0, self.tex_image, subresource_range)
-
-            vk.cmdPipelineBarrier(self.command_buffers[0],
-                                  vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
-                                  vk.VK_PIPELINE_STAGE_FRAGMENT_SHADER_BIT, 0,
-                                  vk.VkMemoryBarrierVector(),
-                                  vk.VkBufferMemoryBarrierVector(),
-                                  vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
-
-            self.dst_img = self.tex_image
-        else:
-            ###############################
-            # !!! NOT CURRENTLY TESTED !!!
-            ici.tiling = vk.VK_IMAGE_TILING_OPTIMAL
-            ici.usage =  vk.VK_IMAGE_USAGE_TRANSFER_DST_BIT | vk.VK_IMAGE_USAGE_SAMPLED_BIT
-            self.dst_img = self.ESP( vk.createImage(self.device, ici) )
-
-            mem_reqs = vk.getImageMemoryRequirements(self.device, self.dst_img);
-            mem_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
-            assert(mem_type_index is not None)
-
-            self.dst_mem = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, mem_type_index) ) )
-            vk.bindImageMemory(self.device, self.dst_img, self.dst_mem, 0)
-
-            subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-            img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_MEMORY_READ_BIT, vk.VK_ACCESS_MEMORY_WRITE_BIT, vk.VK_IMAGE_LAYOUT_GENERAL, vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL, 0, 0, self.tex_image, subresource_range)
-
-            vk.cmdPipelineBarrier(self.command_buffers[0],
-                                  vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
-                                  vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT, 0,
-                                  vk.VkMemoryBarrierVector(),
-                                  vk.VkBufferMemoryBarrierVector(),
-                                  vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
-
-            subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-            img_mem_barrier = vk.ImageMemoryBarrier(0, vk.VK_ACCESS_MEMORY_WRITE_BIT, old_image_layout, vk.VK_IMAGE_LAYOUT_UNDEFINED, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, 0, 0, self.dst_img, subresource_range)
-
-            vk.cmdPipelineBarrier(self.command_buffers[0],
-                                  vk.VK_PIPELINE_STAGE_ALL_COMMANDS_BIT,
-                                  vk.VK_PIPELINE_STAGE_ALL_COMMANDS_BIT, 0,
-                                  vk.VkMemoryBarrierVector(),
-                                  vk.VkBufferMemoryBarrierVector(),
-                                  vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
-
-            copy_regions = vk.VkImageCopyVector(1,vk.ImageCopy(vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_COLOR_BIT,0,0,1),vk.Offset3D(0,0,0),
-                                                               vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_COLOR_BIT,0,0,1),vk.Offset3D(0,0,0), vk.Extent3D(img_size[0],img_size[1],1)))
-            vk.cmdCopyImage(self.command_buffers[0], self.tex_image, vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL, self.dst_img, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, copy_regions)
-
-            subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-            img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_MEMORY_WRITE_BIT, vk.VK_ACCESS_MEMORY_READ_BIT, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, vk.VK_IMAGE_LAYOUT_SHADER_READ_ONLY_OPTIMAL, 0, 0, self.dst_img, subresource_range)
-
-            vk.cmdPipelineBarrier(self.command_buffers[0],
-                                  vk.VK_PIPELINE_STAGE_ALL_COMMANDS_BIT,
-                                  vk.VK_PIPELINE_STAGE_ALL_COMMANDS_BIT, 0,
-                                  vk.VkMemoryBarrierVector(),
-                                  vk.VkBufferMemoryBarrierVector(),
-                                  vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
-            ## End not tested section
-            ###############################
-
         components = vk.ComponentMapping(vk.VK_COMPONENT_SWIZZLE_R, vk.VK_COMPONENT_SWIZZLE_G, vk.VK_COMPONENT_SWIZZLE_B, vk.VK_COMPONENT_SWIZZLE_A)
         subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-        ivci = vk.ImageViewCreateInfo(0, self.dst_img, vk.VK_IMAGE_VIEW_TYPE_2D, tex_format, components, subresource_range)
+        ivci = vk.ImageViewCreateInfo(0, self.tex_image, vk.VK_IMAGE_VIEW_TYPE_2D, tex_format, components, subresource_range)
         self.tex_img_view = self.ESP(vk.createImageView(self.device, ivci))
 
     def init_sampler(self):
@@ -492,16 +574,12 @@ class VkContextManager:
         M = np.eye(4)
         MVP = M.dot(V.dot(P)).astype(np.single)
 
-        self.uniform_buffer = self.ESP( vk.createBuffer(self.device, vk.BufferCreateInfo(0, MVP.nbytes, vk.VK_BUFFER_USAGE_UNIFORM_BUFFER_BIT, vk.VK_SHARING_MODE_EXCLUSIVE, [])) )
-        self.uniform_buffer_bytes = MVP.nbytes
-
-        mem_reqs = vk.getBufferMemoryRequirements(self.device, self.uniform_buffer)
-        memory_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
-        self.uniform_buffer_mem = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, memory_type_index)) )
-        with vkunmapping( vk.mapMemory(self.device, self.uniform_buffer_mem , 0, mem_reqs.size, 0) ) as mapped_array:
-            np.copyto(np.frombuffer(mapped_array.mem, dtype=np.single, count=len(MVP.flat)), MVP.flat)
-
-        vk.bindBufferMemory(self.device, self.uniform_buffer, self.uniform_buffer_mem, 0)
+        # per frame updates are done in place e.g. self.uniform.array[...] = MVP; self.uniform.flush()
+        self.uniform = self.create_mapped_buffer(vk.VK_BUFFER_USAGE_UNIFORM_BUFFER_BIT, np.single, MVP.shape)
+        self.uniform_buffer = self.uniform.buffer
+        self.uniform_buffer_bytes = self.uniform.size
+        self.uniform.array[...] = MVP
+        self.uniform.flush()
 
     def init_descriptor_and_pipeline_layouts(self):
         layout_bindings = vk.VkDescriptorSetLayoutBindingVector()
@@ -523,18 +601,30 @@ class VkContextManager:
             initial_layout = vk.VK_IMAGE_LAYOUT_UNDEFINED
             final_layout = vk.VK_IMAGE_LAYOUT_PRESENT_SRC_KHR
 
+        multisampled = self.sample_count != vk.VK_SAMPLE_COUNT_1_BIT
         attachments = vk.VkAttachmentDescriptionVector()
-        attachments.append( vk.AttachmentDescription(0, self.format,
-                                                        vk.VK_SAMPLE_COUNT_1_BIT,
-                                                        loadOp,
-                                                        vk.VK_ATTACHMENT_STORE_OP_STORE,
-                                                        vk.VK_ATTACHMENT_LOAD_OP_DONT_CARE,
-                                                        vk.VK_ATTACHMENT_STORE_OP_DONT_CARE,
-                                                        initial_layout,
-                                                        final_layout) )
+        if multisampled:
+            # the samples are discarded after the resolve to attachment 2
+            attachments.append( vk.AttachmentDescription(0, self.format,
+                                                            self.sample_count,
+                                                            loadOp,
+                                                            vk.VK_ATTACHMENT_STORE_OP_DONT_CARE,
+                                                            vk.VK_ATTACHMENT_LOAD_OP_DONT_CARE,
+                                                            vk.VK_ATTACHMENT_STORE_OP_DONT_CARE,
+                                                            vk.VK_IMAGE_LAYOUT_UNDEFINED,
+                                                            vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL) )
+        else:
+            attachments.append( vk.AttachmentDescription(0, self.format,
+                                                            vk.VK_SAMPLE_COUNT_1_BIT,
+                                                            loadOp,
+                                                            vk.VK_ATTACHMENT_STORE_OP_STORE,
+                                                            vk.VK_ATTACHMENT_LOAD_OP_DONT_CARE,
+                                                            vk.VK_ATTACHMENT_STORE_OP_DONT_CARE,
+                                                            initial_layout,
+                                                            final_layout) )
 
         attachments.append( vk.AttachmentDescription(0, self.depth_format,
-                                                        vk.VK_SAMPLE_COUNT_1_BIT,
+                                                        self.sample_count,
                                                         loadOp,
                                                         vk.VK_ATTACHMENT_STORE_OP_STORE,
                                                         vk.VK_ATTACHMENT_LOAD_OP_LOAD,
@@ -542,29 +632,41 @@ class VkContextManager:
                                                         vk.VK_IMAGE_LAYOUT_DEPTH_STENCIL_ATTACHMENT_OPTIMAL,
                                                         vk.VK_IMAGE_LAYOUT_DEPTH_STENCIL_ATTACHMENT_OPTIMAL) )
 
+        # the depth buffer is shared by the frames in flight, the clear of a frame waits for the depth writes of the previous one
         dependencies = vk.VkSubpassDependencyVector()
         dependencies.append(vk.SubpassDependency(
             vk.VK_SUBPASS_EXTERNAL,
             0,
-            vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT,
-            vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT,
-            0,
-            vk.VK_ACCESS_COLOR_ATTACHMENT_READ_BIT | vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT,
+            vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT | vk.VK_PIPELINE_STAGE_LATE_FRAGMENT_TESTS_BIT,
+            vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT | vk.VK_PIPELINE_STAGE_EARLY_FRAGMENT_TESTS_BIT,
+            vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT,
+            vk.VK_ACCESS_COLOR_ATTACHMENT_READ_BIT | vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT | vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_READ_BIT | vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT,
             vk.VK_DEPENDENCY_BY_REGION_BIT))
 
         color_attachments = vk.VkAttachmentReferenceVector(1,vk.AttachmentReference(0,vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL))
         depth_attachment = vk.AttachmentReference(1,vk.VK_IMAGE_LAYOUT_DEPTH_STENCIL_ATTACHMENT_OPTIMAL)
+        resolve_attachments = vk.VkAttachmentReferenceVector()
+        if multisampled:
+            attachments.append( vk.AttachmentDescription(0, self.format,
+                                                            vk.VK_SAMPLE_COUNT_1_BIT,
+                                                            vk.VK_ATTACHMENT_LOAD_OP_DONT_CARE,
+                                                            vk.VK_ATTACHMENT_STORE_OP_STORE,
+                                                            vk.VK_ATTACHMENT_LOAD_OP_DONT_CARE,
+                                                            vk.VK_ATTACHMENT_STORE_OP_DONT_CARE,
+                                                            initial_layout,
+                                                            final_layout) )
+            resolve_attachments.append( vk.AttachmentReference(2,vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL) )
 
         subpasses = vk.VkSubpassDescriptionVector()
-        subpasses.append(  vk.SubpassDescription(0, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vk.VkAttachmentReferenceVector(), color_attachments, vk.VkAttachmentReferenceVector(), depth_attachment, []) )
+        subpasses.append(  vk.SubpassDescription(0, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vk.VkAttachmentReferenceVector(), color_attachments, resolve_attachments, depth_attachment, []) )
         self.render_pass = self.ESP( vk.createRenderPass(self.device, vk.RenderPassCreateInfo(0, attachments, subpasses, dependencies)) )
 
     def init_shaders(self, vertex_shader_text, frag_shader_text):
         if vertex_shader_text is not None and len(vertex_shader_text) > 0:
-            spv = glsl_to_spv(pyglslang.EShLangVertex, vertex_shader_text)
+            spv = cached_glsl_to_spv(pyglslang.EShLangVertex, vertex_shader_text)
             self.vertex_shader = self.ESP( vk.createShaderModule(self.device, vk.ShaderModuleCreateInfo(0, spv)) )
         if frag_shader_text is not None and len(frag_shader_text) > 0:
-            spv = glsl_to_spv(pyglslang.EShLangFragment, frag_shader_text)
+            spv = cached_glsl_to_spv(pyglslang.EShLangFragment, frag_shader_text)
             self.fragment_shader = self.ESP( vk.createShaderModule(self.device, vk.ShaderModuleCreateInfo(0, spv)) )
 
     def init_framebuffer(self):
@@ -572,19 +674,257 @@ class VkContextManager:
         self.framebuffers = []
         for img_view in self.image_views:
             attachments = vk.VkImageViewVector()
-            attachments.append(img_view)
-            attachments.append(self.depth_view)
+            if self.sample_count != vk.VK_SAMPLE_COUNT_1_BIT:
+                attachments.append(self.multisample_color_view)
+                attachments.append(self.depth_view)
+                attachments.append(img_view)
+            else:
+                attachments.append(img_view)
+                attachments.append(self.depth_view)
             self.framebuffers.append( self.ESP( vk.createFramebuffer(self.device, vk.FramebufferCreateInfo(0, self.render_pass, attachments, w, h, 1)) ) )
 
-    def init_vertex_buffer(self, coords):
-        self.vertex_buffer = self.ESP(vk.createBuffer( self.device, vk.BufferCreateInfo(0, coords.nbytes, vk.VK_BUFFER_USAGE_VERTEX_BUFFER_BIT, vk.VK_SHARING_MODE_EXCLUSIVE, [])))
-        mem_reqs = vk.getBufferMemoryRequirements(self.device, self.vertex_buffer)
-        memory_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT|vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT)
-        self.vertex_buffer_mem = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, memory_type_index)) )
-        with vkunmapping( vk.mapMemory(self.device, self.vertex_buffer_mem , 0, mem_reqs.size, 0) ) as mapped_array:
-            np.copyto(np.frombuffer(mapped_array.mem,dtype=np.single, count=len(coords.flat)), coords.flat)
-
-        vk.bindBufferMemory(self.device, self.vertex_buffer, self.vertex_buffer_mem, 0)
+    # buffer released with the context or with stack, device local buffers are filled by the staging ring
+    def create_mesh_buffer(self, usage, size, device_local, stack = None):
+        if stack is None:
+            stack = self.stack
+        if device_local:
+            buffer = vk.createBuffer(self.device, vk.BufferCreateInfo(0, size, usage | vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT, vk.VK_SHARING_MODE_EXCLUSIVE, []))
+            stack.callback(delete_this, buffer)
+            self.bind_buffer_memory(buffer, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT, stack = stack)
+            return buffer, None
+        mapped_buffer = self.create_mapped_buffer(usage, np.uint8, size, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT|vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT, stack)
+        return mapped_buffer.buffer, mapped_buffer
+
+    def write_mesh_buffer(self, buffer, mapped_buffer, data, offset):
+        if mapped_buffer is None:
+            self.staging.upload_buffer(buffer, data, offset)
+        else:
+            mapped_buffer.array[offset:offset + data.nbytes] = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+
+    # meshes is a list of (vertices, indices) numpy arrays, indices is None or a uint16 or uint32 array
+    # all the meshes are packed in one vertex buffer and one index buffer uploaded by a single staging batch
+    # on unified memory devices the buffers are written in place instead
+    # the buffers are released by MeshBuffers.close() or with stack, the context by default
+    def upload_meshes(self, meshes, stack = None):
+        ranges = []
+        vertex_size = 0
+        index_size = 0
+        for vertices, indices in meshes:
+            # multiple of the stride so that the offset can be expressed in vertices by indirect draws
+            vertex_offset = align_up(vertex_size, vertices.nbytes // vertices.shape[0])
+            vertex_size = vertex_offset + vertices.nbytes
+            if indices is None:
+                ranges.append( MeshRange(vertex_offset, vertices.shape[0], vertices.nbytes // vertices.shape[0], 0, 0, None) )
+            else:
+                index_offset = align_up(index_size, 4)
+                index_size = index_offset + indices.nbytes
+                ranges.append( MeshRange(vertex_offset, vertices.shape[0], vertices.nbytes // vertices.shape[0], index_offset, indices.size, INDEX_TYPES[indices.dtype]) )
+
+        device_local = not self.memory_types.is_unified()
+        mesh_stack = ExitStack()
+        try:
+            vertex_buffer, mapped_vertices = self.create_mesh_buffer(vk.VK_BUFFER_USAGE_VERTEX_BUFFER_BIT, vertex_size, device_local, mesh_stack)
+            index_buffer, mapped_indices = None, None
+            if index_size > 0:
+                index_buffer, mapped_indices = self.create_mesh_buffer(vk.VK_BUFFER_USAGE_INDEX_BUFFER_BIT, index_size, device_local, mesh_stack)
+
+            for (vertices, indices), mesh_range in zip(meshes, ranges):
+                self.write_mesh_buffer(vertex_buffer, mapped_vertices, vertices, mesh_range.vertex_offset)
+                if indices is not None:
+                    self.write_mesh_buffer(index_buffer, mapped_indices, indices, mesh_range.index_offset)
+
+            if device_local:
+                self.staging.flush()
+            else:
+                for mapped_buffer in [mapped_vertices, mapped_indices]:
+                    if mapped_buffer is not None:
+                        mapped_buffer.flush()
+        except:
+            mesh_stack.close()
+            raise
+        (self.stack if stack is None else stack).callback(mesh_stack.close)
+        return MeshBuffers(vertex_buffer, index_buffer, ranges, device_local, mesh_stack)
+
+    def init_vertex_buffer(self, coords, indices = None):
+        previous = self.mesh_buffers
+        self.mesh_buffers = self.upload_meshes([(coords, indices)])
+        self.vertex_buffer = self.mesh_buffers.vertex_buffer
+        self.index_buffer = self.mesh_buffers.index_buffer
+        self.mesh_range = self.mesh_buffers.ranges[0]
+        self.invalidate_recorded_frames()
+        # the recorded frames using the previous buffers are gone, only the submissions in flight can still read them
+        if previous is not None:
+            vk.queueWaitIdle(self.device_queue)
+            previous.close()
+
+    # (N,4,4) float32 model matrices read per instance by the instanced pipeline
+    # the buffer stays mapped, the transforms can be animated in place through its array then flush()
+    # released with the context, or with stack e.g. a local ExitStack
+    def create_instance_buffer(self, transforms, stack = None):
+        instance_buffer = self.create_mapped_buffer(vk.VK_BUFFER_USAGE_VERTEX_BUFFER_BIT, np.single, (len(transforms),4,4),
+                                                    vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT|vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT, stack)
+        instance_buffer.array[...] = transforms
+        instance_buffer.flush()
+        return instance_buffer
+
+    # mapped so that e.g. a CPU culling pass can rewrite instanceCount in place before each submit
+    # released with the context, or with stack e.g. a local ExitStack
+    def create_indirect_buffer(self, commands, stack = None):
+        indirect_buffer = self.create_mapped_buffer(vk.VK_BUFFER_USAGE_INDIRECT_BUFFER_BIT, DRAW_INDEXED_INDIRECT_COMMAND, len(commands),
+                                                    vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT|vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT, stack)
+        indirect_buffer.array[...] = commands
+        indirect_buffer.flush()
+        return indirect_buffer
+
+    # draws all the commands of the indirect buffer from the shared buffers of mesh_buffers
+    # a single vkCmdDrawIndexedIndirect when multiDrawIndirect is supported, one per command otherwise
+    def record_draw_indirect(self, command_buffer, mesh_buffers, indirect_buffer):
+        index_type = mesh_ranges_index_type(mesh_buffers.ranges)
+        vk.cmdBindVertexBuffers(command_buffer, 0, vk.VkBufferVector(1,mesh_buffers.vertex_buffer), vk.VkDeviceSizeVector(1,0))
+        vk.cmdBindIndexBuffer(command_buffer, mesh_buffers.index_buffer, 0, index_type)
+        draw_count = indirect_buffer.shape[0]
+        stride = DRAW_INDEXED_INDIRECT_COMMAND.itemsize
+        if self.enabled_features.multiDrawIndirect:
+            max_draw_count = self.gpu_props.limits.maxDrawIndirectCount
+            for first in range(0, draw_count, max_draw_count):
+                vk.cmdDrawIndexedIndirect(command_buffer, indirect_buffer.buffer, first * stride, min(max_draw_count, draw_count - first), stride)
+        else:
+            for first in range(draw_count):
+                vk.cmdDrawIndexedIndirect(command_buffer, indirect_buffer.buffer, first * stride, 1, stride)
+
+    # binds the vertex and index buffers of the context mesh and records an indexed or non indexed draw
+    # with an instance_buffer all its instances are drawn by this single draw, self.instanced_pipeline must be bound
+    def record_draw(self, command_buffer = None, instance_count = 1, instance_buffer = None):
+        if command_buffer is None:
+            command_buffer = self.command_buffers[0]
+        mesh = self.mesh_range
+        if instance_buffer is None:
+            vk.cmdBindVertexBuffers(command_buffer, 0, vk.VkBufferVector(1,self.vertex_buffer), vk.VkDeviceSizeVector(1,mesh.vertex_offset))
+        else:
+            buffers = vk.VkBufferVector(1,self.vertex_buffer)
+            buffers.append(instance_buffer.buffer)
+            offsets = vk.VkDeviceSizeVector(1,mesh.vertex_offset)
+            offsets.append(0)
+            vk.cmdBindVertexBuffers(command_buffer, 0, buffers, offsets)
+            instance_count = instance_buffer.shape[0]
+        if mesh.index_type is not None:
+            vk.cmdBindIndexBuffer(command_buffer, self.index_buffer, mesh.index_offset, mesh.index_type)
+            vk.cmdDrawIndexed(command_buffer, mesh.index_count, instance_count, 0, 0, 0)
+        else:
+            vk.cmdDraw(command_buffer, mesh.vertex_count, instance_count, 0, 0)
+
+    # the render pass of the context pipeline drawing its mesh, the default content of a recorded frame
+    # with an instance_buffer every instance is drawn with its own model matrix by the instanced pipeline
+    def record_render_pass(self, command_buffer, instance_buffer = None):
+        vk.cmdBeginRenderPass(command_buffer, self.make_render_pass_begin_info(), vk.VK_SUBPASS_CONTENTS_INLINE)
+        if instance_buffer is None:
+            vk.cmdBindPipeline(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.pipeline[0])
+        else:
+            vk.cmdBindPipeline(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.instanced_pipeline[0])
+        vk.cmdBindDescriptorSets(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.pipeline_layout, 0, self.descriptor_set, [])
+        self.init_viewports(command_buffer)
+        self.init_scissors(command_buffer)
+        self.record_draw(command_buffer, instance_buffer = instance_buffer)
+        vk.cmdEndRenderPass(command_buffer)
+
+    # all the meshes are drawn by the draw commands of the indirect buffer, without one Python call per mesh
+    def record_indirect_render_pass(self, command_buffer, mesh_buffers, indirect_buffer):
+        vk.cmdBeginRenderPass(command_buffer, self.make_render_pass_begin_info(), vk.VK_SUBPASS_CONTENTS_INLINE)
+        vk.cmdBindPipeline(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.pipeline[0])
+        vk.cmdBindDescriptorSets(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.pipeline_layout, 0, self.descriptor_set, [])
+        self.init_viewports(command_buffer)
+        self.init_scissors(command_buffer)
+        self.record_draw_indirect(command_buffer, mesh_buffers, indirect_buffer)
+        vk.cmdEndRenderPass(command_buffer)
+
+    # (N,4,4) MVP matrices of the model matrices transforms with the view projection of the uniform buffer
+    def model_view_projections(self, transforms):
+        return np.matmul(transforms, self.uniform.array).astype(np.float32)
+
+    # one draw of the context mesh per MVP matrix in a push constant, inside a render pass
+    # binds the pipeline and sets the dynamic states so that it can also record a secondary command buffer
+    def record_push_constant_draws(self, command_buffer, mvps):
+        vk.cmdBindPipeline(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.push_constant_pipeline[0])
+        vk.cmdBindDescriptorSets(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, self.push_constant_pipeline_layout, 0, self.descriptor_set, [])
+        self.init_viewports(command_buffer)
+        self.init_scissors(command_buffer)
+        for mvp in mvps:
+            vk.cmdPushConstants(command_buffer, self.push_constant_pipeline_layout, vk.VK_SHADER_STAGE_VERTEX_BIT, 0, mvp)
+            self.record_draw(command_buffer)
+
+    # the render pass of the context with one draw of its mesh per MVP matrix, recorded inline
+    def record_push_constant_render_pass(self, command_buffer, mvps):
+        vk.cmdBeginRenderPass(command_buffer, self.make_render_pass_begin_info(), vk.VK_SUBPASS_CONTENTS_INLINE)
+        self.record_push_constant_draws(command_buffer, mvps)
+        vk.cmdEndRenderPass(command_buffer)
+
+    # a recorded frame is kept until the resources it binds change, resize(), init_vertex_buffer() and init_pipeline()
+    # call this, call it too when other resources bound by a record_frame function are replaced
+    def invalidate_recorded_frames(self):
+        self.recorded_frames = {}
+
+    # records record_frame(command_buffer) followed by the readback copy of the offscreen output in the command buffer
+    # of the current framebuffer, it is recorded without ONE_TIME_SUBMIT so it can be submitted again and again
+    def record_reusable_frame(self, record_frame):
+        if self.recorded_frame_command_buffers is None:
+            cbai = vk.CommandBufferAllocateInfo(self.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY, len(self.framebuffers))
+            self.recorded_frame_command_buffers = self.ESP( vk.allocateCommandBuffers(self.device, cbai) )
+        command_buffer = self.recorded_frame_command_buffers[self.current_buffer]
+        vk.resetCommandBuffer(command_buffer, 0)
+        vk.beginCommandBuffer(command_buffer, vk.CommandBufferBeginInfo(0, None))
+        record_frame(command_buffer)
+        if self.surface_type == VkContextManager.VKC_OFFSCREEN:
+            self.stage_readback_copy(command_buffer)
+        vk.endCommandBuffer(command_buffer)
+        self.recorded_frames[self.current_buffer] = record_frame
+        return command_buffer
+
+    # renders an offscreen frame from its recorded command buffer, it is recorded on the first call and after an invalidation
+    # for a fixed scene the per frame work is the uniform update by the caller and one submit
+    # pass the same record_frame callable on every call, a new lambda each frame defeats the reuse
+    def render_recorded_frame(self, record_frame = None):
+        assert(self.surface_type == VkContextManager.VKC_OFFSCREEN)
+        if record_frame is None:
+            record_frame = self.record_render_pass
+        self.init_presentable_image()
+        if self.recorded_frames.get(self.current_buffer) != record_frame:
+            self.record_reusable_frame(record_frame)
+        self.submit_and_wait(vk.VkCommandBufferVector(1, self.recorded_frame_command_buffers[self.current_buffer]))
+        return self.readback_map_copy()
+
+    # renders a one time offscreen frame recorded by record_frame(command_buffer) in the first command buffer
+    # returns the readback array, see render_recorded_frame to submit the same frame again and again
+    def render_offscreen_frame(self, record_frame = None):
+        assert(self.surface_type == VkContextManager.VKC_OFFSCREEN)
+        if record_frame is None:
+            record_frame = self.record_render_pass
+        command_buffer = self.command_buffers[0]
+        self.init_presentable_image()
+        vk.resetCommandBuffer(command_buffer, 0)
+        vk.beginCommandBuffer(command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, None))
+        record_frame(command_buffer)
+        self.stage_readback_copy(command_buffer)
+        vk.endCommandBuffer(command_buffer)
+        self.submit_and_wait()
+        return self.readback_map_copy()
+
+    # the context mesh drawn once per (4,4) model matrix of transforms by a single instanced draw
+    # the instance buffer only lives for the frame, keep one from create_instance_buffer to animate it in place
+    def render_instanced(self, transforms):
+        if not hasattr(self, 'instanced_pipeline'):
+            self.init_instanced_pipeline()
+        with ExitStack() as stack:
+            instance_buffer = self.create_instance_buffer(transforms, stack)
+            return self.render_offscreen_frame(lambda command_buffer: self.record_render_pass(command_buffer, instance_buffer))
+
+    # meshes is a list of (vertices, indices) uploaded by upload_meshes and drawn from one indirect buffer
+    # the buffers only live for the frame, to draw the same meshes again and again upload them once with upload_meshes
+    # and create_indirect_buffer then record record_indirect_render_pass in each frame
+    def render_indirect(self, meshes):
+        with ExitStack() as stack:
+            mesh_buffers = self.upload_meshes(meshes, stack)
+            indirect_buffer = self.create_indirect_buffer(draw_indexed_indirect_commands(mesh_buffers.ranges), stack)
+            return self.render_offscreen_frame(lambda command_buffer: self.record_indirect_render_pass(command_buffer, mesh_buffers, indirect_buffer))
 
     def init_descriptor_pool(self):
         pool_sizes = vk.VkDescriptorPoolSizeVector()
@@ -610,29 +950,89 @@ class VkContextManager:
                                              0, # dstArrayElements
                                              1,
                                              vk.VK_DESCRIPTOR_TYPE_COMBINED_IMAGE_SAMPLER,
-                                             vk.VkDescriptorImageInfoVector(1,vk.DescriptorImageInfo(self.sampler, self.tex_img_view, vk.VK_IMAGE_LAYOUT_GENERAL)),
+                                             vk.VkDescriptorImageInfoVector(1,vk.DescriptorImageInfo(self.sampler, self.tex_img_view, vk.VK_IMAGE_LAYOUT_SHADER_READ_ONLY_OPTIMAL)),
                                              vk.VkDescriptorBufferInfoVector(),
                                              vk.VkBufferViewVector()) )
         vk.updateDescriptorSets(self.device, writes, vk.VkCopyDescriptorSetVector())
 
+    # one file per driver, the name is only a hint the header is always validated
+    def pipeline_cache_path(self):
+        uuid = binascii.hexlify(bytes(bytearray(self.gpu_props.pipelineCacheUUID))).decode('ascii')
+        return os.path.join(self.pipeline_cache_dir, 'pipeline_cache_%08x_%08x_%s.bin' % (self.gpu_props.vendorID, self.gpu_props.deviceID, uuid))
+
+    def load_pipeline_cache_data(self):
+        if self.pipeline_cache_dir is None:
+            return b''
+        try:
+            with open(self.pipeline_cache_path(), 'rb') as cache_file:
+                data = cache_file.read()
+        except (IOError, OSError):
+            return b''
+        if not pipeline_cache_data_is_compatible(data, self.gpu_props):
+            warnings.warn('Ignoring incompatible pipeline cache ' + self.pipeline_cache_path())
+            return b''
+        return data
+
+    def save_pipeline_cache_data(self):
+        data = bytes(bytearray(vk.getPipelineCacheData(self.device, self.pipeline_cache)))
+        if data == self.pipeline_cache_initial_data:
+            return
+        try:
+            if not os.path.isdir(self.pipeline_cache_dir):
+                os.makedirs(self.pipeline_cache_dir)
+            atomic_write(self.pipeline_cache_path(), data)
+        except (IOError, OSError) as e:
+            warnings.warn('Failed to save the pipeline cache: ' + str(e))
+
     def init_pipeline_cache(self):
-        self.pipeline_cache = self.ESP( vk.createPipelineCache( self.device, vk.PipelineCacheCreateInfo(0, vk.uint8Vector()) ) )
+        self.pipeline_cache_initial_data = self.load_pipeline_cache_data()
+        self.pipeline_cache = self.ESP( vk.createPipelineCache( self.device, vk.PipelineCacheCreateInfo(0, vk.uint8Vector(list(bytearray(self.pipeline_cache_initial_data)))) ) )
         assert(self.pipeline_cache is not None)
-
-    def init_pipeline(self, vertex_buffer_stride_bytes):
+        if self.pipeline_cache_dir is not None:
+            # registered after the cache so it is called before the cache is destroyed
+            self.stack.callback(self.save_pipeline_cache_data)
+
+    def init_pipeline(self, vertex_layout = None):
+        if vertex_layout is None:
+            vertex_layout = self.vertex_layout
+        self.pipeline = self.create_graphics_pipeline(self.vertex_shader, vertex_layout)
+        self.invalidate_recorded_frames()
+
+    # pipeline for record_draw(instance_buffer = ...), the model matrices are read from vertex binding 1
+    def init_instanced_pipeline(self, vertex_shader_path = 'vertex_shader_instanced.glsl'):
+        with open(vertex_shader_path,'r') as vs_in:
+            spv = cached_glsl_to_spv(pyglslang.EShLangVertex, vs_in.read())
+        self.instanced_vertex_shader = self.ESP( vk.createShaderModule(self.device, vk.ShaderModuleCreateInfo(0, spv)) )
+        self.instanced_pipeline = self.create_graphics_pipeline(self.instanced_vertex_shader, self.vertex_layout, INSTANCE_TRANSFORM)
+
+    # pipeline drawing the context mesh with the MVP matrix given by cmdPushConstants, see vkmultiview.py
+    def init_push_constant_pipeline(self, vertex_shader_path = 'vertex_shader_push_constant.glsl'):
+        with open(vertex_shader_path,'r') as vs_in:
+            spv = cached_glsl_to_spv(pyglslang.EShLangVertex, vs_in.read())
+        self.push_constant_vertex_shader = self.ESP( vk.createShaderModule(self.device, vk.ShaderModuleCreateInfo(0, spv)) )
+        push_constant_ranges = vk.VkPushConstantRangeVector(1, vk.PushConstantRange(vk.VK_SHADER_STAGE_VERTEX_BIT, 0, 64))
+        self.push_constant_pipeline_layout = self.ESP(vk.createPipelineLayout(self.device, vk.PipelineLayoutCreateInfo(0, vk.VkDescriptorSetLayoutVector(1,self.desc_layout), push_constant_ranges)))
+        self.push_constant_pipeline = self.create_graphics_pipeline(self.push_constant_vertex_shader, self.vertex_layout, pipeline_layout = self.push_constant_pipeline_layout)
+
+    # instance_layout: optional VertexLayout of the per instance vertex binding 1
+    def create_graphics_pipeline(self, vertex_shader, vertex_layout, instance_layout = None, pipeline_layout = None):
+        if pipeline_layout is None:
+            pipeline_layout = self.pipeline_layout
         psscis = vk.VkPipelineShaderStageCreateInfoVector()
-        psscis.append(vk.PipelineShaderStageCreateInfo(0, vk.VK_SHADER_STAGE_VERTEX_BIT, self.vertex_shader, "main", None))
+        psscis.append(vk.PipelineShaderStageCreateInfo(0, vk.VK_SHADER_STAGE_VERTEX_BIT, vertex_shader, "main", None))
         psscis.append(vk.PipelineShaderStageCreateInfo(0, vk.VK_SHADER_STAGE_FRAGMENT_BIT, self.fragment_shader, "main", None))
 
         dynamic_states = vk.VkDynamicStateVector()
         dynamic_states.append( vk.VK_DYNAMIC_STATE_VIEWPORT )
         dynamic_states.append( vk.VK_DYNAMIC_STATE_SCISSOR )
         pdsci = vk.PipelineDynamicStateCreateInfo(0, dynamic_states)
-        vi_bindings = vk.VertexInputBindingDescription(0, vertex_buffer_stride_bytes, vk.VK_VERTEX_INPUT_RATE_VERTEX)
-        vi_attribs = vk.VkVertexInputAttributeDescriptionVector()
-        vi_attribs.append(vk.VertexInputAttributeDescription(0, 0, vk.VK_FORMAT_R32G32B32A32_SFLOAT, 0))
-        vi_attribs.append(vk.VertexInputAttributeDescription(1, 0, vk.VK_FORMAT_R32G32_SFLOAT, 16))
-        pvisci = vk.PipelineVertexInputStateCreateInfo(0, vk.VkVertexInputBindingDescriptionVector(1,vi_bindings), vi_attribs)
+        vi_bindings = vertex_layout.binding_descriptions()
+        vi_attribs = vertex_layout.attribute_descriptions()
+        if instance_layout is not None:
+            vi_bindings.append( instance_layout.binding_descriptions(1, vk.VK_VERTEX_INPUT_RATE_INSTANCE)[0] )
+            for attrib in instance_layout.attribute_descriptions(1):
+                vi_attribs.append(attrib)
+        pvisci = vk.PipelineVertexInputStateCreateInfo(0, vi_bindings, vi_attribs)
         piasci = vk.PipelineInputAssemblyStateCreateInfo(0, vk.VK_PRIMITIVE_TOPOLOGY_TRIANGLE_LIST, False)
         line_width = 1.0 # this must set to avoid a reported error
         prsci = vk.PipelineRasterizationStateCreateInfo(0, False, False, vk.VK_POLYGON_MODE_FILL, vk.VK_CULL_MODE_BACK_BIT, vk.VK_FRONT_FACE_CLOCKWISE, False, 0, 0, 0, line_width)
@@ -654,11 +1054,11 @@ class VkContextManager:
         pvsci = vk.PipelineViewportStateCreateInfo(0, vk.VkViewportVector(1), vk.VkRect2DVector(1))
         op = vk.StencilOpState(vk.VK_STENCIL_OP_KEEP,vk.VK_STENCIL_OP_KEEP,vk.VK_STENCIL_OP_KEEP,vk.VK_COMPARE_OP_ALWAYS,0,0,0)
         pdssci = vk.PipelineDepthStencilStateCreateInfo(0, True, True, vk.VK_COMPARE_OP_LESS_OR_EQUAL, False, False, op, op, 0, 0)
-        pmsci = vk.PipelineMultisampleStateCreateInfo(0, vk.VK_SAMPLE_COUNT_1_BIT, False, 0, None, False, False)
+        pmsci = vk.PipelineMultisampleStateCreateInfo(0, self.sample_count, False, 0, None, False, False)
 
         pipeline_cis = vk.VkGraphicsPipelineCreateInfoVector()
-        pipeline_cis.append( vk.GraphicsPipelineCreateInfo(0, psscis, pvisci, piasci, None, pvsci, prsci, pmsci, pdssci, pcbsci, pdsci, self.pipeline_layout, self.render_pass, 0, None, 0) )
-        self.pipeline = self.ESP( vk.createGraphicsPipelines(self.device, self.pipeline_cache, pipeline_cis) )
+        pipeline_cis.append( vk.GraphicsPipelineCreateInfo(0, psscis, pvisci, piasci, None, pvsci, prsci, pmsci, pdssci, pcbsci, pdsci, pipeline_layout, self.render_pass, 0, None, 0) )
+        return self.ESP( vk.createGraphicsPipelines(self.device, self.pipeline_cache, pipeline_cis) )
 
     def init_presentable_image(self):
         if self.swap_chain is not None:
@@ -667,7 +1067,9 @@ class VkContextManager:
             # with the offscreen image and no swap chain, we don't do double buffering so current buffer is always 0
             self.current_buffer = 0
 
-    def make_render_pass_begin_info(self):
+    def make_render_pass_begin_info(self, framebuffer = None):
+        if framebuffer is None:
+            framebuffer = self.framebuffers[self.current_buffer]
         w,h = self.get_surface_extent()
 
         clear_color_val = vk.VkClearValue()
@@ -682,127 +1084,128 @@ class VkContextManager:
         clear_values.append( clear_color_val )
         clear_values.append( clear_depth_val )
 
-        return vk.RenderPassBeginInfo(self.render_pass, self.framebuffers[self.current_buffer], vk.Rect2D(vk.Offset2D(0,0), vk.Extent2D(w,h)), clear_values)
+        return vk.RenderPassBeginInfo(self.render_pass, framebuffer, vk.Rect2D(vk.Offset2D(0,0), vk.Extent2D(w,h)), clear_values)
 
-    def init_viewports(self):
+    def init_viewports(self, command_buffer = None):
+        if command_buffer is None:
+            command_buffer = self.command_buffers[0]
         w,h = self.get_surface_extent()
-        vk.cmdSetViewport(self.command_buffers[0], 0, vk.VkViewportVector(1, vk.Viewport(0, 0, w, h, 0.0, 1.0)))
+        vk.cmdSetViewport(command_buffer, 0, vk.VkViewportVector(1, vk.Viewport(0, 0, w, h, 0.0, 1.0)))
 
-    def init_scissors(self):
+    def init_scissors(self, command_buffer = None):
+        if command_buffer is None:
+            command_buffer = self.command_buffers[0]
         w,h = self.get_surface_extent()
-        vk.cmdSetScissor(self.command_buffers[0], 0, vk.VkRect2DVector(1, vk.Rect2D(vk.Offset2D(0,0), vk.Extent2D(w,h))))
+        vk.cmdSetScissor(command_buffer, 0, vk.VkRect2DVector(1, vk.Rect2D(vk.Offset2D(0,0), vk.Extent2D(w,h))))
 
-    def init_readback_image(self):
-        w,h = self.get_surface_extent()
-        self.read_back_host_array = np.empty(shape=(h,4*w),dtype=np.uint8)
-        tex_format = vk.VK_FORMAT_R8G8B8A8_UNORM
+    # cached memory makes the CPU reads much faster, it is often not coherent so the readers call invalidate()
+    def create_readback_buffer(self, dtype, shape):
+        return MappedBuffer(self.allocator, vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT, dtype, shape, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, vk.VK_MEMORY_PROPERTY_HOST_CACHED_BIT)
 
-        ici = vk.ImageCreateInfo(   0,
-                                    vk.VK_IMAGE_TYPE_2D,
-                                    tex_format,
-                                    vk.Extent3D(w,h,1),
-                                    1,
-                                    1,
-                                    vk.VK_SAMPLE_COUNT_1_BIT,
-                                    vk.VK_IMAGE_TILING_LINEAR,
-                                    vk.VK_IMAGE_USAGE_TRANSFER_DST_BIT,
-                                    vk.VK_SHARING_MODE_EXCLUSIVE,
-                                    [],
-                                    vk.VK_IMAGE_LAYOUT_UNDEFINED)
-
-        self.readback_image =  self.ESP( vk.createImage(self.device, ici) )
-        mem_reqs = vk.getImageMemoryRequirements(self.device, self.readback_image)
-
-        mem_type_index = memory_type_from_properties(self.physical_devices[0], mem_reqs.memoryTypeBits, vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
-        assert(mem_type_index is not None)
-
-        self.readback_image_mem = self.ESP( vk.allocateMemory(self.device, vk.MemoryAllocateInfo(mem_reqs.size, mem_type_index) ) )
-        vk.bindImageMemory(self.device, self.readback_image, self.readback_image_mem, 0)
-
-        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-        img_mem_barrier = vk.ImageMemoryBarrier(0,
-                                                vk.VK_ACCESS_MEMORY_READ_BIT,
-                                                vk.VK_IMAGE_LAYOUT_UNDEFINED,
-                                                vk.VK_IMAGE_LAYOUT_GENERAL,
-                                                0, 0, self.readback_image, subresource_range)
-
-        vk.cmdPipelineBarrier(self.command_buffers[0],
-                              vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
-                              vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT, 0,
-                              vk.VkMemoryBarrierVector(),
-                              vk.VkBufferMemoryBarrierVector(),
-                              vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
-
-    def stage_readback_copy(self):
+    # readback buffer typed by COLOR_READBACK_FORMATS for the output image, with layer_count it holds as many images
+    def create_color_readback_buffer(self, layer_count = None):
         w,h = self.get_surface_extent()
-        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-        img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT,
-                                                vk.VK_ACCESS_TRANSFER_READ_BIT,
-                                                vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL,
-                                                vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL,
-                                                0, 0, self.images[self.current_buffer],
-                                                subresource_range)
-
-        vk.cmdPipelineBarrier(  self.command_buffers[0],
-                                vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT,
-                                vk.VK_PIPELINE_STAGE_TRANSFER_BIT, 0,
-                                vk.VkMemoryBarrierVector(),
-                                vk.VkBufferMemoryBarrierVector(),
-                                vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
+        dtype, components = COLOR_READBACK_FORMATS[self.format]
+        shape = (h,w,components) if components > 1 else (h,w)
+        if layer_count is not None:
+            shape = (layer_count,) + shape
+        return self.create_readback_buffer(dtype, shape)
 
-        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-        img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_MEMORY_READ_BIT,
-                                                vk.VK_ACCESS_TRANSFER_WRITE_BIT,
-                                                vk.VK_IMAGE_LAYOUT_GENERAL,
-                                                vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL,
-                                                0, 0, self.readback_image,
-                                                subresource_range)
-
-        vk.cmdPipelineBarrier(  self.command_buffers[0],
-                                vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
+    def init_readback_buffers(self):
+        w,h = self.get_surface_extent()
+        # tightly packed (h,w,components) color and (h,w) depth views of the mapped buffers
+        self.readback = self.create_color_readback_buffer()
+        self.stack.callback(self.readback.destroy)
+        self.readback_buffer = self.readback.buffer
+        self.readback_array = self.readback.array
+        self.read_back_host_array = self.readback_array.reshape((h,-1))
+
+        # a multisampled depth image can't be copied to a buffer
+        self.depth_readback = None
+        self.depth_readback_buffer = None
+        self.depth_readback_array = None
+        if self.sample_count == vk.VK_SAMPLE_COUNT_1_BIT:
+            self.depth_readback = self.create_readback_buffer(DEPTH_READBACK_DTYPES[self.depth_format], (h,w))
+            self.stack.callback(self.depth_readback.destroy)
+            self.depth_readback_buffer = self.depth_readback.buffer
+            self.depth_readback_array = self.depth_readback.array
+
+    # records the copy of the current output image to color_buffer, by default in command_buffers[0] to self.readback_buffer
+    # the depth attachment is copied only when a depth_buffer is passed
+    def stage_readback_copy(self, command_buffer = None, color_buffer = None, depth_buffer = None):
+        if command_buffer is None:
+            command_buffer = self.command_buffers[0]
+        if color_buffer is None:
+            color_buffer = self.readback_buffer
+        w,h = self.get_surface_extent()
+        color_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
+        depth_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_DEPTH_BIT, 0, 1, 0, 1)
+
+        img_mem_barriers = vk.VkImageMemoryBarrierVector()
+        img_mem_barriers.append( vk.ImageMemoryBarrier(vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT,
+                                                       vk.VK_ACCESS_TRANSFER_READ_BIT,
+                                                       vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL,
+                                                       vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL,
+                                                       0, 0, self.images[self.current_buffer], color_range) )
+        if depth_buffer is not None:
+            img_mem_barriers.append( vk.ImageMemoryBarrier(vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT,
+                                                           vk.VK_ACCESS_TRANSFER_READ_BIT,
+                                                           vk.VK_IMAGE_LAYOUT_DEPTH_STENCIL_ATTACHMENT_OPTIMAL,
+                                                           vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL,
+                                                           0, 0, self.depth_image, depth_range) )
+
+        vk.cmdPipelineBarrier(  command_buffer,
+                                vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT | vk.VK_PIPELINE_STAGE_LATE_FRAGMENT_TESTS_BIT,
                                 vk.VK_PIPELINE_STAGE_TRANSFER_BIT, 0,
                                 vk.VkMemoryBarrierVector(),
                                 vk.VkBufferMemoryBarrierVector(),
-                                vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
-
-        copy_regions = vk.VkImageCopyVector(1,vk.ImageCopy(vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_COLOR_BIT,0,0,1),
-                                                           vk.Offset3D(0,0,0),
-                                                           vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_COLOR_BIT,0,0,1),
-                                                           vk.Offset3D(0,0,0),
-                                                           vk.Extent3D(w,h,1)))
-
-        vk.cmdCopyImage(self.command_buffers[0], self.images[self.current_buffer], vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL, self.readback_image, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, copy_regions)
-
-        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, 1)
-        img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_TRANSFER_WRITE_BIT,
-                                                vk.VK_ACCESS_MEMORY_READ_BIT,
-                                                vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL,
-                                                vk.VK_IMAGE_LAYOUT_GENERAL,
-                                                0, 0, self.readback_image, subresource_range)
-
-        vk.cmdPipelineBarrier(  self.command_buffers[0],
+                                img_mem_barriers)
+
+        # bufferRowLength and bufferImageHeight set to 0 means tightly packed
+        color_region = vk.BufferImageCopy(0, 0, 0, vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_COLOR_BIT,0,0,1), vk.Offset3D(0,0,0), vk.Extent3D(w,h,1))
+        vk.cmdCopyImageToBuffer(command_buffer, self.images[self.current_buffer], vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL, color_buffer, vk.VkBufferImageCopyVector(1,color_region))
+        if depth_buffer is not None:
+            depth_region = vk.BufferImageCopy(0, 0, 0, vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_DEPTH_BIT,0,0,1), vk.Offset3D(0,0,0), vk.Extent3D(w,h,1))
+            vk.cmdCopyImageToBuffer(command_buffer, self.depth_image, vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL, depth_buffer, vk.VkBufferImageCopyVector(1,depth_region))
+
+        # back to the layouts expected by the render pass, the next frame can be recorded with the same attachments
+        img_mem_barriers = vk.VkImageMemoryBarrierVector()
+        img_mem_barriers.append( vk.ImageMemoryBarrier(vk.VK_ACCESS_TRANSFER_READ_BIT,
+                                                       vk.VK_ACCESS_COLOR_ATTACHMENT_READ_BIT | vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT,
+                                                       vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL,
+                                                       vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL,
+                                                       0, 0, self.images[self.current_buffer], color_range) )
+        if depth_buffer is not None:
+            img_mem_barriers.append( vk.ImageMemoryBarrier(vk.VK_ACCESS_TRANSFER_READ_BIT,
+                                                           vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_READ_BIT | vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT,
+                                                           vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL,
+                                                           vk.VK_IMAGE_LAYOUT_DEPTH_STENCIL_ATTACHMENT_OPTIMAL,
+                                                           0, 0, self.depth_image, depth_range) )
+        # makes the transfer writes visible to the host once the fence is signaled
+        host_barrier = vk.MemoryBarrier(vk.VK_ACCESS_TRANSFER_WRITE_BIT, vk.VK_ACCESS_HOST_READ_BIT)
+
+        vk.cmdPipelineBarrier(  command_buffer,
                                 vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
-                                vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT, 0,
-                                vk.VkMemoryBarrierVector(),
+                                vk.VK_PIPELINE_STAGE_HOST_BIT | vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT | vk.VK_PIPELINE_STAGE_EARLY_FRAGMENT_TESTS_BIT,
+                                0,
+                                vk.VkMemoryBarrierVector(1,host_barrier),
                                 vk.VkBufferMemoryBarrierVector(),
-                                vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
+                                img_mem_barriers)
 
-    # call after the queue as finished processing the above "stage_readback_copy" commands
+    # the readback buffers are persistently mapped, once the fence is signaled and the range invalidated
+    # self.readback_array and self.depth_readback_array hold the frame, no copy is made
     def readback_map_copy(self):
-        layout = vk.getImageSubresourceLayout(self.device, self.readback_image, vk.ImageSubresource(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 0))
-        with vkunmapping( vk.mapMemory2D(self.device,
-                                         self.readback_image_mem,
-                                         0, 0, np.dtype('ubyte').num,
-                                         self.read_back_host_array.shape[1],
-                                         self.read_back_host_array.shape[0],
-                                         layout.rowPitch ) ) as mapped_array:
-            assert(mapped_array.mem.strides[0] == layout.rowPitch)
-            np.copyto(self.read_back_host_array, mapped_array.mem)
+        self.readback.invalidate()
+        if self.depth_readback is not None:
+            self.depth_readback.invalidate()
+        return self.readback_array
 
+    # float formats are clamped to [0,1] and saved as 8 bits
     def save_readback_image(self,filename):
-        currshape = self.read_back_host_array.shape
-        reshaped_host_array = np.reshape(self.read_back_host_array,newshape=(currshape[0],currshape[1]//4,4))
-        im = Image.fromarray(reshaped_host_array,mode='RGBA')
+        img = self.readback_array
+        if img.dtype != np.uint8:
+            img = (np.clip(img.astype(np.float32), 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+        im = Image.fromarray(img, mode='RGBA' if img.ndim == 3 else 'L')
         im.save(filename)
 
     # Init stages
@@ -830,14 +1233,31 @@ class VkContextManager:
     def __del__(self):
         self.stack.close()
 
-    def __init__(self, init_stages = VKC_INIT_PIPELINE, surface_type = VKC_OFFSCREEN, widget = None, vertex_data = None, texture_file_path = None):
-        self.output_size = (512,512)
+    # pipeline_cache_dir: optional folder where the pipeline cache is loaded from and saved to, None to disable
+    # index_data: optional uint16 or uint32 indices into vertex_data, by default the cube is indexed
+    # vertex_layout: VertexLayout of vertex_data, the default matches get_xyzw_uv_cube_coords
+    # output_size: (width, height) of the offscreen output, see resize()
+    # color_format: offscreen output format, one of COLOR_READBACK_FORMATS, the window surface has its own format
+    # sample_count: VK_SAMPLE_COUNT_*_BIT, with more than one sample the render pass resolves to the output image
+    def __init__(self, init_stages = VKC_INIT_PIPELINE, surface_type = VKC_OFFSCREEN, widget = None, vertex_data = None, texture_file_path = None, pipeline_cache_dir = None, index_data = None, vertex_layout = XYZW_UV_FLOAT,
+                 output_size = (512,512), color_format = vk.VK_FORMAT_R8G8B8A8_UNORM, sample_count = vk.VK_SAMPLE_COUNT_1_BIT):
+        self.output_size = tuple(output_size)
+        self.color_format = color_format
+        self.sample_count = sample_count
+        self.size_dependent_stacks = OrderedDict()
+        self.recorded_frame_command_buffers = None
+        self.recorded_frames = {}
+        self.mesh_buffers = None
+        self.pipeline_cache_dir = pipeline_cache_dir
         self.init_stages = init_stages
         self.surface_type = surface_type
         self.widget = widget
         self.vertex_data = vertex_data
+        self.index_data = index_data
+        self.vertex_layout = vertex_layout
         if vertex_data is None:
-            self.vertex_data = get_xyzw_uv_cube_coords()
+            self.vertex_data, self.index_data = index_mesh(get_xyzw_uv_cube_coords())
+        assert(self.vertex_data.nbytes // len(self.vertex_data) == vertex_layout.stride)
         self.texture_file_path = texture_file_path
 
     def __enter__(self):
@@ -857,18 +1277,23 @@ class VkContextManager:
                     self.init_without_surface()
             if self.init_stages >= VkContextManager.VKC_INIT_DEVICE:
                 self.init_device()
+                self.init_memory_allocator()
             if self.init_stages >= VkContextManager.VKC_INIT_COMMAND_BUFFER:
                 self.init_command_buffers()
                 self.init_device_queue()
+                self.init_staging_ring()
             if self.init_stages >= VkContextManager.VKC_INIT_SWAP_CHAIN:
                 if self.surface_type == VkContextManager.VKC_OFFSCREEN:
-                    self.init_ouput_images()
-                    self.init_readback_image()
+                    self.init_size_dependent(self.init_ouput_images)
                 else:
                     self.init_swap_chain()
                     self.present_complete_semaphore = self.ESP( vk.createSemaphore(self.device, vk.SemaphoreCreateInfo(0)) )
+                if self.sample_count != vk.VK_SAMPLE_COUNT_1_BIT:
+                    self.init_size_dependent(self.init_multisample_color_image)
             if self.init_stages >= VkContextManager.VKC_INIT_DEPTH_BUFFER:
-                self.init_depth_buffer()
+                self.init_size_dependent(self.init_depth_buffer)
+                if self.surface_type == VkContextManager.VKC_OFFSCREEN:
+                    self.init_size_dependent(self.init_readback_buffers)
             if self.init_stages >= VkContextManager.VKC_INIT_TEXTURE:
                 self.init_image(self.texture_file_path)
                 self.init_sampler()
@@ -885,15 +1310,15 @@ class VkContextManager:
                     fs_txt = fs_in.read()
                 self.init_shaders(vs_txt, fs_txt)
             if self.init_stages >= VkContextManager.VKC_INIT_FRAMEBUFFER:
-                self.init_framebuffer()
+                self.init_size_dependent(self.init_framebuffer)
             if self.init_stages >= VkContextManager.VKC_INIT_VERTEX_BUFFER:
-                self.init_vertex_buffer(self.vertex_data)
+                self.init_vertex_buffer(self.vertex_data, self.index_data)
             if self.init_stages >= VkContextManager.VKC_INIT_DESCRIPTORS:
                 self.init_descriptor_pool()
                 self.init_descriptor_set()
             if self.init_stages >= VkContextManager.VKC_INIT_PIPELINE:
                 self.init_pipeline_cache()
-                self.init_pipeline(self.vertex_data[0].nbytes)
+                self.init_pipeline()
 
         except:
             self.stack.close()
@@ -903,3 +1328,43 @@ class VkContextManager:
 
     def __exit__(self, *exc_details):
         self.stack.close()
+
+    # the resources created by init_fn are pushed on their own ExitStack so that resize() can release and recreate them
+    # that stack is closed at the position of the first init_fn call when the context is unwound
+    def init_size_dependent(self, init_fn):
+        name = init_fn.__name__
+        parent = self.stack
+        self.stack = ExitStack()
+        try:
+            init_fn()
+        except:
+            self.stack.close()
+            raise
+        finally:
+            stack, self.stack = self.stack, parent
+        if name not in self.size_dependent_stacks:
+            self.stack.callback(lambda: self.size_dependent_stacks[name][1].close())
+        self.size_dependent_stacks[name] = (init_fn, stack)
+
+    # recreates the output images, depth buffer, framebuffers and readback buffers of the offscreen output
+    # the pipelines use dynamic viewports and scissors so they are kept, the command buffers must be recorded again
+    # objects created from the previous size e.g. a ReadbackRing or a MultiViewRenderer must be recreated too
+    def resize(self, width, height):
+        assert(self.surface_type == VkContextManager.VKC_OFFSCREEN)
+        if (width, height) == self.output_size:
+            return
+        vk.deviceWaitIdle(self.device)
+        for init_fn, stack in reversed(list(self.size_dependent_stacks.values())):
+            stack.close()
+        self.output_size = (width, height)
+
+        # the layout transitions are recorded in command_buffers[0] like during __enter__
+        vk.resetCommandBuffer(self.command_buffers[0], 0)
+        vk.beginCommandBuffer(self.command_buffers[0], vk.CommandBufferBeginInfo(0,None))
+        for init_fn, stack in list(self.size_dependent_stacks.values()):
+            self.init_size_dependent(init_fn)
+        vk.endCommandBuffer(self.command_buffers[0])
+        self.submit_and_wait()
+        vk.resetCommandBuffer(self.command_buffers[0], 0)
+        vk.beginCommandBuffer(self.command_buffers[0], vk.CommandBufferBeginInfo(0,None))
+        self.invalidate_recorded_frames()
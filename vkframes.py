@@ -0,0 +1,140 @@
+# Frames in flight: the CPU records the next frames while the GPU renders the previous ones
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+import numpy as np
+import vulkanmitts as vk
+from contextlib2 import ExitStack
+from vkmemory import delete_this
+
+class FrameSlot:
+    def __init__(self, index, command_buffer, fence, image_acquired, render_done):
+        self.index = index
+        self.command_buffer = command_buffer
+        self.fence = fence # signaled when the GPU is done with the frame, created signaled for the first use
+        self.image_acquired = image_acquired
+        self.render_done = render_done
+        self.readback = None # MappedBuffer the headless frames of the slot are copied to
+        self.frame = None
+
+# Each of the frames_in_flight slots has its own command buffer, fence and acquire / render done semaphores
+# render_frame() only blocks when the slot it reuses is still rendered, so the CPU stays frames_in_flight - 1 frames ahead
+# with a swap chain the images are acquired and presented, offscreen empty submissions signal and consume the
+# semaphores like the presentation engine so the same path runs headless, the slots share the single output image
+# of the context, the queue serializes their render passes, and each slot reads it back to its own buffer
+# data read by the GPU must not be shared by the slots, e.g. put the MVP in a push constant or index buffers by slot.index
+class FrameScheduler:
+    def ESP(self, obj):
+        self.stack.callback(delete_this, obj)
+        return obj
+
+    def __init__(self, vkc, frames_in_flight = 2):
+        self.vkc = vkc
+        self.frames_in_flight = frames_in_flight
+        self.frame_count = 0
+        self.slots = []
+        self.stack = ExitStack()
+        try:
+            cbai = vk.CommandBufferAllocateInfo(vkc.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY, frames_in_flight)
+            self.command_buffers = self.ESP( vk.allocateCommandBuffers(vkc.device, cbai) )
+            for i in range(frames_in_flight):
+                fence = self.ESP( vk.createFence(vkc.device, vk.FenceCreateInfo(vk.VK_FENCE_CREATE_SIGNALED_BIT)) )
+                image_acquired = self.ESP( vk.createSemaphore(vkc.device, vk.SemaphoreCreateInfo(0)) )
+                render_done = self.ESP( vk.createSemaphore(vkc.device, vk.SemaphoreCreateInfo(0)) )
+                self.slots.append( FrameSlot(i, self.command_buffers[i], fence, image_acquired, render_done) )
+                if vkc.swap_chain is None:
+                    self.slots[-1].readback = vkc.create_color_readback_buffer()
+                    self.stack.callback(self.slots[-1].readback.destroy)
+            # pushed last so that it runs first, nothing can be released while the GPU still uses it
+            self.stack.callback(self.wait_idle)
+        except:
+            self.stack.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    # the slot of the frame rendered by the next render_frame, or by the current one while it records
+    def current_slot(self):
+        return self.slots[self.frame_count % self.frames_in_flight]
+
+    def wait_slot(self, slot):
+        res = vk.waitForFencesStatus(self.vkc.device, vk.VkFenceVector(1, slot.fence), True)
+        assert(res == vk.VK_SUCCESS)
+
+    def acquire(self, slot):
+        vkc = self.vkc
+        if vkc.swap_chain is not None:
+            return vk.acquireNextImageKHR(vkc.device, vkc.swap_chain, 0xffffffffffffffff, slot.image_acquired, None)
+        vkc.submit(vk.VkCommandBufferVector(), None, signal_semaphores = vk.VkSemaphoreVector(1, slot.image_acquired))
+        return 0
+
+    def present(self, slot, image_index):
+        vkc = self.vkc
+        if vkc.swap_chain is not None:
+            present_info = vk.PresentInfoKHR(vk.VkSemaphoreVector(1, slot.render_done), vk.VkSwapchainKHRVector(1, vkc.swap_chain), [image_index], vk.VkResultVector())
+            vk.queuePresentKHR(vkc.device_queue, present_info)
+        else:
+            vkc.submit(vk.VkCommandBufferVector(), None, wait_semaphores = vk.VkSemaphoreVector(1, slot.render_done))
+
+    # record_frame(command_buffer, frame) records the frame for the image vkc.current_buffer
+    # returns the slot of the frame, its fence is signaled once the frame is rendered
+    def render_frame(self, record_frame, frame = None):
+        vkc = self.vkc
+        slot = self.current_slot()
+        self.wait_slot(slot)
+        vkc.current_buffer = self.acquire(slot)
+        vk.resetFences(vkc.device, vk.VkFenceVector(1, slot.fence))
+
+        vk.resetCommandBuffer(slot.command_buffer, 0)
+        vk.beginCommandBuffer(slot.command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, None))
+        record_frame(slot.command_buffer, frame)
+        vk.endCommandBuffer(slot.command_buffer)
+        vkc.submit(vk.VkCommandBufferVector(1, slot.command_buffer), slot.fence,
+                   wait_semaphores = vk.VkSemaphoreVector(1, slot.image_acquired),
+                   wait_stages = vk.VkFlagVector(1, vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT),
+                   signal_semaphores = vk.VkSemaphoreVector(1, slot.render_done))
+        self.present(slot, vkc.current_buffer)
+        slot.frame = frame
+        self.frame_count += 1
+        return slot
+
+    def wait_idle(self):
+        for slot in self.slots:
+            self.wait_slot(slot)
+
+    # a frame drawing the context mesh with the push constant pipeline, the MVP is in the command buffer
+    # so that the frames in flight don't share a uniform buffer, pass it as record_frame to render_frame
+    # headless the frame is copied to the readback buffer of its slot
+    def record_push_constant_frame(self, command_buffer, mvp):
+        vkc = self.vkc
+        vkc.record_push_constant_render_pass(command_buffer, [mvp])
+        if vkc.swap_chain is None:
+            vkc.stage_readback_copy(command_buffer, self.current_slot().readback.buffer)
+
+    # copy of the headless frame of slot, once it is rendered
+    def collect(self, slot):
+        self.wait_slot(slot)
+        slot.readback.invalidate()
+        return slot.readback.array.copy()
+
+    # headless run of the presentation loop, one frame per MVP matrix, returns the readback of every frame
+    # a frame is collected when its slot is reused, the frames_in_flight last ones at the end
+    def render_push_constant_frames(self, mvps):
+        if not hasattr(self.vkc, 'push_constant_pipeline'):
+            self.vkc.init_push_constant_pipeline()
+        images = []
+        in_flight = []
+        for mvp in np.asarray(mvps, dtype=np.float32):
+            if len(in_flight) == self.frames_in_flight:
+                images.append(self.collect(in_flight.pop(0)))
+            in_flight.append(self.render_frame(self.record_push_constant_frame, mvp))
+        for slot in in_flight:
+            images.append(self.collect(slot))
+        return images
@@ -0,0 +1,307 @@
+# Device memory sub-allocation for vulkanmitts
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+import bisect
+import numpy as np
+import vulkanmitts as vk
+
+# Calling vk.allocateMemory for every resource doesn't scale: maxMemoryAllocationCount can be as low as 4096
+# and the allocation itself is slow on most drivers. Instead we allocate large blocks per memory type
+# and hand out (offset,size) ranges from them.
+DEFAULT_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Resources kind, linear resources (buffers and linear images) and optimal images are never placed in the same block
+# this way we never have to deal with VkPhysicalDeviceLimits::bufferImageGranularity
+KIND_LINEAR = 0
+KIND_OPTIMAL = 1
+
+# Ranking applied to the memory types that have all the required properties, after the caller's preferred properties
+DEFAULT_PREFERENCES = (vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT,
+                       vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT | vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT)
+
+# Ranking of the memory types when HOST_VISIBLE is required e.g. uniform, staging and readback buffers
+# on discrete cards the device local and host visible types are the small uncached BAR heap, slow to read from the host
+# so they are ranked last unless the caller prefers DEVICE_LOCAL explicitly
+HOST_VISIBLE_PREFERENCES = (vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT,
+                            vk.VK_MEMORY_PROPERTY_HOST_CACHED_BIT)
+HOST_VISIBLE_AVOIDED = vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
+
+# the VkResult errors on which the allocator falls back on the next memory type, any other error is raised
+OUT_OF_MEMORY_RESULTS = (vk.VK_ERROR_OUT_OF_DEVICE_MEMORY, vk.VK_ERROR_OUT_OF_HOST_MEMORY)
+
+def is_out_of_memory_error(error):
+    return isinstance(error, vk.VkError) and error.result in OUT_OF_MEMORY_RESULTS
+
+def align_up(value, alignment):
+    if alignment <= 1:
+        return value
+    return (value + alignment - 1) // alignment * alignment
+
+def delete_this(obj):
+    if hasattr(obj,'this'):
+        del obj.this
+
+# Memory type lookup table built once per physical device from the cached VkPhysicalDeviceMemoryProperties
+# the property flags are copied out of the SWIG wrappers so that a lookup never goes through the bindings
+class MemoryTypeTable:
+    def __init__(self, memory_properties, preferences = DEFAULT_PREFERENCES, host_visible_preferences = HOST_VISIBLE_PREFERENCES):
+        self.property_flags = [memory_properties.memoryTypes[i].propertyFlags for i in range(memory_properties.memoryTypeCount)]
+        self.heap_indices = [memory_properties.memoryTypes[i].heapIndex for i in range(memory_properties.memoryTypeCount)]
+        self.heap_sizes = [memory_properties.memoryHeaps[i].size for i in range(memory_properties.memoryHeapCount)]
+        self.heap_flags = [memory_properties.memoryHeaps[i].flags for i in range(memory_properties.memoryHeapCount)]
+        self.preferences = preferences
+        self.host_visible_preferences = host_visible_preferences
+        self.ranked_cache = {}
+
+    # all the memory types allowed by memory_type_bits that have the required properties, best first
+    def ranked(self, memory_type_bits, properties, preferred = 0):
+        key = (memory_type_bits, properties, preferred)
+        ranking = self.ranked_cache.get(key)
+        if ranking is None:
+            candidates = [i for i,flags in enumerate(self.property_flags) if (memory_type_bits >> i) & 1 == 1 and (flags & properties) == properties]
+            if properties & vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT:
+                preferences = self.host_visible_preferences
+                avoided = HOST_VISIBLE_AVOIDED & ~preferred
+            else:
+                preferences = self.preferences
+                avoided = 0
+            def rank(i):
+                flags = self.property_flags[i]
+                # types are listed by the driver in order of performance, so the index is the last criteria
+                return ((flags & preferred) != preferred, (flags & avoided) != 0) + tuple((flags & p) != p for p in preferences) + (i,)
+            ranking = tuple(sorted(candidates, key=rank))
+            self.ranked_cache[key] = ranking
+        return ranking
+
+    def find(self, memory_type_bits, properties, preferred = 0):
+        ranking = self.ranked(memory_type_bits, properties, preferred)
+        return ranking[0] if len(ranking) > 0 else None
+
+    # integrated GPUs and software rasterizers: all the device local memory types are also host visible
+    # on these devices a staging copy only costs an extra transfer
+    def is_unified(self):
+        device_local = [f for f in self.property_flags if f & vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT]
+        return len(device_local) > 0 and all(f & vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT for f in device_local)
+
+    def heap_size(self, memory_type_index):
+        return self.heap_sizes[self.heap_indices[memory_type_index]]
+
+class Allocation:
+    def __init__(self, block, offset, size):
+        self.block = block
+        self.offset = offset
+        self.size = size
+
+    @property
+    def memory(self):
+        return self.block.memory
+
+    # flat ubyte view on the allocated range, the block stays mapped while any view on it is alive
+    # the views keep the VkDeviceMemory alive, but once the allocation is freed its range can be handed out again
+    def mapped(self):
+        return self.block.map()[self.offset:self.offset + self.size]
+
+    # strided view on a linear image, row_pitch and subresource_offset come from vk.getImageSubresourceLayout
+    def mapped_2d(self, width_bytes, height, row_pitch, subresource_offset=0):
+        start = self.offset + subresource_offset
+        rows = self.block.map()[start:start + row_pitch * height].reshape((height, row_pitch))
+        return rows[:, :width_bytes]
+
+    def free(self):
+        if self.block is not None:
+            self.block.release(self)
+            self.block = None
+
+# Buffer with a typed numpy view on its persistently mapped memory, the view stays valid until destroy()
+# writes are plain numpy assignments to self.array, flush() and invalidate() are no-ops on coherent memory
+class MappedBuffer:
+    def __init__(self, allocator, usage, dtype, shape, properties = vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT, preferred = vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT):
+        self.allocator = allocator
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape) if hasattr(shape, '__len__') else (shape,)
+        self.size = self.dtype.itemsize * int(np.prod(self.shape))
+        self.buffer = vk.createBuffer(allocator.device, vk.BufferCreateInfo(0, self.size, usage, vk.VK_SHARING_MODE_EXCLUSIVE, []))
+        try:
+            self.allocation = allocator.allocate_for_buffer(self.buffer, properties, preferred)
+        except:
+            del self.buffer.this
+            raise
+        flags = allocator.memory_types.property_flags[self.allocation.block.memory_type_index]
+        self.coherent = (flags & vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT) != 0
+        self.array = np.frombuffer(self.allocation.mapped(), dtype=self.dtype, count=int(np.prod(self.shape))).reshape(self.shape)
+
+    # the range is in bytes relative to the start of the buffer, it is expanded to nonCoherentAtomSize boundaries
+    def mapped_range(self, offset, size):
+        if size is None:
+            size = self.size - offset
+        atom = self.allocator.non_coherent_atom_size
+        start = (self.allocation.offset + offset) // atom * atom
+        end = min(align_up(self.allocation.offset + offset + size, atom), self.allocation.block.size)
+        return vk.VkMappedMemoryRangeVector(1, vk.MappedMemoryRange(self.allocation.memory, start, end - start))
+
+    # call after writing to self.array, before the GPU reads the buffer
+    def flush(self, offset = 0, size = None):
+        if not self.coherent:
+            vk.flushMappedMemoryRanges(self.allocator.device, self.mapped_range(offset, size))
+
+    # call after the GPU wrote to the buffer, before reading self.array
+    def invalidate(self, offset = 0, size = None):
+        if not self.coherent:
+            vk.invalidateMappedMemoryRanges(self.allocator.device, self.mapped_range(offset, size))
+
+    def destroy(self):
+        self.array = None
+        if self.allocation is not None:
+            self.allocation.free()
+            self.allocation = None
+        if hasattr(self.buffer, 'this'):
+            del self.buffer.this
+
+class MemoryBlock:
+    def __init__(self, allocator, memory_type_index, size, kind, dedicated=False):
+        self.allocator = allocator
+        self.memory_type_index = memory_type_index
+        self.size = size
+        self.kind = kind
+        self.dedicated = dedicated
+        self.memory = vk.allocateMemory(allocator.device, vk.MemoryAllocateInfo(size, memory_type_index))
+        # free list of (offset, size) tuples sorted by offset, adjacent free ranges are always coalesced
+        self.free_ranges = [(0, size)]
+        self.allocation_count = 0
+        self.used = 0
+        self.mapped_array = None
+
+    def try_allocate(self, size, alignment):
+        for i, (free_offset, free_size) in enumerate(self.free_ranges):
+            offset = align_up(free_offset, alignment)
+            padding = offset - free_offset
+            if free_size < padding + size:
+                continue
+            remainder = []
+            if padding > 0:
+                remainder.append((free_offset, padding))
+            if free_size > padding + size:
+                remainder.append((offset + size, free_size - padding - size))
+            self.free_ranges[i:i+1] = remainder
+            self.allocation_count += 1
+            self.used += size
+            return Allocation(self, offset, size)
+        return None
+
+    def release(self, allocation):
+        offset, size = allocation.offset, allocation.size
+        i = bisect.bisect_left(self.free_ranges, (offset, size))
+        # coalesce with the previous and next free ranges
+        if i > 0 and sum(self.free_ranges[i-1]) == offset:
+            i -= 1
+            offset, size = self.free_ranges[i][0], self.free_ranges[i][1] + size
+            del self.free_ranges[i]
+        if i < len(self.free_ranges) and offset + size == self.free_ranges[i][0]:
+            size += self.free_ranges[i][1]
+            del self.free_ranges[i]
+        self.free_ranges.insert(i, (offset, size))
+        self.allocation_count -= 1
+        self.used -= allocation.size
+        if self.allocation_count == 0 and self.dedicated:
+            self.allocator.destroy_block(self)
+
+    def is_empty(self):
+        return self.allocation_count == 0
+
+    def map(self):
+        if self.mapped_array is None:
+            self.mapped_array = vk.mapMemory(self.allocator.device, self.memory, 0, vk.VK_WHOLE_SIZE, 0)
+        return self.mapped_array
+
+    def stats(self):
+        return { 'memory_type_index' : self.memory_type_index,
+                 'kind' : self.kind,
+                 'dedicated' : self.dedicated,
+                 'size' : self.size,
+                 'used' : self.used,
+                 'free' : self.size - self.used,
+                 'allocations' : self.allocation_count,
+                 'free_ranges' : len(self.free_ranges),
+                 'largest_free_range' : max([s for o,s in self.free_ranges]) if self.free_ranges else 0 }
+
+    # the views from map() outlive the block safely, their capsule references the memory
+    # vkUnmapMemory then vkFreeMemory are called when the last view is garbage collected
+    def destroy(self):
+        self.mapped_array = None
+        if hasattr(self.memory, 'this'):
+            del self.memory.this
+
+class DeviceMemoryAllocator:
+    def __init__(self, device, memory_types, block_size = DEFAULT_BLOCK_SIZE, non_coherent_atom_size = 1):
+        self.device = device
+        self.memory_types = memory_types
+        self.block_size = block_size
+        self.non_coherent_atom_size = max(non_coherent_atom_size, 1)
+        self.blocks = {} # (memory type index, kind) -> [MemoryBlock]
+
+    def preferred_block_size(self, memory_type_index):
+        # small heaps (e.g. the 256MB BAR heap on discrete cards) get smaller blocks
+        return min(self.block_size, max(self.memory_types.heap_size(memory_type_index) // 8, 1))
+
+    def allocate(self, mem_reqs, properties, kind = KIND_LINEAR, preferred = 0):
+        ranking = self.memory_types.ranked(mem_reqs.memoryTypeBits, properties, preferred)
+        if len(ranking) == 0:
+            raise RuntimeError('No memory type with properties 0x%x in memoryTypeBits 0x%x' % (properties, mem_reqs.memoryTypeBits))
+
+        # when a heap is exhausted we fall back on the next best memory type
+        for memory_type_index in ranking[:-1]:
+            try:
+                return self.allocate_from_type(mem_reqs, memory_type_index, kind)
+            except vk.VkError as e:
+                if not is_out_of_memory_error(e):
+                    raise
+        return self.allocate_from_type(mem_reqs, ranking[-1], kind)
+
+    def allocate_from_type(self, mem_reqs, memory_type_index, kind):
+        block_size = self.preferred_block_size(memory_type_index)
+        # large resources get their own block, they would waste most of a shared block anyway
+        if mem_reqs.size > block_size // 2:
+            block = MemoryBlock(self, memory_type_index, mem_reqs.size, kind, dedicated=True)
+            self.blocks.setdefault((memory_type_index, kind), []).append(block)
+            return block.try_allocate(mem_reqs.size, mem_reqs.alignment)
+
+        blocks = self.blocks.setdefault((memory_type_index, kind), [])
+        for block in blocks:
+            if not block.dedicated:
+                allocation = block.try_allocate(mem_reqs.size, mem_reqs.alignment)
+                if allocation is not None:
+                    return allocation
+
+        block = MemoryBlock(self, memory_type_index, block_size, kind)
+        blocks.append(block)
+        return block.try_allocate(mem_reqs.size, mem_reqs.alignment)
+
+    def allocate_for_buffer(self, buffer, properties, preferred = 0):
+        mem_reqs = vk.getBufferMemoryRequirements(self.device, buffer)
+        allocation = self.allocate(mem_reqs, properties, KIND_LINEAR, preferred)
+        vk.bindBufferMemory(self.device, buffer, allocation.memory, allocation.offset)
+        return allocation
+
+    def allocate_for_image(self, image, properties, linear = False, preferred = 0):
+        mem_reqs = vk.getImageMemoryRequirements(self.device, image)
+        allocation = self.allocate(mem_reqs, properties, KIND_LINEAR if linear else KIND_OPTIMAL, preferred)
+        vk.bindImageMemory(self.device, image, allocation.memory, allocation.offset)
+        return allocation
+
+    def destroy_block(self, block):
+        self.blocks[(block.memory_type_index, block.kind)].remove(block)
+        block.destroy()
+
+    def stats(self):
+        return [b.stats() for blocks in self.blocks.values() for b in blocks]
+
+    def print_stats(self):
+        for s in self.stats():
+            print('memory type %(memory_type_index)d kind %(kind)d: %(used)d / %(size)d bytes used in %(allocations)d allocations, %(free_ranges)d free ranges, largest %(largest_free_range)d' % s)
+
+    def destroy(self):
+        for blocks in self.blocks.values():
+            for b in blocks:
+                b.destroy()
+        self.blocks = {}
@@ -0,0 +1,137 @@
+# Batched offscreen rendering of many views into the layers of an image array
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+import numpy as np
+import vulkanmitts as vk
+from contextlib2 import ExitStack
+from vkmemory import delete_this
+from transforms import perspective, look_at
+
+# MVP matrices of count cameras on a circle around the origin, same camera height and distance as VkContextManager.init_uniform_buffer
+def orbit_view_projections(count, radius = 11.2, height = 3.0):
+    P = perspective(45.0, 1.0, 0.1, 100.0)
+    mvps = np.empty((count,4,4), dtype=np.single)
+    for i in range(count):
+        angle = 2.0 * np.pi * i / count
+        V = look_at( np.array([radius * np.sin(angle), height, radius * np.cos(angle)]), np.array([0, 0, 0]), np.array([0, -1, 0]) )
+        mvps[i] = V.dot(P)
+    return mvps
+
+# Renders the context mesh once per view matrix, each view in its own layer of a 2D array image
+# all the views are recorded in one command buffer, submitted once and read back by a single copy
+# the MVP of each view is a push constant, see vertex_shader_push_constant.glsl
+class MultiViewRenderer:
+    def ESP(self, obj):
+        self.stack.callback(delete_this, obj)
+        return obj
+
+    def __init__(self, vkc, layer_count):
+        self.vkc = vkc
+        self.layer_count = layer_count
+        self.stack = ExitStack()
+        try:
+            # the framebuffers of each layer use the render pass of the context without resolve attachment
+            assert(layer_count <= vkc.gpu_props.limits.maxImageArrayLayers and vkc.sample_count == vk.VK_SAMPLE_COUNT_1_BIT)
+            if not hasattr(vkc, 'push_constant_pipeline'):
+                vkc.init_push_constant_pipeline()
+            w,h = vkc.get_surface_extent()
+            ici = vk.ImageCreateInfo(   0,
+                                        vk.VK_IMAGE_TYPE_2D,
+                                        vkc.format,
+                                        vk.Extent3D(w,h,1),
+                                        1,
+                                        layer_count,
+                                        vk.VK_SAMPLE_COUNT_1_BIT,
+                                        vk.VK_IMAGE_TILING_OPTIMAL,
+                                        vk.VK_IMAGE_USAGE_COLOR_ATTACHMENT_BIT|vk.VK_IMAGE_USAGE_TRANSFER_SRC_BIT,
+                                        vk.VK_SHARING_MODE_EXCLUSIVE,
+                                        [],
+                                        vk.VK_IMAGE_LAYOUT_UNDEFINED)
+            self.image = self.ESP( vk.createImage(vkc.device, ici) )
+            image_alloc = vkc.allocator.allocate_for_image(self.image, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT)
+            self.stack.callback(image_alloc.free)
+
+            # one 2D view and framebuffer per layer, the depth buffer of the context is cleared and reused by each view
+            components = vk.ComponentMapping(vk.VK_COMPONENT_SWIZZLE_R, vk.VK_COMPONENT_SWIZZLE_G, vk.VK_COMPONENT_SWIZZLE_B, vk.VK_COMPONENT_SWIZZLE_A)
+            self.framebuffers = []
+            for layer in range(layer_count):
+                subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, layer, 1)
+                layer_view = self.ESP( vk.createImageView(vkc.device, vk.ImageViewCreateInfo(0, self.image, vk.VK_IMAGE_VIEW_TYPE_2D, vkc.format, components, subresource_range)) )
+                attachments = vk.VkImageViewVector()
+                attachments.append(layer_view)
+                attachments.append(vkc.depth_view)
+                self.framebuffers.append( self.ESP( vk.createFramebuffer(vkc.device, vk.FramebufferCreateInfo(0, vkc.render_pass, attachments, w, h, 1)) ) )
+
+            self.readback = vkc.create_color_readback_buffer(layer_count)
+            self.stack.callback(self.readback.destroy)
+
+            cbai = vk.CommandBufferAllocateInfo(vkc.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY, 1)
+            self.command_buffers = self.ESP( vk.allocateCommandBuffers(vkc.device, cbai) )
+            self.fence = self.ESP( vk.createFence(vkc.device, vk.FenceCreateInfo(0)) )
+        except:
+            self.stack.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    def layer_barrier(self, command_buffer, src_access, dst_access, old_layout, new_layout, src_stage, dst_stage):
+        subresource_range = vk.ImageSubresourceRange(vk.VK_IMAGE_ASPECT_COLOR_BIT, 0, 1, 0, self.layer_count)
+        img_mem_barrier = vk.ImageMemoryBarrier(src_access, dst_access, old_layout, new_layout, 0, 0, self.image, subresource_range)
+        vk.cmdPipelineBarrier(command_buffer, src_stage, dst_stage, 0,
+                              vk.VkMemoryBarrierVector(),
+                              vk.VkBufferMemoryBarrierVector(),
+                              vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
+
+    def record(self, command_buffer, mvps):
+        vkc = self.vkc
+        self.layer_barrier(command_buffer, 0, vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT,
+                           vk.VK_IMAGE_LAYOUT_UNDEFINED, vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL,
+                           vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT, vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT)
+        # the views share the depth buffer, each render pass clears it after the depth writes of the previous one
+        depth_barrier = vk.MemoryBarrier(vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT, vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_READ_BIT | vk.VK_ACCESS_DEPTH_STENCIL_ATTACHMENT_WRITE_BIT)
+        for layer, mvp in enumerate(mvps):
+            if layer > 0:
+                vk.cmdPipelineBarrier(command_buffer, vk.VK_PIPELINE_STAGE_LATE_FRAGMENT_TESTS_BIT, vk.VK_PIPELINE_STAGE_EARLY_FRAGMENT_TESTS_BIT, 0,
+                                      vk.VkMemoryBarrierVector(1,depth_barrier),
+                                      vk.VkBufferMemoryBarrierVector(),
+                                      vk.VkImageMemoryBarrierVector())
+            vk.cmdBeginRenderPass(command_buffer, vkc.make_render_pass_begin_info(self.framebuffers[layer]), vk.VK_SUBPASS_CONTENTS_INLINE)
+            vkc.record_push_constant_draws(command_buffer, [mvp])
+            vk.cmdEndRenderPass(command_buffer)
+
+        self.layer_barrier(command_buffer, vk.VK_ACCESS_COLOR_ATTACHMENT_WRITE_BIT, vk.VK_ACCESS_TRANSFER_READ_BIT,
+                           vk.VK_IMAGE_LAYOUT_COLOR_ATTACHMENT_OPTIMAL, vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL,
+                           vk.VK_PIPELINE_STAGE_COLOR_ATTACHMENT_OUTPUT_BIT, vk.VK_PIPELINE_STAGE_TRANSFER_BIT)
+        # all the layers in one copy, they are tightly packed one after the other in the buffer
+        w,h = vkc.get_surface_extent()
+        region = vk.BufferImageCopy(0, 0, 0, vk.ImageSubresourceLayers(vk.VK_IMAGE_ASPECT_COLOR_BIT,0,0,len(mvps)), vk.Offset3D(0,0,0), vk.Extent3D(w,h,1))
+        vk.cmdCopyImageToBuffer(command_buffer, self.image, vk.VK_IMAGE_LAYOUT_TRANSFER_SRC_OPTIMAL, self.readback.buffer, vk.VkBufferImageCopyVector(1,region))
+        host_barrier = vk.MemoryBarrier(vk.VK_ACCESS_TRANSFER_WRITE_BIT, vk.VK_ACCESS_HOST_READ_BIT)
+        vk.cmdPipelineBarrier(command_buffer, vk.VK_PIPELINE_STAGE_TRANSFER_BIT, vk.VK_PIPELINE_STAGE_HOST_BIT, 0,
+                              vk.VkMemoryBarrierVector(1,host_barrier),
+                              vk.VkBufferMemoryBarrierVector(),
+                              vk.VkImageMemoryBarrierVector())
+
+    # mvps is a (V,4,4) array of model view projection matrices, row vector convention like transforms.py
+    # returns a (V,h,w,4) view on the mapped readback buffer, valid until the next call
+    # the array is typed by the color format of the context, see COLOR_READBACK_FORMATS
+    def render(self, mvps):
+        mvps = np.ascontiguousarray(mvps, dtype=np.float32)
+        assert(mvps.shape[1:] == (4,4) and len(mvps) <= self.layer_count)
+        command_buffer = self.command_buffers[0]
+        vk.resetCommandBuffer(command_buffer, 0)
+        vk.beginCommandBuffer(command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, None))
+        self.record(command_buffer, mvps)
+        vk.endCommandBuffer(command_buffer)
+        self.vkc.submit(vk.VkCommandBufferVector(1, command_buffer), self.fence)
+        self.vkc.wait_and_reset_fence(self.fence)
+        self.readback.invalidate()
+        return self.readback.array[:len(mvps)]
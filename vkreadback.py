@@ -0,0 +1,92 @@
+# Asynchronous readback of offscreen frames
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+import vulkanmitts as vk
+from contextlib2 import ExitStack
+from vkcontextmanager import delete_this
+
+class ReadbackSlot:
+    def __init__(self, command_buffer, fence, readback):
+        self.command_buffer = command_buffer
+        self.fence = fence
+        self.readback = readback # MappedBuffer with a (h,w,4) view
+        self.frame = None # frame id in flight in this slot, None when the slot is free
+
+# N-deep ring of readback targets, each with its own command buffer and fence
+# while the caller processes frame N the GPU keeps copying the next depth-1 frames to the host
+# the slots share the single color/depth target and uniform buffer of the context, so the render passes
+# of consecutive frames are serialized by the queue and only the host copy is multi-buffered
+# overlapping the render passes too would need a color target per slot
+class ReadbackRing:
+    def ESP(self, obj):
+        self.stack.callback(delete_this, obj)
+        return obj
+
+    def __init__(self, vkc, depth = 2):
+        self.vkc = vkc
+        self.depth = depth
+        self.next_slot = 0
+        self.slots = []
+        self.stack = ExitStack()
+        try:
+            cbai = vk.CommandBufferAllocateInfo(vkc.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY, depth)
+            self.command_buffers = self.ESP( vk.allocateCommandBuffers(vkc.device, cbai) )
+            for i in range(depth):
+                fence = self.ESP( vk.createFence(vkc.device, vk.FenceCreateInfo(0)) )
+                readback = vkc.create_color_readback_buffer()
+                self.stack.callback(readback.destroy)
+                self.slots.append( ReadbackSlot(self.command_buffers[i], fence, readback) )
+            # pushed last so that it runs first, nothing can be released while the GPU still uses it
+            self.stack.callback(self.wait_idle)
+        except:
+            self.stack.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    def record_and_submit(self, slot, record_frame, frame):
+        vk.resetCommandBuffer(slot.command_buffer, 0)
+        vk.beginCommandBuffer(slot.command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, None))
+        record_frame(slot.command_buffer, frame)
+        self.vkc.stage_readback_copy(slot.command_buffer, slot.readback.buffer)
+        vk.endCommandBuffer(slot.command_buffer)
+        self.vkc.submit(vk.VkCommandBufferVector(1, slot.command_buffer), slot.fence)
+        slot.frame = frame
+
+    def collect(self, slot):
+        self.vkc.wait_and_reset_fence(slot.fence)
+        slot.readback.invalidate()
+        frame = slot.frame
+        slot.frame = None
+        return frame, slot.readback.array
+
+    # record_frame(command_buffer, frame) records the render pass of a frame, the ring records the readback copy
+    # yields (frame, array) in submission order, the array is a view on the mapped memory of the slot
+    # it is only valid until the next iteration, copy it to keep it
+    def render(self, frames, record_frame):
+        for frame in frames:
+            slot = self.slots[self.next_slot]
+            if slot.frame is not None:
+                yield self.collect(slot)
+            self.record_and_submit(slot, record_frame, frame)
+            self.next_slot = (self.next_slot + 1) % self.depth
+
+        # the oldest frame in flight is always in the next slot
+        for i in range(self.depth):
+            slot = self.slots[(self.next_slot + i) % self.depth]
+            if slot.frame is not None:
+                yield self.collect(slot)
+
+    def wait_idle(self):
+        for slot in self.slots:
+            if slot.frame is not None:
+                self.vkc.wait_and_reset_fence(slot.fence)
+                slot.frame = None
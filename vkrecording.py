@@ -0,0 +1,138 @@
+# Parallel recording of secondary command buffers
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import vulkanmitts as vk
+from contextlib2 import ExitStack
+from vkmemory import delete_this
+from vkcommandstream import push_constant_draw_stream, record_stream_draws
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+# A command pool and the secondary command buffers allocated from it, a pool is used by one thread at a time
+class RecordingPool:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        vkc = recorder.vkc
+        cpci = vk.CommandPoolCreateInfo(vk.VK_COMMAND_POOL_CREATE_TRANSIENT_BIT, vkc.graphics_queue_family_index)
+        self.command_pool = recorder.ESP( vk.createCommandPool(vkc.device, cpci) )
+        self.command_buffer_vectors = []
+        self.command_buffers = []
+        self.used = 0
+        recorder.stack.callback(self.release)
+
+    # the command buffers are recycled by reset(), new ones are only allocated when a frame needs more than before
+    def next_command_buffer(self):
+        if self.used == len(self.command_buffers):
+            cbai = vk.CommandBufferAllocateInfo(self.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_SECONDARY, 1)
+            self.command_buffer_vectors.append( vk.allocateCommandBuffers(self.recorder.vkc.device, cbai) )
+            self.command_buffers.append( self.command_buffer_vectors[-1][0] )
+        command_buffer = self.command_buffers[self.used]
+        self.used += 1
+        return command_buffer
+
+    def reset(self):
+        vk.resetCommandPool(self.recorder.vkc.device, self.command_pool, 0)
+        self.used = 0
+
+    # the command buffers are freed before their pool
+    def release(self):
+        self.command_buffers = []
+        while len(self.command_buffer_vectors) > 0:
+            delete_this(self.command_buffer_vectors.pop())
+
+# Records the draws of a render pass in secondary command buffers from a thread pool and executes them from a primary
+# Vulkan requires a command pool per recording thread, each task checks out a pool for the duration of its recording
+# the vkCmd* wrappers keep the GIL, the threads only overlap where it is released, so a task recording one vkCmd* call
+# per draw doesn't scale, the tasks of render_push_constant_draws replay command streams with cmdReplayCommandStream
+# benchmark_parallel_recording.py compares thread_count 1 and N
+class ParallelRecorder:
+    def ESP(self, obj):
+        self.stack.callback(delete_this, obj)
+        return obj
+
+    def __init__(self, vkc, thread_count = 4):
+        self.vkc = vkc
+        self.thread_count = thread_count
+        self.pools = []
+        self.free_pools = Queue()
+        self.stack = ExitStack()
+        try:
+            for i in range(thread_count):
+                pool = RecordingPool(self)
+                self.pools.append(pool)
+                self.free_pools.put(pool)
+            self.executor = ThreadPoolExecutor(thread_count)
+            self.stack.callback(self.executor.shutdown)
+            # pushed last so that it runs first, the secondary command buffers may still be executed by the GPU
+            self.stack.callback(vk.deviceWaitIdle, vkc.device)
+        except:
+            self.stack.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    # recycles the secondary command buffers, the submission that executed them must be completed
+    def reset(self):
+        for pool in self.pools:
+            pool.reset()
+
+    def record_secondary(self, record_task, framebuffer):
+        pool = self.free_pools.get()
+        try:
+            command_buffer = pool.next_command_buffer()
+            inheritance_info = vk.CommandBufferInheritanceInfo(self.vkc.render_pass, 0, framebuffer, False, 0, 0)
+            vk.beginCommandBuffer(command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_RENDER_PASS_CONTINUE_BIT | vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, inheritance_info))
+            record_task(command_buffer)
+            vk.endCommandBuffer(command_buffer)
+            return command_buffer
+        finally:
+            self.free_pools.put(pool)
+
+    # record_task(command_buffer) records draws inside the render pass of the context, the dynamic states aren't
+    # inherited by secondary command buffers so each task sets its viewport and scissor
+    # returns the secondary command buffers in the order of the tasks
+    def record(self, record_tasks, framebuffer = None):
+        if framebuffer is None:
+            framebuffer = self.vkc.framebuffers[self.vkc.current_buffer]
+        futures = [self.executor.submit(self.record_secondary, record_task, framebuffer) for record_task in record_tasks]
+        command_buffers = vk.VkCommandBufferVector()
+        for future in futures:
+            command_buffers.append(future.result())
+        return command_buffers
+
+    # records the render pass of the context in the primary command buffer, its content is recorded by the tasks in parallel
+    def record_render_pass(self, command_buffer, record_tasks, framebuffer = None):
+        secondary_command_buffers = self.record(record_tasks, framebuffer)
+        vk.cmdBeginRenderPass(command_buffer, self.vkc.make_render_pass_begin_info(framebuffer), vk.VK_SUBPASS_CONTENTS_SECONDARY_COMMAND_BUFFERS)
+        vk.cmdExecuteCommands(command_buffer, secondary_command_buffers)
+        vk.cmdEndRenderPass(command_buffer)
+
+    # one task per chunk of MVP matrices, the command streams are built here with numpy so that the tasks
+    # only record, in one native call that releases the GIL
+    def push_constant_draw_tasks(self, mvps, task_count = 16):
+        vkc = self.vkc
+        if not hasattr(vkc, 'push_constant_pipeline'):
+            vkc.init_push_constant_pipeline()
+        streams = [push_constant_draw_stream(vkc, chunk) for chunk in np.array_split(mvps, task_count) if len(chunk) > 0]
+        for stream in streams:
+            stream.finish()
+        return [lambda cb, stream=stream: record_stream_draws(vkc, cb, stream) for stream in streams]
+
+    # renders one draw of the context mesh per MVP matrix, the draws are split in task_count secondary command buffers
+    def render_push_constant_draws(self, mvps, task_count = 16):
+        tasks = self.push_constant_draw_tasks(mvps, task_count)
+        self.reset()
+        return self.vkc.render_offscreen_frame(lambda command_buffer: self.record_render_pass(command_buffer, tasks))
@@ -0,0 +1,176 @@
+# Streaming uploads through a persistently mapped staging ring buffer
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+from collections import deque
+import numpy as np
+import vulkanmitts as vk
+from contextlib2 import ExitStack
+from vkmemory import MappedBuffer, align_up, delete_this
+
+DEFAULT_STAGING_SIZE = 8 * 1024 * 1024
+
+class StagingBatch:
+    def __init__(self, command_buffer, fence):
+        self.command_buffer = command_buffer
+        self.fence = fence
+        self.ranges = [] # (begin, end) byte ranges of the ring used by the copies of this batch
+        self.recording = False
+
+    def overlaps(self, begin, end):
+        return any(begin < r_end and r_begin < end for r_begin, r_end in self.ranges)
+
+# Uploads are copied to the ring then recorded in the command buffer of the current batch
+# flush() submits the batch with its fence, the ring regions of a batch are reused once its fence is signaled
+# nothing is allocated per upload and the CPU only waits when the ring or the batches are all in flight
+class StagingRing:
+    def ESP(self, obj):
+        self.stack.callback(delete_this, obj)
+        return obj
+
+    def __init__(self, vkc, size = DEFAULT_STAGING_SIZE, depth = 2):
+        self.vkc = vkc
+        self.size = size
+        self.depth = depth
+        self.head = 0
+        self.upload_count = 0
+        self.batches = []
+        self.in_flight = deque()
+        self.stack = ExitStack()
+        try:
+            limits = vkc.gpu_props.limits
+            # bufferOffset of vkCmdCopyBufferToImage must be a multiple of 4 and of the texel size
+            self.image_alignment = max(16, limits.optimalBufferCopyOffsetAlignment)
+            self.ring = MappedBuffer(vkc.allocator, vk.VK_BUFFER_USAGE_TRANSFER_SRC_BIT, np.uint8, size)
+            self.stack.callback(self.ring.destroy)
+            cbai = vk.CommandBufferAllocateInfo(vkc.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY, depth)
+            self.command_buffers = self.ESP( vk.allocateCommandBuffers(vkc.device, cbai) )
+            for i in range(depth):
+                fence = self.ESP( vk.createFence(vkc.device, vk.FenceCreateInfo(0)) )
+                self.batches.append( StagingBatch(self.command_buffers[i], fence) )
+            self.current = self.batches[0]
+            # pushed last so that it runs first, nothing can be released while the GPU still uses it
+            self.stack.callback(self.wait_idle)
+        except:
+            self.stack.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    def retire_oldest(self):
+        batch = self.in_flight.popleft()
+        self.vkc.wait_and_reset_fence(batch.fence)
+        batch.ranges = []
+
+    # returns the ring offset of size free bytes, waits for the batches using that region if needed
+    def reserve(self, size, alignment = 4):
+        if size > self.size:
+            raise ValueError('Upload of %d bytes is larger than the staging ring of %d bytes' % (size, self.size))
+        offset = align_up(self.head, alignment)
+        if offset + size > self.size:
+            offset = 0
+        while True:
+            if self.current.overlaps(offset, offset + size):
+                # the current batch already uses this region, it must be submitted and completed
+                self.flush()
+            elif any(batch.overlaps(offset, offset + size) for batch in self.in_flight):
+                self.retire_oldest()
+            else:
+                break
+        self.head = offset + size
+        self.current.ranges.append( (offset, offset + size) )
+        return offset
+
+    def begin(self):
+        if not self.current.recording:
+            vk.resetCommandBuffer(self.current.command_buffer, 0)
+            vk.beginCommandBuffer(self.current.command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, None))
+            self.current.recording = True
+        return self.current.command_buffer
+
+    def stage(self, data, alignment):
+        data = np.ascontiguousarray(data)
+        offset = self.reserve(data.nbytes, alignment)
+        self.ring.array[offset:offset + data.nbytes] = data.reshape(-1).view(np.uint8)
+        self.upload_count += 1
+        return offset
+
+    # uploads larger than half the ring are split so that the chunks can be pipelined
+    def upload_buffer(self, dst_buffer, data, dst_offset = 0):
+        flat = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+        chunk_size = max(4, self.size // 2 // 4 * 4)
+        for begin in range(0, flat.nbytes, chunk_size):
+            chunk = flat[begin:begin + chunk_size]
+            offset = self.stage(chunk, 4)
+            command_buffer = self.begin()
+            vk.cmdCopyBuffer(command_buffer, self.ring.buffer, dst_buffer, vk.VkBufferCopyVector(1, vk.BufferCopy(offset, dst_offset + begin, chunk.nbytes)))
+
+    # data must be tightly packed rows of texels, the image is left in final_layout for the consumer stage
+    def upload_image(self, dst_image, data, width, height,
+                     aspect = vk.VK_IMAGE_ASPECT_COLOR_BIT,
+                     final_layout = vk.VK_IMAGE_LAYOUT_SHADER_READ_ONLY_OPTIMAL,
+                     dst_stage = vk.VK_PIPELINE_STAGE_FRAGMENT_SHADER_BIT,
+                     dst_access = vk.VK_ACCESS_SHADER_READ_BIT):
+        offset = self.stage(data, self.image_alignment)
+        command_buffer = self.begin()
+        subresource_range = vk.ImageSubresourceRange(aspect, 0, 1, 0, 1)
+
+        img_mem_barrier = vk.ImageMemoryBarrier(0, vk.VK_ACCESS_TRANSFER_WRITE_BIT, vk.VK_IMAGE_LAYOUT_UNDEFINED, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, 0, 0, dst_image, subresource_range)
+        vk.cmdPipelineBarrier(command_buffer,
+                              vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
+                              vk.VK_PIPELINE_STAGE_TRANSFER_BIT, 0,
+                              vk.VkMemoryBarrierVector(),
+                              vk.VkBufferMemoryBarrierVector(),
+                              vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
+
+        # bufferRowLength and bufferImageHeight set to 0 means tightly packed
+        region = vk.BufferImageCopy(offset, 0, 0, vk.ImageSubresourceLayers(aspect,0,0,1), vk.Offset3D(0,0,0), vk.Extent3D(width,height,1))
+        vk.cmdCopyBufferToImage(command_buffer, self.ring.buffer, dst_image, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, vk.VkBufferImageCopyVector(1,region))
+
+        img_mem_barrier = vk.ImageMemoryBarrier(vk.VK_ACCESS_TRANSFER_WRITE_BIT, dst_access, vk.VK_IMAGE_LAYOUT_TRANSFER_DST_OPTIMAL, final_layout, 0, 0, dst_image, subresource_range)
+        vk.cmdPipelineBarrier(command_buffer,
+                              vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
+                              dst_stage, 0,
+                              vk.VkMemoryBarrierVector(),
+                              vk.VkBufferMemoryBarrierVector(),
+                              vk.VkImageMemoryBarrierVector(1,img_mem_barrier))
+
+    # submits the uploads recorded since the last flush, later submissions on the same queue see the uploaded data
+    def flush(self):
+        batch = self.current
+        if not batch.recording:
+            return
+        # buffer uploads are read by vertex input, index and shader stages
+        buffer_barrier = vk.MemoryBarrier(vk.VK_ACCESS_TRANSFER_WRITE_BIT, vk.VK_ACCESS_VERTEX_ATTRIBUTE_READ_BIT | vk.VK_ACCESS_INDEX_READ_BIT | vk.VK_ACCESS_UNIFORM_READ_BIT | vk.VK_ACCESS_SHADER_READ_BIT)
+        vk.cmdPipelineBarrier(batch.command_buffer,
+                              vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
+                              vk.VK_PIPELINE_STAGE_VERTEX_INPUT_BIT | vk.VK_PIPELINE_STAGE_VERTEX_SHADER_BIT | vk.VK_PIPELINE_STAGE_FRAGMENT_SHADER_BIT, 0,
+                              vk.VkMemoryBarrierVector(1,buffer_barrier),
+                              vk.VkBufferMemoryBarrierVector(),
+                              vk.VkImageMemoryBarrierVector())
+        vk.endCommandBuffer(batch.command_buffer)
+        for begin, end in batch.ranges:
+            self.ring.flush(begin, end - begin)
+        self.vkc.submit(vk.VkCommandBufferVector(1, batch.command_buffer), batch.fence)
+        batch.recording = False
+        self.in_flight.append(batch)
+
+        self.current = self.batches[(self.batches.index(batch) + 1) % self.depth]
+        while self.current in self.in_flight:
+            self.retire_oldest()
+
+    def wait_idle(self):
+        while len(self.in_flight) > 0:
+            self.retire_oldest()
+
+    # submits the pending uploads and blocks until they are all completed
+    def finish(self):
+        self.flush()
+        self.wait_idle()
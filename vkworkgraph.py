@@ -0,0 +1,191 @@
+# GPU work graph ordered by a timeline semaphore
+# Copyright (C) 2016 by VLAM3D Software inc. https://www.vlam3d.com
+# This code is licensed under the MIT license (MIT) (http://opensource.org/licenses/MIT)
+from __future__ import print_function
+from collections import OrderedDict
+import numpy as np
+import vulkanmitts as vk
+from contextlib2 import ExitStack
+from vkmemory import delete_this, MappedBuffer
+
+UINT64_MAX = 0xffffffffffffffff
+
+# requires Vulkan 1.2, see VkContextManager.timeline_semaphores
+def create_timeline_semaphore(device, initial_value = 0):
+    return vk.createSemaphore(device, vk.SemaphoreCreateInfo(0, vk.SemaphoreTypeCreateInfo(vk.VK_SEMAPHORE_TYPE_TIMELINE, initial_value)))
+
+class WorkStage:
+    def __init__(self, name, record, dependencies, wait_stage, command_buffers, semaphore):
+        self.name = name
+        self.record = record
+        self.dependencies = dependencies
+        self.wait_stage = wait_stage # pipeline stages of this stage that wait for its dependencies
+        self.command_buffers = command_buffers # one per run in flight
+        self.semaphore = semaphore # timeline of the stage, its value is the number of the last run that completed the stage
+        self.value = 0 # run number signaled by the last submission of the stage
+
+# Stages e.g. upload, render and readback are each recorded in their own command buffer and submitted together
+# each stage has its own timeline semaphore, the submission of run N signals N and waits for N on the timelines of
+# its dependencies, so the GPU orders the stages and the host follows the progress of every stage without any fence
+# a stage also waits for its own run N-1, the signals of a timeline must increase and the stages of different runs
+# still overlap e.g. the upload of run N+1 with the render of run N
+# up to runs_in_flight runs of the graph are in flight, a run reuses the command buffers of the run runs_in_flight before it
+# once the run is complete, the resources written by the stages can be indexed by the slot passed to record
+class WorkGraph:
+    def ESP(self, obj):
+        self.stack.callback(delete_this, obj)
+        return obj
+
+    def __init__(self, vkc, runs_in_flight = 2):
+        assert(vkc.timeline_semaphores)
+        self.vkc = vkc
+        self.runs_in_flight = runs_in_flight
+        self.stages = OrderedDict()
+        self.run_count = 0
+        self.slot_values = [0] * runs_in_flight
+        self.stack = ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    # the command buffers and semaphores of the stages are pushed later, so the wait can't be a callback of the stack
+    def close(self):
+        try:
+            self.wait_idle()
+        finally:
+            self.stack.close()
+
+    # record(command_buffer, slot) records the stage of the run using the resources of slot
+    # the stages are submitted in the order they are added, so the dependencies must be added first
+    # wait_stage is where the stage waits for its dependencies e.g. VK_PIPELINE_STAGE_VERTEX_INPUT_BIT after an upload
+    def add_stage(self, name, record, after = (), wait_stage = vk.VK_PIPELINE_STAGE_ALL_COMMANDS_BIT):
+        assert(name not in self.stages and all(dependency in self.stages for dependency in after) and self.run_count == 0)
+        cbai = vk.CommandBufferAllocateInfo(self.vkc.command_pool, vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY, self.runs_in_flight)
+        command_buffers = self.ESP( vk.allocateCommandBuffers(self.vkc.device, cbai) )
+        semaphore = self.ESP( create_timeline_semaphore(self.vkc.device) )
+        stage = WorkStage(name, record, [self.stages[dependency] for dependency in after], wait_stage, command_buffers, semaphore)
+        self.stages[name] = stage
+        return stage
+
+    # records and submits all the stages in one vkQueueSubmit, returns the run number signaled by the stages
+    def submit(self):
+        slot = self.run_count % self.runs_in_flight
+        self.wait(self.slot_values[slot])
+        # the values are committed after the submit, if a stage fails to record nothing waits for values never signaled
+        value = self.run_count + 1
+        submit_info_vec = vk.VkSubmitInfoVector()
+        for stage in self.stages.values():
+            command_buffer = stage.command_buffers[slot]
+            vk.resetCommandBuffer(command_buffer, 0)
+            vk.beginCommandBuffer(command_buffer, vk.CommandBufferBeginInfo(vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT, None))
+            stage.record(command_buffer, slot)
+            vk.endCommandBuffer(command_buffer)
+
+            wait_semaphores = vk.VkSemaphoreVector()
+            wait_stages = vk.VkFlagVector()
+            wait_values = []
+            if stage.value > 0:
+                wait_semaphores.append(stage.semaphore)
+                wait_stages.append(vk.VK_PIPELINE_STAGE_ALL_COMMANDS_BIT)
+                wait_values.append(stage.value)
+            for dependency in stage.dependencies:
+                wait_semaphores.append(dependency.semaphore)
+                wait_stages.append(stage.wait_stage)
+                wait_values.append(value)
+            submit_info_vec.append( self.vkc.make_submit_info(vk.VkCommandBufferVector(1, command_buffer),
+                                                              wait_semaphores,
+                                                              wait_stages if len(wait_semaphores) > 0 else None,
+                                                              vk.VkSemaphoreVector(1, stage.semaphore),
+                                                              wait_values,
+                                                              [value]) )
+        vk.queueSubmit(self.vkc.device_queue, submit_info_vec, None)
+        for stage in self.stages.values():
+            stage.value = value
+        self.slot_values[slot] = value
+        self.run_count = value
+        return value
+
+    def stage_completed_value(self, name):
+        return vk.getSemaphoreCounterValue(self.vkc.device, self.stages[name].semaphore)
+
+    # the progress of the GPU, every run lower or equal is complete
+    def completed_value(self):
+        return min([self.stage_completed_value(name) for name in self.stages] + [self.run_count])
+
+    def is_complete(self, value):
+        return self.completed_value() >= value
+
+    def stage_complete(self, name):
+        return self.stage_completed_value(name) >= self.stages[name].value
+
+    def wait_semaphores(self, stages, value, timeout):
+        if value <= 0 or len(stages) == 0:
+            return True
+        semaphores = vk.VkSemaphoreVector()
+        for stage in stages:
+            semaphores.append(stage.semaphore)
+        res = vk.waitSemaphoresStatus(self.vkc.device, semaphores, [value] * len(stages), False, timeout)
+        return res == vk.VK_SUCCESS
+
+    # blocks until all the stages of run value are complete, returns False on timeout, the GIL is released while waiting
+    def wait(self, value, timeout = UINT64_MAX):
+        return self.wait_semaphores(list(self.stages.values()), value, timeout)
+
+    def wait_stage(self, name, timeout = UINT64_MAX):
+        stage = self.stages[name]
+        return self.wait_semaphores([stage], stage.value, timeout)
+
+    def wait_idle(self):
+        self.wait(self.run_count)
+
+# upload, render and readback stages ordered by the timeline semaphores of a WorkGraph, the host never waits on a fence
+# each run copies the vertices from the staging buffer of its slot to the device local vertex buffer of the same slot
+# returns the number of completed runs and the readback of the last run
+def render_work_graph(vkc, vertices, mvps, runs_in_flight = 2):
+    if not hasattr(vkc, 'push_constant_pipeline'):
+        vkc.init_push_constant_pipeline()
+    vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+    sources = []
+    targets = []
+    mvp = [None] # MVP of the run being recorded, using a list in the closures
+
+    def record_upload(command_buffer, slot):
+        sources[slot].array[...] = vertices
+        sources[slot].flush()
+        vk.cmdCopyBuffer(command_buffer, sources[slot].buffer, targets[slot], vk.VkBufferCopyVector(1, vk.BufferCopy(0, 0, vertices.nbytes)))
+
+    def record_render(command_buffer, slot):
+        vk.cmdBeginRenderPass(command_buffer, vkc.make_render_pass_begin_info(), vk.VK_SUBPASS_CONTENTS_INLINE)
+        vk.cmdBindPipeline(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vkc.push_constant_pipeline[0])
+        vk.cmdBindDescriptorSets(command_buffer, vk.VK_PIPELINE_BIND_POINT_GRAPHICS, vkc.push_constant_pipeline_layout, 0, vkc.descriptor_set,  [])
+        vkc.init_viewports(command_buffer)
+        vkc.init_scissors(command_buffer)
+        vk.cmdPushConstants(command_buffer, vkc.push_constant_pipeline_layout, vk.VK_SHADER_STAGE_VERTEX_BIT, 0, mvp[0])
+        vk.cmdBindVertexBuffers(command_buffer, 0, vk.VkBufferVector(1,targets[slot]), vk.VkDeviceSizeVector(1,0))
+        vk.cmdDraw(command_buffer, vertices.shape[0], 1, 0, 0)
+        vk.cmdEndRenderPass(command_buffer)
+
+    # the buffers are owned by this call, the graph is closed first so the GPU is done with them when they are released
+    with ExitStack() as stack:
+        for i in range(runs_in_flight):
+            source = MappedBuffer(vkc.allocator, vk.VK_BUFFER_USAGE_TRANSFER_SRC_BIT, np.float32, vertices.shape)
+            stack.callback(source.destroy)
+            sources.append(source)
+            target = vk.createBuffer(vkc.device, vk.BufferCreateInfo(0, vertices.nbytes, vk.VK_BUFFER_USAGE_VERTEX_BUFFER_BIT | vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT, vk.VK_SHARING_MODE_EXCLUSIVE, []))
+            stack.callback(delete_this, target)
+            stack.callback(vkc.allocator.allocate_for_buffer(target, vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT).free)
+            targets.append(target)
+
+        with WorkGraph(vkc, runs_in_flight) as graph:
+            graph.add_stage('upload', record_upload)
+            graph.add_stage('render', record_render, after = ['upload'], wait_stage = vk.VK_PIPELINE_STAGE_VERTEX_INPUT_BIT)
+            graph.add_stage('readback', lambda command_buffer, slot: vkc.stage_readback_copy(command_buffer), after = ['render'], wait_stage = vk.VK_PIPELINE_STAGE_TRANSFER_BIT)
+            for run_mvp in np.asarray(mvps, dtype=np.float32):
+                mvp[0] = run_mvp
+                graph.submit()
+            graph.wait_stage('readback')
+            completed_value = graph.completed_value()
+    return completed_value, vkc.readback_map_copy()
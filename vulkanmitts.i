@@ -34,7 +34,10 @@ Please read SWIG_DOC_
 #define _DEBUG 1
 
 #include <exception>
+#include <stdexcept>
 #include <memory>
+#include <mutex>
+#include <unordered_map>
 #include <vector>
 #include <numpy/arrayobject.h>
 #include <vulkan/vk_platform.h>
@@ -44,6 +47,15 @@ Please read SWIG_DOC_
 %init
 %{
     import_array();
+
+    VkErrorType = PyErr_NewException("vulkanmitts.VkError", PyExc_RuntimeError, NULL);
+    PyDict_SetItemString(d, "VkError", VkErrorType);
+%}
+
+// RuntimeError subclass raised for the VkResult errors, its result attribute is the VkResult
+%pythoncode
+%{
+VkError = _vulkanmitts.VkError
 %}
 
 %define %ref_counted_handle(HANDLETYPE...)
@@ -209,6 +221,13 @@ Please read SWIG_DOC_
         }
     }
 
+    // None is accepted like in the typemap below, e.g. for the optional pNext chain parameters
+    %typemap(typecheck, precedence=SWIG_TYPECHECK_POINTER) const std::shared_ptr<TYPE##RAII> &
+    {
+        void *vptr = 0;
+        $1 = ($input == Py_None) || SWIG_CheckState(SWIG_ConvertPtr($input, &vptr, $descriptor(std::shared_ptr<TYPE##RAII> *), 0));
+    }
+
     %typemap(in) const std::shared_ptr<TYPE##RAII> &
     (void *argp, int res = 0, std::shared_ptr<TYPE##RAII> null_shared_ptr)
     {
@@ -266,6 +285,11 @@ Please read SWIG_DOC_
     {
         SWIG_exception(SWIG_IndexError,const_cast<char*>(e.what()));
     }
+    catch (const VkErrorException& e)
+    {
+        SetVkError(e);
+        SWIG_fail;
+    }
     catch (const std::exception& e)
     {
         SWIG_exception(SWIG_RuntimeError, e.what());
@@ -282,6 +306,29 @@ Please read SWIG_DOC_
 }
 
 %{
+    // the VkResult is kept so that Python can test it without parsing the message, see SetVkError
+    class VkErrorException : public std::runtime_error
+    {
+    public:
+        VkErrorException(VkResult result, const std::string& message) : std::runtime_error(message), result(result) {}
+        VkResult result;
+    };
+
+    static PyObject* VkErrorType = nullptr;
+
+    void SetVkError(const VkErrorException& e)
+    {
+        PyObject* exception = PyObject_CallFunction(VkErrorType, "s", e.what());
+        if (exception)
+        {
+            PyObject* result = PyLong_FromLong(e.result);
+            PyObject_SetAttrString(exception, "result", result);
+            Py_XDECREF(result);
+            PyErr_SetObject(VkErrorType, exception);
+            Py_DECREF(exception);
+        }
+    }
+
     void ThrowOnVkError(VkResult res, const char* statement, const char* file, long line);
 
     #define V(x) do{   \
@@ -384,6 +431,49 @@ VK_DEFINE_NON_DISPATCHABLE_HANDLE(VkDescriptorSet)
 
 uint32_t makeVersion(uint32_t major, uint32_t minor, uint32_t patch);
 
+// unlike the generated waitForFences, VK_TIMEOUT is returned as a status instead of being raised as an exception
+// and the GIL is released while the calling thread is blocked, the default timeout is infinite
+%inline %{
+    VkResult waitForFencesStatus(VkDevice device, const std::vector<VkFence>& fences, VkBool32 waitAll, uint64_t timeout = UINT64_MAX)
+    {
+        VkResult res;
+        Py_BEGIN_ALLOW_THREADS
+        res = vkWaitForFences(device, static_cast<uint32_t>(fences.size()), fences.data(), waitAll, timeout);
+        Py_END_ALLOW_THREADS
+        if (res != VK_TIMEOUT)
+        {
+            ThrowOnVkError(res, "vkWaitForFences", __FILE__, __LINE__);
+        }
+        return res;
+    }
+
+    // same for the timeline semaphores of Vulkan 1.2, blocks until each semaphore reaches its value or any of them with waitAny
+    VkResult waitSemaphoresStatus(VkDevice device, const std::vector<VkSemaphore>& semaphores, const std::vector<uint64_t>& values, VkBool32 waitAny = VK_FALSE, uint64_t timeout = UINT64_MAX)
+    {
+        if ( nullptr == pfvkWaitSemaphores )
+            throw std::runtime_error("Trying to use an unavailable function\n"
+                                     "Review you instance create info\n"
+                                     "and call load_vulkan_fct_ptrs() with the new instance");
+        if (semaphores.size() != values.size())
+            throw std::runtime_error("waitSemaphoresStatus: one value is required per semaphore");
+        VkSemaphoreWaitInfo wait_info = {};
+        wait_info.sType = VK_STRUCTURE_TYPE_SEMAPHORE_WAIT_INFO;
+        wait_info.flags = waitAny ? VK_SEMAPHORE_WAIT_ANY_BIT : 0;
+        wait_info.semaphoreCount = static_cast<uint32_t>(semaphores.size());
+        wait_info.pSemaphores = semaphores.data();
+        wait_info.pValues = values.data();
+        VkResult res;
+        Py_BEGIN_ALLOW_THREADS
+        res = pfvkWaitSemaphores(device, &wait_info, timeout);
+        Py_END_ALLOW_THREADS
+        if (res != VK_TIMEOUT)
+        {
+            ThrowOnVkError(res, "vkWaitSemaphores", __FILE__, __LINE__);
+        }
+        return res;
+    }
+%}
+
 %{
     void ThrowOnVkError(VkResult res, const char* statement, const char* file, long line)
     {
@@ -399,7 +489,7 @@ uint32_t makeVersion(uint32_t major, uint32_t minor, uint32_t patch);
             {
                 err_message << "Unknown error VkResult code " << res << " ; Error returned by command " << statement << " in source file " << file << " line " << line;
             }
-            throw std::runtime_error(err_message.str());
+            throw VkErrorException(res, err_message.str());
         }
     }
 
@@ -506,10 +596,12 @@ std::shared_ptr< VkCommandBufferVector > allocateCommandBuffers(VkDevice device,
 {
     %#define PYVULKAN_MAPPEDMEMORY_CAPSULE_NAME "vulkanmitts_mapped_memory_capsule"
 
+    // the capsule references the memory, vkFreeMemory is deferred until the last array on the mapping is garbage collected
     struct VkMapMemoryCapsule
     {
         VkDevice m_device;
         VkDeviceMemory m_memory;
+        std::shared_ptr<VkDeviceMemory_T> m_memory_ref;
     };
 
     void free_vkmapmemory_cap(PyObject * cap)
@@ -518,61 +610,306 @@ std::shared_ptr< VkCommandBufferVector > allocateCommandBuffers(VkDevice device,
         if (p_capsule != nullptr)
         {
             vkUnmapMemory(p_capsule->m_device, p_capsule->m_memory);
+            // may call vkFreeMemory, after the unmap
             delete p_capsule;
         }
     }
 }
 
-// Type map for contiguous buffer interface - e.g. uniform buffer
-%typemap(in, numinputs = 0)
-(void** ppData_contiguous, VkDeviceSize* buffer_size)
-(void*  data_temp = nullptr, VkDeviceSize  dim_temp)
-{
-    $1 = &data_temp;
-    $2 = &dim_temp;
-}
+// genswigi skips the commands with a const void* parameter, values can be any C contiguous buffer e.g. a numpy array
+%inline %{
+    void cmdPushConstants(VkCommandBuffer commandBuffer, VkPipelineLayout layout, VkShaderStageFlags stageFlags, uint32_t offset, PyObject* values)
+    {
+        Py_buffer view;
+        if (PyObject_GetBuffer(values, &view, PyBUF_C_CONTIGUOUS) != 0)
+        {
+            PyErr_Clear();
+            throw std::runtime_error("cmdPushConstants values must be a C contiguous buffer e.g. a numpy array");
+        }
+        vkCmdPushConstants(commandBuffer, layout, stageFlags, offset, static_cast<uint32_t>(view.len), view.buf);
+        PyBuffer_Release(&view);
+    }
+%}
 
-%typemap(argout, fragment = "NumPy_Backward_Compatibility,NumPy_Utilities,vulkanmitts_mapmemory")
-(void** ppData_contiguous, VkDeviceSize* buffer_size)
-{
-    npy_intp dims[1] = { static_cast<npy_intp>(*$2) };
-    PyObject* obj = PyArray_SimpleNewFromData(1, dims, NPY_UBYTE, (void*)(*$1));
-    PyArrayObject* array = (PyArrayObject*)obj;
+// Command stream: an array of fixed size records replayed into a command buffer by one C++ loop, see vkcommandstream.py
+// it avoids the argument conversion and the temporary vectors of one Python call per command
+// buffers is the table of handles referenced by index, payload holds the push constant bytes
+%inline %{
+    enum CommandStreamOpcode
+    {
+        COMMAND_STREAM_NOP = 0,
+        COMMAND_STREAM_BIND_VERTEX_BUFFER = 1, // binding, buffer index, offset low, offset high
+        COMMAND_STREAM_BIND_INDEX_BUFFER = 2,  // buffer index, offset low, offset high, index type
+        COMMAND_STREAM_PUSH_CONSTANTS = 3,     // stage flags, offset, size, payload offset
+        COMMAND_STREAM_DRAW = 4,               // vertex count, instance count, first vertex, first instance
+        COMMAND_STREAM_DRAW_INDEXED = 5,       // index count, instance count, first index, vertex offset, first instance
+        COMMAND_STREAM_SET_SCISSOR = 6         // first scissor, x, y, width, height
+    };
+%}
 
-    if (!array)
-        SWIG_fail;
+%{
+    struct CommandStreamRecord
+    {
+        uint32_t opcode;
+        uint32_t args[7];
+    };
 
-    VkMapMemoryCapsule *p_cap = new VkMapMemoryCapsule;
-    p_cap->m_device = arg1;
-    p_cap->m_memory = arg2;
+    const char* replayCommandStream(VkCommandBuffer commandBuffer, const CommandStreamRecord* records, size_t count, const std::vector<VkBuffer>& buffers, VkPipelineLayout layout, const uint8_t* payload, size_t payloadSize)
+    {
+        for (size_t i = 0; i < count; ++i)
+        {
+            const uint32_t* a = records[i].args;
+            switch (records[i].opcode)
+            {
+            case COMMAND_STREAM_NOP:
+                break;
+            case COMMAND_STREAM_BIND_VERTEX_BUFFER:
+                {
+                    if (a[1] >= buffers.size()) return "command stream buffer index out of range";
+                    VkDeviceSize offset = static_cast<VkDeviceSize>(a[2]) | (static_cast<VkDeviceSize>(a[3]) << 32);
+                    vkCmdBindVertexBuffers(commandBuffer, a[0], 1, &buffers[a[1]], &offset);
+                }
+                break;
+            case COMMAND_STREAM_BIND_INDEX_BUFFER:
+                if (a[0] >= buffers.size()) return "command stream buffer index out of range";
+                vkCmdBindIndexBuffer(commandBuffer, buffers[a[0]], static_cast<VkDeviceSize>(a[1]) | (static_cast<VkDeviceSize>(a[2]) << 32), static_cast<VkIndexType>(a[3]));
+                break;
+            case COMMAND_STREAM_PUSH_CONSTANTS:
+                if (layout == VK_NULL_HANDLE) return "command stream push constants without pipeline layout";
+                if (static_cast<size_t>(a[3]) + a[2] > payloadSize) return "command stream payload range out of range";
+                vkCmdPushConstants(commandBuffer, layout, a[0], a[1], a[2], payload + a[3]);
+                break;
+            case COMMAND_STREAM_DRAW:
+                vkCmdDraw(commandBuffer, a[0], a[1], a[2], a[3]);
+                break;
+            case COMMAND_STREAM_DRAW_INDEXED:
+                vkCmdDrawIndexed(commandBuffer, a[0], a[1], a[2], static_cast<int32_t>(a[3]), a[4]);
+                break;
+            case COMMAND_STREAM_SET_SCISSOR:
+                {
+                    VkRect2D scissor = { { static_cast<int32_t>(a[1]), static_cast<int32_t>(a[2]) }, { a[3], a[4] } };
+                    vkCmdSetScissor(commandBuffer, a[0], 1, &scissor);
+                }
+                break;
+            default:
+                return "unknown command stream opcode";
+            }
+        }
+        return nullptr;
+    }
+%}
 
-    PyObject* cap = PyCapsule_New((void*)p_cap, PYVULKAN_MAPPEDMEMORY_CAPSULE_NAME, free_vkmapmemory_cap);
-    PyArray_SetBaseObject(array, cap);
+// records is a C contiguous array of 32 bytes records e.g. numpy COMMAND_STREAM_RECORD, payload can be None
+// the GIL is released during the replay, the records and the payload are pinned by their buffer views
+void cmdReplayCommandStream(VkCommandBuffer commandBuffer, PyObject* records, const std::vector<VkBuffer>& buffers, VkPipelineLayout layout, PyObject* payload);
+%{
+    void cmdReplayCommandStream(VkCommandBuffer commandBuffer, PyObject* records, const std::vector<VkBuffer>& buffers, VkPipelineLayout layout, PyObject* payload)
+    {
+        Py_buffer records_view;
+        if (PyObject_GetBuffer(records, &records_view, PyBUF_C_CONTIGUOUS) != 0)
+        {
+            PyErr_Clear();
+            throw std::runtime_error("cmdReplayCommandStream records must be a C contiguous buffer e.g. a numpy array");
+        }
+        if (records_view.len % sizeof(CommandStreamRecord) != 0)
+        {
+            PyBuffer_Release(&records_view);
+            throw std::runtime_error("cmdReplayCommandStream records must be 32 bytes each");
+        }
 
-    $result = SWIG_Python_AppendOutput($result, obj);
-}
+        Py_buffer payload_view = {};
+        bool has_payload = payload != nullptr && payload != Py_None;
+        if (has_payload && PyObject_GetBuffer(payload, &payload_view, PyBUF_C_CONTIGUOUS) != 0)
+        {
+            PyErr_Clear();
+            PyBuffer_Release(&records_view);
+            throw std::runtime_error("cmdReplayCommandStream payload must be a C contiguous buffer e.g. a numpy array");
+        }
+
+        const char* error = nullptr;
+        Py_BEGIN_ALLOW_THREADS
+        error = replayCommandStream(commandBuffer,
+                                    static_cast<const CommandStreamRecord*>(records_view.buf),
+                                    records_view.len / sizeof(CommandStreamRecord),
+                                    buffers,
+                                    layout,
+                                    has_payload ? static_cast<const uint8_t*>(payload_view.buf) : nullptr,
+                                    has_payload ? payload_view.len : 0);
+        Py_END_ALLOW_THREADS
+
+        if (has_payload)
+        {
+            PyBuffer_Release(&payload_view);
+        }
+        PyBuffer_Release(&records_view);
+        if (error != nullptr)
+        {
+            // the commands before the faulty record are already recorded
+            throw std::runtime_error(error);
+        }
+    }
+%}
+
+// vkAllocateMemory is wrapped by hand to remember the size of each allocation, mapMemory needs it to resolve VK_WHOLE_SIZE
+// and a weak reference so that the mapped arrays can keep the memory alive after its Python wrapper is deleted
+%{
+    struct MemoryRecord
+    {
+        VkDeviceSize size;
+        std::weak_ptr<VkDeviceMemory_T> ref;
+    };
+
+    std::mutex g_memory_sizes_mutex;
+    std::unordered_map<VkDeviceMemory, MemoryRecord> g_memory_sizes;
 
+    VkDeviceSize getMemorySize(VkDeviceMemory memory)
+    {
+        std::lock_guard<std::mutex> lock(g_memory_sizes_mutex);
+        auto it = g_memory_sizes.find(memory);
+        if (it == g_memory_sizes.end())
+        {
+            throw std::runtime_error("Unknown VkDeviceMemory; VK_WHOLE_SIZE requires memory allocated by vulkanmitts.allocateMemory");
+        }
+        return it->second.size;
+    }
+
+    // empty for memory not allocated by vulkanmitts.allocateMemory, its lifetime is then up to the caller
+    std::shared_ptr<VkDeviceMemory_T> lockMemory(VkDeviceMemory memory)
+    {
+        std::lock_guard<std::mutex> lock(g_memory_sizes_mutex);
+        auto it = g_memory_sizes.find(memory);
+        if (it == g_memory_sizes.end())
+        {
+            return std::shared_ptr<VkDeviceMemory_T>();
+        }
+        return it->second.ref.lock();
+    }
+%}
+
+std::shared_ptr<VkDeviceMemory_T> allocateMemory(VkDevice device, const VkMemoryAllocateInfo& allocateInfo);
+VkDeviceSize getMemorySize(VkDeviceMemory memory);
+
+%{
+    std::shared_ptr<VkDeviceMemory_T> allocateMemory(VkDevice device, const VkMemoryAllocateInfo& allocateInfo)
+    {
+        VkDeviceMemory memory = nullptr;
+        VkResult res;
+        Py_BEGIN_ALLOW_THREADS
+        res = vkAllocateMemory(device, &allocateInfo, nullptr, &memory);
+        Py_END_ALLOW_THREADS
+        ThrowOnVkError(res, "vkAllocateMemory", __FILE__, __LINE__);
+        std::shared_ptr<VkDeviceMemory_T> memory_ref(memory,
+            [device](VkDeviceMemory to_free)
+            {
+                {
+                    std::lock_guard<std::mutex> lock(g_memory_sizes_mutex);
+                    g_memory_sizes.erase(to_free);
+                }
+                vkFreeMemory(device, to_free, nullptr);
+            });
+        {
+            std::lock_guard<std::mutex> lock(g_memory_sizes_mutex);
+            g_memory_sizes[memory] = MemoryRecord{ allocateInfo.allocationSize, memory_ref };
+        }
+        return memory_ref;
+    }
+%}
+
+%fragment("vulkanmitts_mapmemory");
+
+// Maps a contiguous range e.g. a uniform or vertex buffer and returns it as a numpy array
+// dtype can be anything accepted by numpy.dtype including structured dtypes, the default is uint8
+// shape defaults to a flat array covering the whole range, size can be VK_WHOLE_SIZE
+// the array owns the mapping, vkUnmapMemory is called when it is garbage collected
+// it also keeps memory allocated by allocateMemory alive, deleting the memory wrapper while arrays are alive is safe
 %inline %{
-    void mapMemory(
+    PyObject* mapMemory(
         VkDevice                                    device,
         VkDeviceMemory                              memory,
         VkDeviceSize                                offset,
         VkDeviceSize                                size,
         VkMemoryMapFlags                            flags,
-        void**                                      ppData_contiguous,
-        VkDeviceSize*                               buffer_size)
+        PyObject*                                   dtype = nullptr,
+        PyObject*                                   shape = nullptr)
     {
         if (size == VK_WHOLE_SIZE)
         {
-            throw std::runtime_error("VK_WHOLE_SIZE not supported; Please compute the size");
+            auto memory_size = getMemorySize(memory);
+            if (offset >= memory_size)
+            {
+                throw std::out_of_range("mapMemory offset is past the end of the allocation");
+            }
+            size = memory_size - offset;
         }
 
-        V(vkMapMemory(device, memory, offset, size, flags, ppData_contiguous));
-        *buffer_size = size;
-    }
-%}
+        PyArray_Descr* descr = nullptr;
+        if (dtype == nullptr || dtype == Py_None)
+        {
+            descr = PyArray_DescrFromType(NPY_UBYTE);
+        }
+        else if (!PyArray_DescrConverter(dtype, &descr))
+        {
+            throw std::runtime_error("mapMemory dtype is not a valid numpy dtype");
+        }
+
+        npy_intp dims[NPY_MAXDIMS] = { 0 };
+        int ndims = 1;
+        npy_intp n_elements = 0;
+        if (shape == nullptr || shape == Py_None)
+        {
+            dims[0] = static_cast<npy_intp>(size / descr->elsize);
+            n_elements = dims[0];
+        }
+        else
+        {
+            PyArray_Dims shape_dims = { nullptr, 0 };
+            if (!PyArray_IntpConverter(shape, &shape_dims))
+            {
+                Py_DECREF(descr);
+                throw std::runtime_error("mapMemory shape must be an int or a sequence of ints");
+            }
+            ndims = shape_dims.len;
+            n_elements = 1;
+            for (int i = 0; i < ndims; ++i)
+            {
+                dims[i] = shape_dims.ptr[i];
+                n_elements *= dims[i];
+            }
+            PyDimMem_FREE(shape_dims.ptr);
+        }
 
+        if (static_cast<VkDeviceSize>(n_elements) * descr->elsize > size)
+        {
+            Py_DECREF(descr);
+            throw std::out_of_range("mapMemory dtype and shape are larger than the mapped range");
+        }
 
+        void* p_data = nullptr;
+        VkResult res = vkMapMemory(device, memory, offset, size, flags, &p_data);
+        if (res != VK_SUCCESS)
+        {
+            Py_DECREF(descr);
+            ThrowOnVkError(res, "vkMapMemory", __FILE__, __LINE__);
+        }
+
+        // PyArray_NewFromDescr steals the reference to descr
+        PyObject* obj = PyArray_NewFromDescr(&PyArray_Type, descr, ndims, dims, nullptr, p_data, NPY_ARRAY_CARRAY, nullptr);
+        if (!obj)
+        {
+            vkUnmapMemory(device, memory);
+            return nullptr;
+        }
+
+        VkMapMemoryCapsule *p_cap = new VkMapMemoryCapsule;
+        p_cap->m_device = device;
+        p_cap->m_memory = memory;
+        p_cap->m_memory_ref = lockMemory(memory);
+
+        PyObject* cap = PyCapsule_New((void*)p_cap, PYVULKAN_MAPPEDMEMORY_CAPSULE_NAME, free_vkmapmemory_cap);
+        PyArray_SetBaseObject((PyArrayObject*)obj, cap);
+        return obj;
+    }
+%}
 
 // Type map for strided image buffer - e.g. texture image staging buffer
 %typemap(in, numinputs = 0)
@@ -599,6 +936,7 @@ std::shared_ptr< VkCommandBufferVector > allocateCommandBuffers(VkDevice device,
     VkMapMemoryCapsule *p_cap = new VkMapMemoryCapsule;
     p_cap->m_device = arg1;
     p_cap->m_memory = arg2;
+    p_cap->m_memory_ref = lockMemory(arg2);
 
     PyObject* cap = PyCapsule_New((void*)p_cap, PYVULKAN_MAPPEDMEMORY_CAPSULE_NAME, free_vkmapmemory_cap);
     PyArray_SetBaseObject(array, cap);